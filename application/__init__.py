@@ -15,15 +15,49 @@ def configure_app(app, configuration):
     app.config.from_pyfile('environ.py', silent=True)
 
 
+def configure_json(app):
+    from application.modules.json_encoder import make_encoder
+
+    app.json_encoder = make_encoder(app.config['JSON_BACKEND'], app.config['JSON_COMPACT'])
+
+
+def configure_concurrency(app):
+    mode = app.config['CONCURRENCY']
+    if mode not in ('prefork', 'threads', 'gevent'):
+        raise ValueError('Unknown CONCURRENCY %s' % mode)
+
+    if mode == 'gevent':
+        from gevent import monkey
+
+        if not monkey.is_module_patched('socket'):
+            raise RuntimeError('gevent concurrency needs standard library patched before app is imported, '
+                               'use deploy_gevent.py')
+
+    # every request in flight may hold a Redis connection and token cache listener holds one more
+    workers = app.config['CONCURRENCY_WORKERS']
+    app.config['REDIS_MAX_CONNECTIONS'] = max(app.config['REDIS_MAX_CONNECTIONS'], workers + 1)
+
+    # sqlite has no connection pool to size, requests over pool size wait for a database connection
+    if mode != 'prefork' and not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config.setdefault('SQLALCHEMY_POOL_SIZE', min(workers, 20))
+
+
 def configure_folders(app):
     for key, value in app.config.items():
-        if key.endswith('DIR'):
+        # folders left unset are resolved by their extensions
+        if key.endswith('DIR') and value is not None:
             if not os.path.exists(value):
                 os.makedirs(value)
                 app.logger.info("{} created at {}".format(key, value))
 
 
 def configure_controllers(app):
+    from application.modules.lazy import load_url_map, save_url_map
+
+    if app.config['LAZY_VIEWS'] and load_url_map(app):
+        return
+
+    blueprints = []
     controllers = app.config['CONTROLLERS']
     for controller in controllers:
         bp = __import__('application.controllers.%s' % controller, fromlist=[controller])
@@ -31,12 +65,16 @@ def configure_controllers(app):
         for route in bp.__all__:
             route_obj = getattr(bp, route)
             app.register_blueprint(route_obj)
+            blueprints.append(route_obj)
+
+    if app.config['LAZY_VIEWS'] and not save_url_map(app, blueprints):
+        app.logger.warning('Url map is not cacheable, controllers are imported on every start')
 
 
 def configure_errorhandlers(app):
     # python imports
+    from jsonschema import ValidationError as JsonValidationError
     # flask imports
-    from flask.ext.jsonschema import ValidationError as JsonValidationError
 
     # from application.extensions import bug_report
 
@@ -152,16 +190,15 @@ def configure_errorhandlers(app):
 
 def configure_extensions(app):
     import application.extensions as ex
-    from application.extensions import redis
-    from application.extensions import migrate, db
+    from application.extensions import redis, db
 
+    # extensions which need more than app to be initialized
+    arguments = {'migrate': {'db': db}}
+
+    # an extension which fails to initialize must stop the app, others rely on it
     for extension in app.config['EXTENSIONS']:
-        try:
-            getattr(ex, extension).init_app(app)
-        except (AttributeError, TypeError):
-            pass
+        getattr(ex, extension).init_app(app, **arguments.get(extension, {}))
     redis.init_app(app, strict=True)
-    migrate.init_app(app, db)
 
 
 def configure_media(app):
@@ -173,6 +210,10 @@ def configure_media(app):
 
 
 def configure_admin(app):
+    # admin views import the whole Flask-Admin SQLAlchemy support
+    if 'admin' not in app.config['EXTENSIONS']:
+        return
+
     from application.admin import (AdminModelView)
 
     from application.extensions import admin, db
@@ -181,13 +222,31 @@ def configure_admin(app):
 
 
 def configure_event_listeners(app):
-    pass
+    from sqlalchemy import event
+    from flask.ext.sqlalchemy import SignallingSession
+    from application.models.user import collect_changed_users, invalidate_changed_users, forget_changed_users
+    from application.modules import count_cache, search_sync
+
+    # listeners are attached to the session class so guard against apps created more than once (tests)
+    for name, listener in (('after_flush', collect_changed_users),
+                           ('after_commit', invalidate_changed_users),
+                           ('after_rollback', forget_changed_users),
+                           ('after_flush', count_cache.collect_changed_tables),
+                           ('after_commit', count_cache.invalidate_changed_tables),
+                           ('after_rollback', count_cache.forget_changed_tables),
+                           ('after_flush', search_sync.collect_changed_documents),
+                           ('after_commit', search_sync.enqueue_changed_documents),
+                           ('after_rollback', search_sync.forget_changed_documents)):
+        if not event.contains(SignallingSession, name, listener):
+            event.listen(SignallingSession, name, listener)
 
 
 def create_app(configuration):
     app = Flask(__name__)
 
     configure_app(app, configuration)
+    configure_json(app)
+    configure_concurrency(app)
     configure_folders(app)
     configure_media(app)
     configure_errorhandlers(app)
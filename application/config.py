@@ -29,7 +29,18 @@ class DefaultConfig(object):
 
     API_VERSION = 1
 
+    # How a worker process serves requests: 'prefork' (one at a time), 'threads' or 'gevent', in which case
+    # each process serves CONCURRENCY_WORKERS requests at the same time (see uwsgi-threads.ini and uwsgi-gevent.ini)
+    CONCURRENCY = 'prefork'
+    CONCURRENCY_WORKERS = 1
+
+    # 'auto' picks simplejson when it is installed and json otherwise
+    JSON_BACKEND = 'auto'
+    JSON_COMPACT = False
+
     PAGE_SIZE = 10
+    # Streamed paginated responses read and write this many items at a time
+    PAGINATE_STREAM_CHUNK_SIZE = 1000
 
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
@@ -43,15 +54,122 @@ class DefaultConfig(object):
     CACHE_DEFAULT_TIMEOUT = 3600
     CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/cache/')
 
+    # Paginated totals are cached in cache backend until a table they count is changed
+    COUNT_CACHE_TIMEOUT = 60 * 60
+    # paginate(approximate_total=True) trusts planner estimates above this many rows (PostgreSQL only)
+    COUNT_ESTIMATE_THRESHOLD = 100000
+
+    # unix:///path/to/redis.sock?db=0 connects through a unix socket
     REDIS_URL = "redis://localhost:6379/0"
+    # Each worker process has its own pool, requests wait REDIS_POOL_TIMEOUT seconds when all connections are in use
+    REDIS_MAX_CONNECTIONS = 20
+    REDIS_POOL_TIMEOUT = 5
+    REDIS_SOCKET_TIMEOUT = 5
+    REDIS_SOCKET_CONNECT_TIMEOUT = 2
+    REDIS_SOCKET_KEEPALIVE = True
+    # Connections idle longer than this many seconds are pinged before use, 0 disables checks
+    REDIS_HEALTH_CHECK_INTERVAL = 30
+    # memory:// keeps indices in process, for tests
     ELASTICSEARCH_HOST = "localhost:9200"
+    # Alias searches are sent to, ./manager.py database reindex builds a new index and swaps the alias to it
+    SEARCH_INDEX = 'example'
+    # Documents per bulk request and bulk requests sent at the same time while reindexing
+    SEARCH_BULK_CHUNK_SIZE = 500
+    SEARCH_BULK_THREADS = 4
+    # Index settings turned back on once bulk load is done (refresh and replicas are off during it)
+    SEARCH_REFRESH_INTERVAL = '1s'
+    SEARCH_REPLICAS = 1
+    # Indexed rows changed by a commit are queued in SEARCH_SYNC_OUTBOX and sent to search index by
+    # ./manager.py search_worker, SEARCH_SYNC_BATCH_SIZE documents per bulk request
+    SEARCH_SYNC_ENABLED = True
+    SEARCH_SYNC_OUTBOX = 'search:outbox'
+    SEARCH_SYNC_BATCH_SIZE = 500
+    SEARCH_SYNC_INTERVAL = 1  # seconds worker waits when outbox is empty
 
     ACTIVATION_CODE_TIMEOUT = 60 * 10  # 10 minutes
     ACCESS_TOKEN_TIMEOUT = 60 * 60  # 60 minutes
+    # Sign access tokens with SECRET_KEY instead of storing each of them in Redis
+    ACCESS_TOKEN_SIGNED = False
+
+    # Per worker access token cache, revocations are broadcast to workers over TOKEN_CACHE_CHANNEL
+    TOKEN_CACHE_ENABLED = True
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TIMEOUT = 60
+    TOKEN_CACHE_NEGATIVE_TIMEOUT = 5
+    TOKEN_CACHE_CHANNEL = 'uat:invalidate'
+    # Serialized user rows are cached for a few seconds per worker, changes are broadcast on TOKEN_CACHE_CHANNEL
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TIMEOUT = 5
+    # Columns of users table which are not loaded for authenticated user unless accessed
+    USER_DEFERRED_COLUMNS = ('password',)
+
+    # App wide response compression, brotli is used when the package (0.6 or newer) is installed and client accepts it
+    COMPRESS_ENABLED = True
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI_LEVEL = 4
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+    # media files are served as they are stored
+    COMPRESS_SKIP_PATHS = ('/media/',)
+    COMPRESS_CACHE_SIZE = 256
+    COMPRESS_CACHE_TIMEOUT = 60 * 10
+    COMPRESS_CACHE_MAX_BODY = 256 * 1024
+
+    # GET responses of views decorated with cached_response, stored with Flask-Cache (CACHE_TYPE) or in Redis
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_BACKEND = 'cache'
+    RESPONSE_CACHE_TIMEOUT = 60 * 5
+
+    # Activation codes are queued in Redis and sent by ./manager.py sms_worker, codes are only logged when SMS_ON is off
+    SMS_ON = False
+    SMS_QUEUE = 'sms'
+    SMS_PROVIDER = 'fake'
+    # concurrency is the most batches sent to a provider at the same time
+    SMS_PROVIDERS = {
+        'fake': {'class': 'application.modules.sms.FakeProvider', 'concurrency': 4},
+    }
+    SMS_BATCH_SIZE = 100
+    SMS_MAX_ATTEMPTS = 5
+    SMS_RETRY_BACKOFF = 30  # seconds, doubled after each failed attempt
+
+    # POST /api/v1/user/bulk_authenticate is only served to partners sending this key in X-Api-Key header
+    BULK_API_KEY = os.environ.get('BULK_API_KEY')
+    # phones registered per database and Redis round trip, SQLite allows 999 parameters per statement
+    BULK_CHUNK_SIZE = 500
+
+    # GET /api/v1/stats shows per worker monitoring data
+    STATS_ENABLED = False
+
+    # Share of requests whose phases (auth, db, redis, validation, serialize, compress) are timed and aggregated,
+    # TIMING_HEADER sends the timings of a sampled request back in a Server-Timing header
+    TIMING_ENABLED = True
+    TIMING_SAMPLE_RATE = 0.01
+    TIMING_HEADER = False
+
+    # Requests picked by PROFILER_SAMPLE_RATE or sent with PROFILER_HEADER set to PROFILER_SECRET are profiled, those
+    # faster than PROFILER_THRESHOLD_MS are dropped. PROFILER_MODE is cprofile or sampler (cheap, for rate 1.0)
+    PROFILER_ENABLED = False
+    PROFILER_MODE = 'cprofile'
+    PROFILER_SAMPLE_RATE = 0
+    PROFILER_HEADER = 'X-Profile'
+    PROFILER_SECRET = os.environ.get('PROFILER_SECRET')
+    PROFILER_THRESHOLD_MS = None
+    PROFILER_SAMPLER_INTERVAL = 0.005
+    # <CACHE_DIR>/profiles when None, created only when profiler is enabled
+    PROFILER_DIR = None
+
+    # Count SQL statements of each request and warn when one of them runs more than QUERY_REPEAT_THRESHOLD times
+    QUERY_COUNT_ENABLED = False
+    QUERY_REPEAT_THRESHOLD = 5
 
     # TODO not a good option because it allow CORS attack so use credentials in future
     CORS_RESOURCES = {r"/api/*": {"origins": "*"}}
-    EXTENSIONS = ['db', 'cache', 'json', 'es', 'sms', 'cors', 'admin', 'es']
+    # es, admin and migrate packages are only imported when they are listed here
+    EXTENSIONS = ['db', 'cache', 'json', 'es', 'sms', 'cors', 'admin', 'migrate', 'token_cache', 'compress',
+                  'timing', 'profiler', 'query_counter']
+
+    # Read controller url rules from a url map cached in CACHE_DIR and import views on first request
+    LAZY_VIEWS = False
 
 
 class DeploymentConfig(DefaultConfig):
@@ -60,10 +178,29 @@ class DeploymentConfig(DefaultConfig):
     DEPLOYMENT = True
     CACHE_TYPE = 'filesystem'
     FANTASY_LEAGUE_START = True
+    JSON_COMPACT = True
+    # migrations are run by manager.py
+    EXTENSIONS = ['db', 'cache', 'json', 'es', 'sms', 'cors', 'admin', 'token_cache', 'compress', 'timing', 'profiler',
+                  'query_counter']
+    LAZY_VIEWS = True
+
+
+class ThreadedDeploymentConfig(DeploymentConfig):
+    CONCURRENCY = 'threads'
+    CONCURRENCY_WORKERS = 8
+
+
+class GeventDeploymentConfig(DeploymentConfig):
+    CONCURRENCY = 'gevent'
+    CONCURRENCY_WORKERS = 100
 
 
 class DevelopmentConfig(DefaultConfig):
     DEBUG = True
+    STATS_ENABLED = True
+    TIMING_SAMPLE_RATE = 1.0
+    TIMING_HEADER = True
+    QUERY_COUNT_ENABLED = True
 
 
 class TestingConfig(DefaultConfig):
@@ -71,3 +208,8 @@ class TestingConfig(DefaultConfig):
     TESTING = True
     DEPLOYMENT = True
     CACHE_TYPE = 'null'
+    SEARCH_SYNC_ENABLED = False
+    EXTENSIONS = ['db', 'cache', 'json', 'sms', 'cors', 'token_cache', 'compress', 'timing', 'profiler',
+                  'query_counter']
+    # controllers are imported as they are, never through a url map cached by an earlier run
+    LAZY_VIEWS = False
@@ -2,9 +2,11 @@
 
 
 # flask imports
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, abort, current_app
 
 # project imports
+from application.decorators import cached_response
+from application.extensions import redis, timing
 
 __author__ = 'Hamid FzM'
 
@@ -20,6 +22,7 @@ def index():
 
 
 @api1.route('')
+@cached_response(vary_user=False)
 def status():
     """
     @apiVersion 1.0.0
@@ -36,3 +39,24 @@ def status():
     # OK or Deprecate api
     return jsonify(version=1, status="OK"), 200
 
+
+@api1.route('/stats')
+def stats():
+    """
+    @apiVersion 1.0.0
+    @apiGroup Main
+    @apiName Stats
+    @apiDescription Show monitoring data of the worker process which answers (only when STATS_ENABLED is set)
+    @api {get} /v1/stats API V1 Stats
+    @apiHeader {String} Content-Type =application/json JSON (application/json)
+
+    @apiSuccess {Object} redis Redis connection pool usage
+    @apiSuccess {Object} timing Histograms of sampled requests per endpoint and phase (total, auth, db, redis,
+                validation, serialize, compress) with samples, calls, mean_ms, p50_ms, p95_ms, p99_ms and buckets
+
+    @apiUse NotFound
+    """
+    if not current_app.config['STATS_ENABLED']:
+        return abort(404)
+
+    return jsonify(redis=redis.pool_stats(), timing=timing.snapshot()), 200
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 # python imports
+import hmac
 from datetime import datetime
 from uuid import uuid4
 from sqlalchemy.exc import IntegrityError
@@ -9,12 +10,13 @@ from os import path, remove
 
 # flask imports
 from flask import Blueprint, request, jsonify, abort, g, current_app
-from flask.ext.jsonschema import validate
 
 # project imports
-from application.extensions import db
+from application.decorators import cached_response
+from application.extensions import db, redis_pipeline
 from application.models.user import User
 from application.forms.user import UploadAvatar
+from application.modules.schema_validator import validate
 
 api1 = Blueprint('user.api1', __name__, url_prefix='/api/v1/user')
 
@@ -60,6 +62,45 @@ def authenticate():
         return jsonify(), 201
 
 
+@api1.route('/bulk_authenticate', methods=['POST'])
+@validate('bulk_authenticate')
+def bulk_authenticate():
+    """
+    @apiVersion 1.0.0
+    @apiGroup User
+    @apiName BulkAuthenticate
+    @apiDescription Register many phone numbers at once (partner campaigns) and send activation codes to them.
+    Only served when BULK_API_KEY is configured.
+    @api {post} /v1/user/bulk_authenticate Authenticate or register many phone numbers
+    @apiHeader {String} Content-Type =application/json JSON (application/json)
+    @apiHeader {String} X-Api-Key Partner API key
+
+    @apiParam {String[]} phones Phone numbers, at most 10000
+    @apiParam {Boolean} [send_codes=true] Send activation codes
+
+    @apiSuccess {Object[]} results Status of each phone in request order
+    @apiSuccess {String} results.phone Phone number
+    @apiSuccess {String} results.status created, existing, invalid or duplicate (repeated in request)
+    @apiSuccess {Object} counts Number of phones with each status
+
+    @apiUse Unauthorized
+    @apiUse NotFound
+    @apiUse BadRequest
+    """
+    api_key = current_app.config['BULK_API_KEY']
+    if not api_key:
+        return abort(404)
+    if not hmac.compare_digest(str(request.headers.get('X-Api-Key', '')), str(api_key)):
+        return abort(401)
+
+    results = User.bulk_authenticate(request.json['phones'], request.json.get('send_codes', True))
+
+    counts = dict((status, 0) for status in ('created', 'existing', 'invalid', 'duplicate'))
+    for _, status in results:
+        counts[status] += 1
+    return jsonify(results=[{'phone': phone, 'status': status} for phone, status in results], counts=counts), 200
+
+
 @api1.route('/web_authenticate', methods=['POST'])
 @validate('web_authenticate')
 def web_authenticate():
@@ -95,11 +136,13 @@ def web_authenticate():
 
         # TODO save password using bycrypt not plain text in DB
         if user_obj.password == json['password']:
-            access_token = user_obj.generate_access_token()
+            # token is stored in Redis only if it is committed to database too
+            with redis_pipeline() as pipe:
+                access_token = user_obj.generate_access_token(pipe)
 
-            token_obj = Token(user=user_obj, access=access_token, refresh=str(uuid4()))
-            db.session.add(token_obj)
-            db.session.commit()
+                token_obj = Token(user=user_obj, access=access_token, refresh=str(uuid4()))
+                db.session.add(token_obj)
+                db.session.commit()
 
             return jsonify(access=access_token, refresh=token_obj.refresh), 200
 
@@ -144,11 +187,13 @@ def activate():
         # Warning!!! 1370 activation code is for developing purpose
         # TODO think about a solution to stop brute force and DDOS attacks using activation codes
         if user_obj.consume_activation_code(json['code']) or json['code'] == '13740':
-            access_token = user_obj.generate_access_token()
+            # token is stored in Redis only if it is committed to database too
+            with redis_pipeline() as pipe:
+                access_token = user_obj.generate_access_token(pipe)
 
-            token_obj = Token(user=user_obj, access=access_token, refresh=str(uuid4()))
-            db.session.add(token_obj)
-            db.session.commit()
+                token_obj = Token(user=user_obj, access=access_token, refresh=str(uuid4()))
+                db.session.add(token_obj)
+                db.session.commit()
 
             if user_obj.user_name is None or user_obj.user_name == "":
                 return jsonify(access=access_token, refresh=token_obj.refresh), 201
@@ -190,9 +235,12 @@ def refresh():
 
     if token_obj.consume_access_code(json['access']):
         token_obj.last_refresh = datetime.utcnow()
-        access_token = token_obj.user.generate_access_token()
-        token_obj.access = access_token
-        db.session.commit()
+        # new token is stored and old one revoked in one round trip
+        with redis_pipeline() as pipe:
+            access_token = token_obj.user.generate_access_token(pipe)
+            token_obj.access = access_token
+            db.session.commit()
+            User.revoke_access_token(json['access'], pipe)
 
         return jsonify(access=access_token), 200
 
@@ -201,6 +249,7 @@ def refresh():
 
 @api1.route('', methods=['GET'])
 @User.authenticate()
+@cached_response(tags=('user:{me}',))
 def profile():
     """
     @apiVersion 1.0.0
@@ -210,6 +259,7 @@ def profile():
     @api {get} /v1/user Get private user profile
     @apiHeader {String} Content-Type =application/json JSON (application/json)
     @apiHeader {String} Access-Token User access token
+    @apiHeader {String} [If-None-Match] ETag of a previous response, 304 is returned while it is current
 
     @apiSuccess {String} user_name User nick name
     @apiSuccess {String} real_name User real name
@@ -224,11 +274,12 @@ def profile():
 
     @apiSampleRequest http://example.com/api/v1/user
     """
-    return jsonify(g.user.to_json()), 200
+    return jsonify(User.cached_json(g.user_id, g.user)), 200
 
 
 @api1.route('/<int:user_id>', methods=['GET'])
 @User.authenticate()
+@cached_response(tags=('user:{user_id}',), vary_user=False)
 def profile_other(user_id):
     """
     @apiVersion 1.0.0
@@ -238,6 +289,7 @@ def profile_other(user_id):
     @api {get} /v1/user/:id Get public user profile
     @apiHeader {String} Content-Type =application/json JSON (application/json)
     @apiHeader {String} Access-Token User access token
+    @apiHeader {String} [If-None-Match] ETag of a previous response, 304 is returned while it is current
 
     @apiParam {Integer} id Other user id
 
@@ -250,10 +302,10 @@ def profile_other(user_id):
     @apiSampleRequest http://example.com/api/v1/user/:id
     """
 
-    user_obj = User.query.get(user_id)
-    if not user_obj:
+    user_json = User.cached_json(user_id)
+    if not user_json:
         return abort(404)
-    return jsonify(user_name=user_obj.user_name), 200
+    return jsonify(user_name=user_json['user_name']), 200
 
 
 @api1.route('', methods=['PUT'])
@@ -428,8 +480,10 @@ def revoke():
 
     @apiSampleRequest http://example.com/api/v1/user/revoke
     """
-    Token.revoke(request.headers.get('Access-Token'))
+    access_token = request.headers.get('Access-Token')
+    Token.revoke(access_token)
     db.session.commit()
+    User.revoke_access_token(access_token)
     return jsonify(), 200
 
 
@@ -452,8 +506,9 @@ def revoke_all():
 
     @apiSampleRequest http://example.com/api/v1/user/revoke_all
     """
-    Token.revoke_all(g.user)
+    Token.revoke_all(g.user._get_current_object())
     db.session.commit()
+    g.user.revoke_all_access_tokens()
     return jsonify(), 200
 
 
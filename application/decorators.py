@@ -1,16 +1,34 @@
 # python imports
 from functools import wraps
 from cStringIO import StringIO as IO
+from datetime import datetime, date
+from decimal import Decimal
 import gzip
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_, inspect
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import UnaryExpression
 
 # flask imports
-from flask import request, current_app, abort, after_this_request, url_for, jsonify, g
-from flask.ext.sqlalchemy import BaseQuery
+from flask import request, current_app, abort, after_this_request, url_for, jsonify, g, Response, stream_with_context, json, \
+    make_response
+from flask.ext.sqlalchemy import BaseQuery, Pagination
+
+# project imports
+from application.modules import count_cache, response_cache
+from application.modules.timing import phase
 
 
 def gzipped(f):
+    """
+    Deprecated, responses are compressed app wide when COMPRESS_ENABLED is set (see application.modules.compress)
+    """
+
     @wraps(f)
     def view_func(*args, **kwargs):
+        if current_app.config['COMPRESS_ENABLED']:
+            return f(*args, **kwargs)
+
         @after_this_request
         def zipper(response):
             accept_encoding = request.headers.get('Accept-Encoding', '')
@@ -24,11 +42,13 @@ def gzipped(f):
                         response.status_code >= 300 or
                         'Content-Encoding' in response.headers):
                 return response
-            gzip_buffer = IO()
-            gzip_file = gzip.GzipFile(mode='wb',
-                                      fileobj=gzip_buffer)
-            gzip_file.write(response.data)
-            gzip_file.close()
+            with phase('compress'):
+                gzip_buffer = IO()
+                gzip_file = gzip.GzipFile(mode='wb',
+                                          compresslevel=current_app.config['COMPRESS_LEVEL'],
+                                          fileobj=gzip_buffer)
+                gzip_file.write(response.data)
+                gzip_file.close()
 
             response.data = gzip_buffer.getvalue()
             response.headers['Content-Encoding'] = 'gzip'
@@ -42,8 +62,56 @@ def gzipped(f):
     return view_func
 
 
-def paginate(key, max_per_page):
+def cached_response(timeout=None, tags=(), vary_user=True):
+    """
+    Serve successful responses of a GET view from cache (RESPONSE_CACHE_ENABLED) with an ETag, clients sending it
+    back in If-None-Match get 304. Put it below User.authenticate so the access token is still checked.
+    :param timeout: seconds, RESPONSE_CACHE_TIMEOUT by default
+    :param tags: entries are skipped once one of these tags is invalidated (response_cache.invalidate), they are
+                 formatted with view arguments and me (authenticated user id), e.g. 'user:{me}'
+    :param vary_user: response depends on authenticated user, when off every user shares one entry
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not current_app.config['RESPONSE_CACHE_ENABLED'] or request.method != 'GET':
+                return f(*args, **kwargs)
+
+            user_id = g.get('user_id')
+            entry_key = response_cache.key(request.endpoint, user_id if vary_user else None, request.path,
+                                           request.args)
+            entry_tags = [tag.format(me=user_id, **kwargs) for tag in tags]
+
+            entry, versions = response_cache.load(entry_key, entry_tags)
+            if entry is None:
+                # rows cached by this worker may be older than versions, so the response is built from database
+                g.building_cached_response = True
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = response_cache.store(entry_key, entry_tags, versions, response.get_data(), response.mimetype,
+                                             timeout)
+
+            response = Response(entry['body'], mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            # clients check their copy on every request, only per user responses are kept out of shared caches
+            response.headers['Cache-Control'] = 'private, no-cache' if vary_user else 'no-cache'
+            return response.make_conditional(request)
+
+        return wrapped
+
+    return decorator
+
+
+def paginate(key, max_per_page, mode='offset', order_by=None, approximate_total=False, stream=False):
     """
+    :param mode: 'offset' uses page numbers, 'keyset' uses opaque cursors which keep deep pages as fast as the first one
+    :param order_by: keyset mode columns (or column.desc()) to order by, primary key is always added as tie breaker
+    :param approximate_total: use database planner estimate as total when it is COUNT_ESTIMATE_THRESHOLD or more
+    :param stream: write items to response while they are read from a server side cursor, for big per_page values.
+                   Clients accepting application/x-ndjson get one item per line followed by a {"meta": ...} line
+
     @apiDefine Paginate
     @apiSuccess {Object} meta Pagination meta data.
     @apiSuccess {Url} meta.first Url for first page of results
@@ -56,11 +124,13 @@ def paginate(key, max_per_page):
     @apiSuccess {int} meta.total count of all items
     """
 
+    if mode not in ('offset', 'keyset'):
+        raise ValueError('Unknown pagination mode %s' % mode)
+
     def decorator(f):
         @wraps(f)
         def wrapped(*args, **kwargs):
             query = f(*args, **kwargs)
-            page = request.args.get('page', 1, type=int)
 
             per_page = min(request.args.get('per_page', current_app.config['PAGE_SIZE'], type=int),
                            max_per_page)
@@ -68,36 +138,241 @@ def paginate(key, max_per_page):
             if not isinstance(query, BaseQuery):
                 return f(*args, **kwargs)
 
-            pagination_obj = query.paginate(page, per_page)
-            meta = {'page': pagination_obj.page, 'per_page': pagination_obj.per_page,
-                    'total': pagination_obj.total, 'pages': pagination_obj.pages}
-
-            if pagination_obj.has_prev:
-                meta['prev'] = url_for(request.endpoint, page=pagination_obj.prev_num,
-                                       per_page=per_page,
-                                       _external=True, **kwargs)
-            else:
-                meta['prev'] = None
-
-            if pagination_obj.has_next:
-                meta['next'] = url_for(request.endpoint, page=pagination_obj.next_num,
-                                       per_page=per_page,
-                                       _external=True, **kwargs)
+            if mode == 'keyset':
+                items, meta = _keyset_page(query, order_by, per_page, approximate_total, stream, kwargs)
             else:
-                meta['next'] = None
+                items, meta = _offset_page(query, per_page, approximate_total, stream, kwargs)
 
-            meta['first'] = url_for(request.endpoint, page=1,
-                                    per_page=per_page, _external=True,
-                                    **kwargs)
-            meta['last'] = url_for(request.endpoint, page=pagination_obj.pages,
-                                   per_page=per_page, _external=True,
-                                   **kwargs)
+            if stream:
+                return _stream_response(str(key), items, meta)
 
+            with phase('serialize', len(items)):
+                items = [item.to_json() for item in items]
             return jsonify({
-                str(key): [item.to_json() for item in pagination_obj.items],
-                'meta': meta
+                str(key): items,
+                'meta': meta()
             })
 
         return wrapped
 
     return decorator
+
+
+def _total(query, approximate_total):
+    return count_cache.approximate_count(query) if approximate_total else count_cache.count(query)
+
+
+def _stream_response(key, items, meta):
+    """
+    Write items in chunks of PAGINATE_STREAM_CHUNK_SIZE, meta is called once all items are written
+    """
+    ndjson = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+    chunk_size = current_app.config['PAGINATE_STREAM_CHUNK_SIZE']
+
+    def chunks():
+        chunk = []
+        for item in items:
+            chunk.append(json.dumps(item.to_json()))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def generate():
+        if ndjson:
+            for chunk in chunks():
+                yield '\n'.join(chunk) + '\n'
+            yield json.dumps({'meta': meta()}) + '\n'
+        else:
+            yield '{%s: [' % json.dumps(key)
+            for idx, chunk in enumerate(chunks()):
+                yield (', ' if idx else '') + ', '.join(chunk)
+            yield '], "meta": %s}' % json.dumps(meta())
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def _offset_page(query, per_page, approximate_total, stream, kwargs):
+    page = request.args.get('page', 1, type=int)
+    if page < 1 or per_page < 1:
+        return abort(404)
+
+    page_query = query.limit(per_page).offset((page - 1) * per_page)
+    if stream:
+        total = _total(query, approximate_total)
+        if page != 1 and (page - 1) * per_page >= total:
+            return abort(404)
+
+        items = page_query.yield_per(current_app.config['PAGINATE_STREAM_CHUNK_SIZE'])
+    else:
+        items = page_query.all()
+        if not items and page != 1:
+            return abort(404)
+
+        # first page holding every item needs no count query
+        total = len(items) if page == 1 and len(items) < per_page else _total(query, approximate_total)
+
+    pagination_obj = Pagination(query, page, per_page, total, items)
+    meta = {'page': pagination_obj.page, 'per_page': pagination_obj.per_page,
+            'total': pagination_obj.total, 'pages': pagination_obj.pages}
+
+    if pagination_obj.has_prev:
+        meta['prev'] = url_for(request.endpoint, page=pagination_obj.prev_num,
+                               per_page=per_page,
+                               _external=True, **kwargs)
+    else:
+        meta['prev'] = None
+
+    if pagination_obj.has_next:
+        meta['next'] = url_for(request.endpoint, page=pagination_obj.next_num,
+                               per_page=per_page,
+                               _external=True, **kwargs)
+    else:
+        meta['next'] = None
+
+    meta['first'] = url_for(request.endpoint, page=1,
+                            per_page=per_page, _external=True,
+                            **kwargs)
+    meta['last'] = url_for(request.endpoint, page=pagination_obj.pages,
+                           per_page=per_page, _external=True,
+                           **kwargs)
+
+    return items, lambda: meta
+
+
+def _cursor_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='paginate-cursor')
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'n': str(value)}
+    return value
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.strptime(value['dt'], '%Y-%m-%dT%H:%M:%S.%f' if '.' in value['dt'] else '%Y-%m-%dT%H:%M:%S')
+        if 'd' in value:
+            return datetime.strptime(value['d'], '%Y-%m-%d').date()
+        if 'n' in value:
+            return Decimal(value['n'])
+    return value
+
+
+def _keyset_columns(query, order_by):
+    """
+    :return: list of (column, descending) with primary key columns appended
+    """
+    if order_by is None:
+        order_by = ()
+    elif not isinstance(order_by, (list, tuple)):
+        order_by = (order_by,)
+
+    columns = []
+    for clause in order_by:
+        if isinstance(clause, UnaryExpression) and clause.modifier in (operators.desc_op, operators.asc_op):
+            columns.append((clause.element, clause.modifier is operators.desc_op))
+        else:
+            columns.append((clause, False))
+
+    model = query.column_descriptions[0]['entity']
+    keys = set(column.key for column, _ in columns)
+    columns.extend((column, False) for column in inspect(model).primary_key if column.key not in keys)
+    return columns
+
+
+def _keyset_filter(columns, values, forward):
+    """
+    Build (a > :a) OR (a = :a AND b > :b) ... for rows after (forward) or before values
+    """
+    (column, descending), value = columns[0], values[0]
+    after = (column < value) if descending == forward else (column > value)
+
+    if len(columns) == 1:
+        return after
+    return or_(after, and_(column == value, _keyset_filter(columns[1:], values[1:], forward)))
+
+
+def _keyset_page(query, order_by, per_page, approximate_total, stream, kwargs):
+    """
+    Order columns should not be nullable, rows with NULL values are skipped by cursors
+
+    @apiDefine KeysetPaginate
+    @apiParam {String} [cursor] Opaque cursor taken from meta.next or meta.prev urls
+    @apiParam {Boolean} [total] Set to 1 to get meta.total
+    @apiSuccess {Object} meta Pagination meta data.
+    @apiSuccess {Url} meta.first Url for first page of results
+    @apiSuccess {Url} meta.next Url for next page of results
+    @apiSuccess {Url} meta.prev Url for previous page of results
+    @apiSuccess {int} meta.per_page item per each page
+    @apiSuccess {int} meta.total count of all items, null unless asked for
+    """
+    columns = _keyset_columns(query, order_by)
+    base_query = query
+    forward = True
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            direction, values = _cursor_serializer().loads(cursor)
+        except (BadSignature, ValueError, TypeError):
+            return abort(400)
+
+        if len(values) != len(columns):
+            return abort(400)
+
+        forward = direction == 'n'
+        query = query.filter(_keyset_filter(columns, [_decode_cursor_value(value) for value in values], forward))
+
+    ordering = [column.desc() if descending == forward else column.asc() for column, descending in columns]
+    page_query = query.order_by(None).order_by(*ordering).limit(per_page + 1)
+
+    seen = {'count': 0, 'first': None, 'last': None, 'more': False}
+    if stream and forward:
+        items = _take(page_query.yield_per(current_app.config['PAGINATE_STREAM_CHUNK_SIZE']), per_page, seen)
+    else:
+        # previous pages are read in reverse order so they are buffered before being turned around
+        items = list(_take(page_query.all(), per_page, seen))
+        if not forward:
+            items.reverse()
+
+    def cursor_url(direction, item):
+        values = [_encode_cursor_value(getattr(item, column.key)) for column, _ in columns]
+        return url_for(request.endpoint, cursor=_cursor_serializer().dumps([direction, values]),
+                       per_page=per_page, _external=True, **kwargs)
+
+    def meta():
+        first, last = (seen['first'], seen['last']) if forward else (seen['last'], seen['first'])
+        has_next = seen['more'] if forward else bool(cursor)
+        has_prev = seen['more'] if not forward else bool(cursor)
+
+        return {'per_page': per_page,
+                'total': _total(base_query, approximate_total) if request.args.get('total', 0, type=int) else None,
+                'next': cursor_url('n', last) if has_next and seen['count'] else None,
+                'prev': cursor_url('p', first) if has_prev and seen['count'] else None,
+                'first': url_for(request.endpoint, per_page=per_page, _external=True, **kwargs)}
+
+    return items, meta
+
+
+def _take(rows, per_page, seen):
+    """
+    Yield up to per_page rows, recording first and last yielded row and whether any row was left
+    """
+    for row in rows:
+        if seen['count'] == per_page:
+            seen['more'] = True
+            break
+
+        if seen['count'] == 0:
+            seen['first'] = row
+        seen['last'] = row
+        seen['count'] += 1
+        yield row
@@ -1,24 +1,48 @@
+# python imports
+from contextlib import contextmanager
+
 # flask imports
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.cache import Cache
-from flask.ext.jsonschema import JsonSchema
-from flask.ext.redis import FlaskRedis
 from flask.ext.cors import CORS
-from flask.ext.admin import Admin
-from flask.ext.elasticsearch import FlaskElasticsearch
 from flask.ext.log import Logging
-from flask.ext.migrate import Migrate
 
 # project imports
 # from application.modules.bug_report import BugReport
+from application.modules.token_cache import TokenCache
+from application.modules.compress import Compress
+from application.modules.schema_validator import JsonSchema
+from application.modules.redis_pool import PooledRedis
+from application.modules.sms import SMS
+from application.modules.lazy import LazyExtension
+from application.modules.timing import Timing
+from application.modules.profiler import Profiler
+from application.modules.query_counter import QueryCounter
 
 db = SQLAlchemy()
 cache = Cache()
 json = JsonSchema()
-redis = FlaskRedis()
+redis = PooledRedis()
 # bug_report = BugReport()
 cors = CORS()
-admin = Admin(template_mode='bootstrap3', url='/admin')
-es = FlaskElasticsearch()
+admin = LazyExtension('flask.ext.admin.Admin', template_mode='bootstrap3', url='/admin')
+es = LazyExtension('application.modules.search.FlaskElasticsearch')
 log = Logging()
-migrate = Migrate()
+migrate = LazyExtension('flask.ext.migrate.Migrate')
+token_cache = TokenCache()
+compress = Compress()
+sms = SMS()
+timing = Timing()
+profiler = Profiler()
+query_counter = QueryCounter()
+
+
+@contextmanager
+def redis_pipeline(transaction=False):
+    """
+    Queue Redis commands of the block and send them in one round trip when it ends,
+    nothing is sent if block raises
+    """
+    pipe = redis.pipeline(transaction=transaction)
+    yield pipe
+    pipe.execute()
@@ -1,4 +1,5 @@
 from user import (Authenticate,
+                  BulkAuthenticate,
                   Activate,
                   Refresh,
                   EditInfo,
@@ -11,6 +12,7 @@ from fantasy_league import JoinFantasyLeague
 from fantasy_team import SetPosition, BuyFantasyPlayer, SetCaptain, SellFantasyPlayer
 
 __all__ = ['Authenticate',
+           'BulkAuthenticate',
            'Activate',
            'Refresh',
            'EditInfo',
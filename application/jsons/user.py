@@ -1,11 +1,17 @@
 # python imports
-from jsl import Document, StringField
+from jsl import Document, StringField, ArrayField, BooleanField
 
 
 class Authenticate(Document):
     phone = StringField(required=True, pattern='^09[0-9]{9}$')
 
 
+class BulkAuthenticate(Document):
+    # phones are checked one by one so an invalid one does not fail the whole batch
+    phones = ArrayField(StringField(), required=True, min_items=1, max_items=10000)
+    send_codes = BooleanField()
+
+
 class WebAuthenticate(Document):
     phone = StringField(required=True, pattern='^09[0-9]{9}$')
     password = StringField(required=True, pattern='.{6,}')
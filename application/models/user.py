@@ -1,15 +1,26 @@
 # python imports
+import re
 from datetime import datetime
+from time import time
 from uuid import uuid4
 from random import randint
 from functools import wraps
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy_utils import PasswordType
+from itsdangerous import URLSafeSerializer, BadSignature
 
 # flask imports
 from flask import current_app, request, abort, g
+from werkzeug.local import LocalProxy
 
 # project imports
-from application.extensions import db, redis, sms
+from application.extensions import db, redis, redis_pipeline, sms, token_cache
+from application.modules import count_cache, response_cache
+from application.modules.local_cache import MISSING
+from application.modules.timing import phase
+
+
+PHONE_PATTERN = re.compile('^09[0-9]{9}$')
 
 
 class User(db.Model):
@@ -21,6 +32,8 @@ class User(db.Model):
     phone = db.Column(db.String(11), nullable=False, unique=True)
     national_code = db.Column(db.String(10), nullable=True, unique=True)
     password = db.Column(PasswordType(schemes=['pbkdf2_sha512', 'md5_crypt'], deprecated=['md5_crypt']), nullable=True)
+    # loaded with the row so serializing a user never fetches deferred password
+    password_set = db.column_property(password.isnot(None))
     active = db.Column(db.Boolean, default=True, nullable=False)
     registered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
     coupon_count = db.Column(db.Integer, nullable=False, default=0)
@@ -31,7 +44,10 @@ class User(db.Model):
     fantasy_teams = db.relationship('FantasyTeam', backref='user', lazy='dynamic', cascade='all,delete')
 
     def has_password(self):
-        return self.password is not None
+        # password itself when it is loaded (or just changed), deferred otherwise
+        if 'password' not in db.inspect(self).unloaded:
+            return self.password is not None
+        return bool(self.password_set)
 
     @classmethod
     def authenticate(cls, populate=True):
@@ -39,6 +55,7 @@ class User(db.Model):
         If user authenticated correctly then g.user value will be filled with user sql alchemy
         other wise it will abort request with 401 unauthorised http response code
         :param populate: if False user is user_id and if True user is user_obj from database. use populate=False for perfomance
+        user_obj is loaded lazily on first attribute access and g.user_id is always available without a query
 
 
         @apiDefine AccessTokenHeader
@@ -57,11 +74,14 @@ class User(db.Model):
                     access_token_id = request.headers.get('Access-Token')
                     assert access_token_id
 
-                    user_id = redis.get('uat:%s' % access_token_id)
+                    with phase('auth'):
+                        user_id = token_cache.get(access_token_id)
+                        if user_id is MISSING:
+                            user_id = cls.access_token_user_id(access_token_id)
                     assert user_id
 
-                    g.user = cls.query.get(user_id) if populate else user_id
-                    assert g.user
+                    g.user_id = int(user_id)
+                    g.user = LocalProxy(cls._lazy_loader(g.user_id)) if populate else user_id
 
                     return f(*args, **kwargs)
                 except AssertionError:
@@ -71,11 +91,211 @@ class User(db.Model):
 
         return decorator
 
+    @classmethod
+    def load(cls, user_id):
+        """
+        Load user leaving USER_DEFERRED_COLUMNS to be fetched on first access
+        :rtype User
+        """
+        options = [db.defer(column) for column in current_app.config['USER_DEFERRED_COLUMNS']]
+        return cls.query.options(*options).get(user_id)
+
+    @classmethod
+    def _lazy_loader(cls, user_id):
+        loaded = []
+
+        def loader():
+            if not loaded:
+                user_obj = cls.load(user_id)
+                if user_obj is None:
+                    abort(401)
+                loaded.append(user_obj)
+            return loaded[0]
+
+        return loader
+
+    @classmethod
+    def cached_json(cls, user_id, user_obj=None):
+        """
+        Serialized user from worker cache, falls back to database
+        Worker cache is skipped while a cached response is built, the invalidation of a row may not have reached
+        this worker yet when the response cache already has the new version of its tag
+        :param user_obj: already known user object (or g.user proxy) to use on cache miss
+        :rtype dict
+        """
+        json = MISSING if g.get('building_cached_response') else token_cache.get_user(user_id)
+        if json is MISSING:
+            generation = token_cache.user_generation
+            if user_obj is None:
+                user_obj = cls.load(user_id)
+            json = user_obj.to_json() if user_obj is not None else None
+            if json is not None:
+                token_cache.set_user(user_id, json, generation)
+        return json
+
+    @classmethod
+    def access_token_user_id(cls, access_token_id):
+        """
+        Resolve access token to user id and remember the answer in worker token cache
+        :rtype str
+        """
+        # a revocation applied while Redis is read must not be undone by caching what was read before it
+        generation = token_cache.generation
+        if current_app.config['ACCESS_TOKEN_SIGNED']:
+            user_id, ttl = cls._verify_signed_access_token(access_token_id)
+        else:
+            key = 'uat:%s' % access_token_id
+            user_id, ttl = redis.pipeline(transaction=False).get(key).ttl(key).execute()
+
+        token_cache.set(access_token_id, user_id, ttl, generation)
+        return user_id
+
+    @staticmethod
+    def _access_token_serializer():
+        return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='access-token')
+
+    @classmethod
+    def _verify_signed_access_token(cls, access_token_id):
+        """
+        Signed tokens carry [user_id, token_id, epoch, expires_at]. Only revocation state is read from Redis:
+        'uae:<user_id>' epoch is increased by revoke_all and 'uar:<user_id>' holds revoked token ids.
+        :return: (user_id, ttl) or (None, None) if token is not valid
+        """
+        try:
+            user_id, token_id, epoch, expires_at = cls._access_token_serializer().loads(access_token_id)
+        except (BadSignature, ValueError, TypeError):
+            return None, None
+
+        ttl = int(expires_at - time())
+        if ttl <= 0:
+            return None, None
+
+        current_epoch, revoked = redis.pipeline(transaction=False) \
+            .get('uae:%d' % user_id).sismember('uar:%d' % user_id, token_id).execute()
+        if revoked or epoch < int(current_epoch or 0):
+            return None, None
+
+        return str(user_id), ttl
+
+    @classmethod
+    def revoke_access_token(cls, access_token_id, pipe=None):
+        """
+        Revoke a single access token (Token.revoke takes care of Redis stored tokens)
+        :param pipe: redis pipeline to queue commands in, it is executed by caller
+        """
+        if pipe is None:
+            with redis_pipeline() as pipe:
+                return cls.revoke_access_token(access_token_id, pipe)
+
+        if current_app.config['ACCESS_TOKEN_SIGNED']:
+            try:
+                user_id, token_id, _, _ = cls._access_token_serializer().loads(access_token_id)
+            except (BadSignature, ValueError, TypeError):
+                return
+
+            key = 'uar:%d' % user_id
+            pipe.sadd(key, token_id).expire(key, current_app.config['ACCESS_TOKEN_TIMEOUT'])
+
+        token_cache.invalidate(access_token_id, pipe)
+
+    def revoke_all_access_tokens(self):
+        """
+        Revoke all access tokens of user (Token.revoke_all takes care of Redis stored tokens)
+        """
+        if current_app.config['ACCESS_TOKEN_SIGNED']:
+            redis.incr('uae:%d' % self.id)
+
+        token_cache.invalidate_user(self.id)
+
     def send_activation_code(self):
+        with redis_pipeline() as pipe:
+            self.queue_activation_code(self.id, self.phone, pipe)
+
+    @staticmethod
+    def queue_activation_code(user_id, phone, pipe):
+        """
+        :param pipe: redis pipeline to store code (and queue its sms) in, it is executed by caller
+        """
         code = str(randint(0, 99999)).zfill(5)
-        redis.setex('uac:%d' % self.id, current_app.config['ACTIVATION_CODE_TIMEOUT'], code)
-        current_app.logger.debug(sms.send_one('%s\nCode: %s' % (current_app.config['SITE_NAME'], code), self.phone)
-                                 if sms.on else 'Code: %s' % code)
+        pipe.setex('uac:%d' % user_id, current_app.config['ACTIVATION_CODE_TIMEOUT'], code)
+        if sms.on:
+            # sent by sms worker, request does not wait for provider
+            sms.enqueue('%s\nCode: %s' % (current_app.config['SITE_NAME'], code), phone, pipe=pipe)
+        else:
+            current_app.logger.debug('Code: %s' % code)
+
+    @classmethod
+    def bulk_authenticate(cls, phones, send_codes=True):
+        """
+        Register missing phones and send activation codes to all of them, BULK_CHUNK_SIZE phones at a time: one
+        IN query finds existing users, missing ones are inserted in one statement and codes are queued in one
+        Redis round trip
+        :return: list of (phone, status) in order of phones, status is created, existing, invalid or duplicate
+        """
+        statuses = {}
+        valid = []
+        for phone in phones:
+            if phone in statuses:
+                continue
+            if isinstance(phone, basestring) and PHONE_PATTERN.match(phone):
+                statuses[phone] = None
+                valid.append(phone)
+            else:
+                statuses[phone] = 'invalid'
+
+        chunk_size = current_app.config['BULK_CHUNK_SIZE']
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            user_ids = cls._bulk_register(chunk, statuses)
+
+            if send_codes:
+                with redis_pipeline() as pipe:
+                    for phone in chunk:
+                        cls.queue_activation_code(user_ids[phone], phone, pipe)
+
+        seen = set()
+        results = []
+        for phone in phones:
+            results.append((phone, statuses[phone] if phone not in seen else 'duplicate'))
+            seen.add(phone)
+        return results
+
+    @classmethod
+    def _bulk_register(cls, phones, statuses):
+        """
+        :return: dict of phone to user id
+        """
+        def existing():
+            return dict((phone, user_id) for user_id, phone in
+                        db.session.query(cls.id, cls.phone).filter(cls.phone.in_(phones)))
+
+        user_ids = existing()
+        created = set()
+        for _ in range(3):
+            missing = [phone for phone in phones if phone not in user_ids]
+            if not missing:
+                break
+
+            now = datetime.utcnow()
+            try:
+                db.session.bulk_insert_mappings(cls, [{'phone': phone, 'registered_at': now} for phone in missing])
+                count_cache.mark_changed(db.session, cls.__tablename__)
+                db.session.commit()
+            except IntegrityError:
+                # some were registered by another request meanwhile, the rest is inserted again
+                db.session.rollback()
+                user_ids = existing()
+                continue
+
+            created.update(missing)
+            user_ids = existing()
+            break
+        else:
+            raise RuntimeError('Could not register %d phones' % len(missing))
+
+        for phone in phones:
+            statuses[phone] = 'created' if phone in created else 'existing'
+        return user_ids
 
     def consume_activation_code(self, code):
         """
@@ -83,17 +303,21 @@ class User(db.Model):
         """
 
         key = 'uac:%d' % self.id
-        if redis.exists(key):
-            r_code = redis.get(key)
-            redis.delete(key)
+        # GET and DEL in one MULTI so a code is only ever consumed by one request
+        r_code, _ = redis.pipeline(transaction=True).get(key).delete(key).execute()
+        return r_code is not None and r_code == code
 
-            if r_code == code:
-                return True
-        return False
+    def generate_access_token(self, pipe=None):
+        """
+        :param pipe: redis pipeline to store token in, it is executed by caller
+        """
+        if current_app.config['ACCESS_TOKEN_SIGNED']:
+            epoch = int(redis.get('uae:%d' % self.id) or 0)
+            expires_at = int(time()) + current_app.config['ACCESS_TOKEN_TIMEOUT']
+            return self._access_token_serializer().dumps([self.id, uuid4().hex[:16], epoch, expires_at])
 
-    def generate_access_token(self):
         code = str(uuid4())
-        redis.setex('uat:%s' % code, current_app.config['ACCESS_TOKEN_TIMEOUT'], str(self.id))
+        (pipe or redis).setex('uat:%s' % code, current_app.config['ACCESS_TOKEN_TIMEOUT'], str(self.id))
         return code
 
     def populate(self, json):
@@ -101,7 +325,6 @@ class User(db.Model):
         Populate model from json dictionary
         :type json dict
         """
-
         if 'user_name' in json:
             self.user_name = json['user_name'] if len(json['user_name']) > 0 else None
         if 'real_name' in json:
@@ -112,39 +335,43 @@ class User(db.Model):
             self.national_code = json['national_code'] if len(json['national_code']) > 0 else None
 
     @classmethod
-    def generate_fake(cls):
+    def generate_fake(cls, seed=None):
         """
+        Insert one fake user with an access token (database fake command inserts many at once)
         :rtype User
         """
-        from faker import Factory
-        from mixer.backend.flask import mixer
-
-        mixer.faker.locale = 'fa'
-        faker = Factory.create('fa_IR')
-
-        fake = mixer.blend(cls)
-        fake.real_name = faker.name()
-
-        faker = Factory.create()
-        while True:
-            try:
-                fake_username = faker.domain_word()
-                fake.user_name = fake_username
-
-                db.session.add(fake)
-                db.session.commit()
-                break
-            except:
-                db.session.rollback()
+        from application.modules.fake_data import seed_users
 
-        return fake
+        inserted, = seed_users(1, seed if seed is not None else uuid4().hex)
+        (user_id, _, _), = inserted
+        return cls.query.get(user_id)
 
     def to_json(self):
         return {'user_name': self.user_name,
                 'real_name': self.real_name,
                 'phone': self.phone,
-                'registered_at': str(self.registered_at),
+                'registered_at': self.registered_at,
                 'coupon_count': self.coupon_count,
                 'national_code': self.national_code,
                 'has_password': self.has_password()
                 }
+
+
+def collect_changed_users(session, flush_context):
+    """
+    Remember users changed in a flush so their cached rows can be dropped after commit
+    """
+    changed = session.info.setdefault('changed_user_ids', set())
+    changed.update(obj.id for obj in session.dirty.union(session.deleted) if isinstance(obj, User))
+
+
+def invalidate_changed_users(session):
+    user_ids = session.info.pop('changed_user_ids', ())
+    for user_id in user_ids:
+        token_cache.invalidate_user_row(user_id)
+    if user_ids and current_app.config['RESPONSE_CACHE_ENABLED']:
+        response_cache.invalidate(['user:%d' % user_id for user_id in user_ids])
+
+
+def forget_changed_users(session):
+    session.info.pop('changed_user_ids', None)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+    App wide response compression as a WSGI middleware.
+
+    Picks brotli (if 0.6 or newer is installed) or gzip from Accept-Encoding, compresses body chunk by chunk so
+    streamed responses stay streamed, and keeps compressed bodies of responses with a strong ETag
+    in a per worker cache so the same body is not compressed twice.
+"""
+
+# python imports
+import zlib
+from time import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# streaming compressor was added in Brotli 0.6, gzip is used with older releases
+if brotli is not None and not hasattr(brotli, 'Compressor'):
+    brotli = None
+
+# project imports
+from application.modules.local_cache import LocalCache, MISSING
+
+
+def parse_accept_encoding(value):
+    """
+    :return: set of encodings client accepts (q=0 ones are left out)
+    """
+    encodings = set()
+    for item in value.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if name and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.add(name)
+    return encodings
+
+
+class GzipCompressor(object):
+    encoding = 'gzip'
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor(object):
+    encoding = 'br'
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class CompressMiddleware(object):
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.gzip_level = config['COMPRESS_LEVEL']
+        self.brotli_level = config['COMPRESS_BROTLI_LEVEL']
+        self.min_size = config['COMPRESS_MIN_SIZE']
+        self.mimetypes = set(config['COMPRESS_MIMETYPES'])
+        self.skip_paths = tuple(config['COMPRESS_SKIP_PATHS'])
+        self.cache = LocalCache(config['COMPRESS_CACHE_SIZE'], config['COMPRESS_CACHE_TIMEOUT'])
+        self.cache_max_size = config['COMPRESS_CACHE_MAX_BODY']
+
+    def compressor(self, environ):
+        if environ.get('REQUEST_METHOD') == 'HEAD' or environ.get('PATH_INFO', '').startswith(self.skip_paths):
+            return None
+
+        accepted = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in accepted:
+            return BrotliCompressor(self.brotli_level)
+        if 'gzip' in accepted:
+            return GzipCompressor(self.gzip_level)
+        return None
+
+    def should_compress(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code >= 300 or code == 204:
+            return False
+
+        if 'content-encoding' in headers:
+            return False
+
+        mimetype = headers.get('content-type', '').split(';', 1)[0].strip()
+        if mimetype not in self.mimetypes:
+            return False
+
+        length = headers.get('content-length')
+        return length is None or int(length) >= self.min_size
+
+    def cache_key(self, environ, headers, encoding):
+        """
+        Only bodies identified by a strong ETag, which are allowed to be stored, are cached
+        """
+        etag = headers.get('etag')
+        cache_control = headers.get('cache-control', '').lower()
+        length = headers.get('content-length')
+
+        if not etag or etag.startswith('W/') or length is None or int(length) > self.cache_max_size:
+            return None
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return None
+        # ETags are only unique per resource
+        return '%s:%s?%s:%s' % (encoding, environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''), etag)
+
+    def __call__(self, environ, start_response):
+        compressor = self.compressor(environ)
+        if compressor is None:
+            return self.wsgi_app(environ, start_response)
+
+        captured = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            # body is written through the returned iterable so write() is not supported
+            return None
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        status, headers, exc_info = captured
+        lowered = dict((name.lower(), value) for name, value in headers)
+
+        if not self.should_compress(status, lowered):
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        key = self.cache_key(environ, lowered, compressor.encoding)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'vary', 'etag')]
+        headers.append(('Content-Encoding', compressor.encoding))
+        headers.append(('Vary', ', '.join(filter(None, [lowered.get('vary'), 'Accept-Encoding']))))
+        if 'etag' in lowered:
+            # compressed representation is not byte for byte equal to the original one
+            etag = lowered['etag']
+            headers.append(('ETag', etag if etag.startswith('W/') else 'W/' + etag))
+
+        recorder = environ.get('timing.recorder')
+        if key is None and 'content-length' not in lowered:
+            start_response(status, headers, exc_info)
+            return self.stream(app_iter, compressor, recorder=recorder)
+
+        body = self.cache.get(key) if key is not None else MISSING
+        if body is MISSING:
+            started = time()
+            body = ''.join(self.stream(app_iter, compressor, flush=False))
+            if key is not None:
+                self.cache.set(key, body)
+            if recorder is not None:
+                spent = time() - started
+                recorder.add_after_response('compress', spent)
+                headers = [(name, value + ', compress;dur=%.2f' % (spent * 1000))
+                           if name.lower() == 'server-timing' else (name, value) for name, value in headers]
+        else:
+            self.close(app_iter)
+
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, exc_info)
+        return [body]
+
+    def stream(self, app_iter, compressor, flush=True, recorder=None):
+        """
+        Compress chunk by chunk, flushing after each one so clients receive streamed data without delay
+        :param recorder: timing recorder of request which compression time is added to
+        """
+        spent = 0.0
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+
+                started = time()
+                data = compressor.compress(chunk)
+                if flush:
+                    data += compressor.flush()
+                spent += time() - started
+                if data:
+                    yield data
+
+            started = time()
+            data = compressor.finish()
+            spent += time() - started
+            yield data
+        finally:
+            self.close(app_iter)
+            if recorder is not None:
+                recorder.add_after_response('compress', spent)
+
+    @staticmethod
+    def close(app_iter):
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class Compress(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['COMPRESS_ENABLED']:
+            app.wsgi_app = CompressMiddleware(app.wsgi_app, app.config)
+
+        app.extensions['compress'] = self
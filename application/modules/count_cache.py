@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Cached and estimated row counts for paginated queries.
+
+    Counts are stored in the configured Flask-Cache backend under a key made of the compiled SQL, its
+    parameters and a version for each table the query reads. Committing changes to a table gives it a new
+    version so every cached count over that table is skipped from then on.
+"""
+
+# python imports
+from hashlib import sha1
+from uuid import uuid4
+from sqlalchemy.sql.util import find_tables
+
+# flask imports
+from flask import current_app
+
+# project imports
+from application.extensions import cache
+
+
+def _table_names(statement):
+    return sorted(set(table.name for table in find_tables(statement, include_joins=True)
+                      if hasattr(table, 'name')))
+
+
+def _table_versions(tables):
+    keys = ['count-version:%s' % table for table in tables]
+    versions = list(cache.get_many(*keys)) if keys else []
+
+    for idx, version in enumerate(versions):
+        if version is None:
+            # a lost version must never bring old counts back to life
+            versions[idx] = uuid4().hex
+            cache.set(keys[idx], versions[idx], timeout=0)
+
+    return versions
+
+
+def _compile(query):
+    statement = query.order_by(None).statement
+    return statement, statement.compile(dialect=query.session.get_bind().dialect)
+
+
+def count(query):
+    """
+    Exact count of query rows, served from cache when it is not changed since last count
+    :rtype int
+    """
+    statement, compiled = _compile(query)
+
+    digest = sha1(str(compiled))
+    digest.update(repr(sorted(compiled.params.items())))
+    for version in _table_versions(_table_names(statement)):
+        digest.update(version)
+    key = 'count:%s' % digest.hexdigest()
+
+    total = cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        cache.set(key, total, timeout=current_app.config['COUNT_CACHE_TIMEOUT'])
+    return total
+
+
+def estimate(query):
+    """
+    Planner estimate of query rows, only PostgreSQL is supported
+    :return: estimated count or None when database can not estimate
+    """
+    statement, compiled = _compile(query)
+    if compiled.dialect.name != 'postgresql':
+        return None
+
+    plan = query.session.connection().execute('EXPLAIN (FORMAT JSON) %s' % compiled, compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def approximate_count(query):
+    """
+    Use planner estimate for big results (COUNT_ESTIMATE_THRESHOLD rows or more) and exact cached count otherwise
+    :rtype int
+    """
+    estimated = estimate(query)
+    if estimated is not None and estimated >= current_app.config['COUNT_ESTIMATE_THRESHOLD']:
+        return estimated
+    return count(query)
+
+
+def collect_changed_tables(session, flush_context):
+    """
+    Remember tables changed in a flush so their counts can be dropped after commit
+    """
+    changed = session.info.setdefault('changed_tables', set())
+    for obj in session.new.union(session.dirty).union(session.deleted):
+        table = getattr(obj, '__table__', None)
+        if table is not None:
+            changed.add(table.name)
+
+
+def mark_changed(session, table):
+    """
+    Remember a table changed by statements which bypass the unit of work (bulk inserts and updates)
+    """
+    session.info.setdefault('changed_tables', set()).add(table)
+
+
+def invalidate_changed_tables(session):
+    for table in session.info.pop('changed_tables', ()):
+        cache.set('count-version:%s' % table, uuid4().hex, timeout=0)
+
+
+def forget_changed_tables(session):
+    session.info.pop('changed_tables', None)
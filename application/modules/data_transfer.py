@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Streaming export and import of table rows as NDJSON or CSV (used by ./manager.py database export/import).
+
+    Rows are exported as plain column tuples read with yield_per (a server side cursor on PostgreSQL), so memory
+    does not grow with the table. Import reads batch_size rows at a time and commits each batch with one
+    bulk_insert_mappings (COPY on PostgreSQL for CSV) call. After every committed batch the number of imported rows
+    is written to a checkpoint file next to the input, so an interrupted import resumes after the last
+    committed batch. CSV files have a header row and write NULL as \\N like COPY does.
+    Password hashes are moved as they are, they are never hashed again.
+"""
+
+# python imports
+import csv
+import json
+import os
+import sys
+from binascii import hexlify
+from datetime import datetime
+from time import time
+from sqlalchemy import Boolean, DateTime, Integer, TypeDecorator
+from sqlalchemy.types import _Binary
+from sqlalchemy_utils import PasswordType
+from sqlalchemy_utils.types.password import Password
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# project imports
+from application.extensions import db
+from application.modules import count_cache
+
+FORMATS = ('ndjson', 'csv')
+NULL = '\\N'
+
+
+def _dump(value):
+    """
+    Column value to a JSON (and CSV) friendly one
+    """
+    if value is None:
+        return None
+    if isinstance(value, Password):
+        return value.hash.decode('utf-8')
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _load(column, value, text):
+    """
+    Exported value back to column value
+    :param text: value was read from CSV so every value is a string
+    """
+    if value is None or (text and value == NULL):
+        return None
+
+    column_type = column.type
+    if isinstance(column_type, PasswordType):
+        # a string would be taken as a new password and hashed
+        return Password(value)
+    if isinstance(column_type, DateTime):
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if text and isinstance(column_type, Boolean):
+        return value.lower() in ('true', '1', 't')
+    if text and isinstance(column_type, Integer):
+        return int(value)
+    return value
+
+
+class Progress(object):
+    """
+    One updating line of done rows, rate and percent (when total is known) on stderr
+    """
+
+    def __init__(self, label, total=None, stream=sys.stderr):
+        self.label = label
+        self.total = total
+        self.stream = stream
+        self.started = time()
+
+    def update(self, done, rows, finished=False):
+        elapsed = max(time() - self.started, 1e-6)
+        percent = ' {:5.1f}%'.format(100.0 * done / self.total) if self.total else ''
+        self.stream.write('\r{}: {:d} rows{} {:.0f} rows/s'.format(self.label, rows, percent, rows / elapsed))
+        if finished:
+            self.stream.write('\n')
+        self.stream.flush()
+
+
+def export_rows(model, output, fmt='ndjson', batch_size=1000, progress=None):
+    """
+    Write every row of model table ordered by primary key
+    :return: number of rows written
+    """
+    columns = list(model.__table__.columns)
+    query = db.session.query(*columns).order_by(*model.__table__.primary_key.columns).yield_per(batch_size)
+    if progress is not None:
+        progress.total = db.session.query(db.func.count()).select_from(model.__table__).scalar()
+
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow([column.name for column in columns])
+
+    rows = 0
+    for row in query:
+        values = [_dump(value) for value in row]
+        if writer is not None:
+            writer.writerow([NULL if value is None else _csv_value(value) for value in values])
+        else:
+            output.write(json.dumps(dict(zip((column.name for column in columns), values))) + '\n')
+
+        rows += 1
+        if progress is not None and rows % batch_size == 0:
+            progress.update(rows, rows)
+
+    if progress is not None:
+        progress.update(rows, rows, finished=True)
+    return rows
+
+
+def _csv_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _read_rows(model, path, fmt, consumed):
+    """
+    Yield mappings of column values read from path
+    :param consumed: list whose only item is kept equal to bytes read so far
+    """
+    columns = model.__table__.columns
+
+    def lines(f):
+        for line in iter(f.readline, ''):
+            consumed[0] += len(line)
+            yield line
+
+    with open(path) as f:
+        if fmt == 'csv':
+            reader = csv.reader(lines(f))
+            names = next(reader)
+            for values in reader:
+                yield dict((name, _load(columns[name], value.decode('utf-8'), True))
+                           for name, value in zip(names, values))
+        else:
+            for line in lines(f):
+                if line.strip():
+                    yield dict((name, _load(columns[name], value, False)) for name, value in json.loads(line).items())
+
+
+def checkpoint_path(path):
+    return path + '.checkpoint'
+
+
+def _write_checkpoint(path, rows):
+    temporary = '%s.%d' % (checkpoint_path(path), os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(str(rows))
+    # a half written checkpoint would resume from a wrong row
+    os.rename(temporary, checkpoint_path(path))
+
+
+def _is_binary(column_type, dialect):
+    if isinstance(column_type, TypeDecorator):
+        column_type = column_type.load_dialect_impl(dialect)
+    return isinstance(column_type, _Binary)
+
+
+def copy_csv(model, mappings, dialect):
+    """
+    Batch as CSV for COPY FROM STDIN, values are converted by column types the way inserts convert them
+    :rtype StringIO
+    """
+    columns = list(model.__table__.columns)
+    binary = [_is_binary(column.type, dialect) for column in columns]
+    binds = [column.type.bind_processor(dialect) for column in columns]
+    buffer_ = StringIO()
+    writer = csv.writer(buffer_)
+    for mapping in mappings:
+        row = []
+        for column, is_binary, bind in zip(columns, binary, binds):
+            value = mapping.get(column.name)
+            if value is None:
+                row.append(NULL)
+            elif is_binary:
+                # bind processor wraps bytes for the driver, COPY reads bytea as \x and hex digits
+                if isinstance(column.type, TypeDecorator):
+                    value = column.type.process_bind_param(value, dialect)
+                row.append('\\x' + hexlify(value))
+            else:
+                if bind is not None:
+                    value = bind(value)
+                row.append(_csv_value(_dump(value)))
+        writer.writerow(row)
+    buffer_.seek(0)
+    return buffer_
+
+
+def _copy(model, mappings):
+    """
+    Insert batch with PostgreSQL COPY, the fastest way in
+    """
+    columns = list(model.__table__.columns)
+    buffer_ = copy_csv(model, mappings, db.engine.dialect)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV NULL '%s'" % (
+        model.__tablename__, ', '.join(column.name for column in columns), NULL), buffer_)
+
+
+def import_rows(model, path, fmt='ndjson', batch_size=1000, resume=False, progress=None):
+    """
+    Insert rows of file at path in batches, committing each one
+    :param resume: skip rows committed by an earlier run (read from checkpoint file)
+    :return: number of rows inserted by this run
+    """
+    skip = 0
+    if resume and os.path.exists(checkpoint_path(path)):
+        with open(checkpoint_path(path)) as f:
+            skip = int(f.read().strip() or 0)
+
+    if progress is not None:
+        progress.total = os.path.getsize(path)
+
+    use_copy = fmt == 'csv' and db.engine.dialect.name == 'postgresql'
+    consumed = [0]
+    done = skip
+    batch = []
+
+    def flush():
+        if use_copy:
+            _copy(model, batch)
+        else:
+            db.session.bulk_insert_mappings(model, batch)
+        count_cache.mark_changed(db.session, model.__tablename__)
+        db.session.commit()
+        _write_checkpoint(path, done)
+        if progress is not None:
+            progress.update(consumed[0], done - skip)
+        del batch[:]
+
+    for idx, mapping in enumerate(_read_rows(model, path, fmt, consumed)):
+        if idx < skip:
+            continue
+        batch.append(mapping)
+        done += 1
+        if len(batch) == batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    if db.engine.dialect.name == 'postgresql':
+        reset_sequences(model)
+    if progress is not None:
+        progress.update(consumed[0], done - skip, finished=True)
+
+    if os.path.exists(checkpoint_path(path)):
+        os.remove(checkpoint_path(path))
+    return done - skip
+
+
+def reset_sequences(model):
+    """
+    Rows were inserted with their ids, move serial sequences past them
+    """
+    for column in model.__table__.primary_key.columns:
+        if isinstance(column.type, Integer) and column.autoincrement:
+            db.session.execute("SELECT setval(pg_get_serial_sequence('%s', '%s'), COALESCE(MAX(%s), 1)) FROM %s"
+                               % (model.__tablename__, column.name, column.name, model.__tablename__))
+    db.session.commit()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Fast and deterministic fake users for development and load testing (used by ./manager.py database fake).
+
+    Users are generated in chunks of ids after the largest id in the table. Phones and user names are made from
+    the id (phones through a permutation of all 09xxxxxxxxx numbers picked by the seed) so they never collide
+    and no query or retry is needed to keep them unique (a phone of a user made some other way still could).
+    Every other value comes from a random generator seeded with the seed and the first id of the chunk, and
+    registration times are counted back from a now picked by the seed unless one is given, so the same seed,
+    chunk size and table give the same rows. Signed access tokens are issued at the given now or else at the
+    current time, so they are valid for ACCESS_TOKEN_TIMEOUT whatever day the seed picked.
+    Each chunk is inserted with one bulk_insert_mappings per table and every user gets an access token
+    (stored in Redis unless tokens are signed) and a refresh token. All users share one password hash, hashing
+    a password per user would take longer than everything else together.
+    Chunks can be spread over processes, which pays off with PostgreSQL (SQLite allows one writer at a time).
+"""
+
+# python imports
+import multiprocessing
+from calendar import timegm
+from datetime import datetime, timedelta
+from fractions import gcd
+from hashlib import sha1
+from random import Random
+from uuid import UUID, uuid4
+from sqlalchemy_utils.types.password import Password
+
+# flask imports
+from flask import current_app
+
+# project imports
+from application.extensions import db, redis
+from application.modules import count_cache
+from application.modules.data_transfer import reset_sequences
+
+FIRST_NAMES = (u'علی', u'محمد', u'حسین', u'رضا', u'مهدی', u'امیر', u'حمید', u'سعید', u'مجید', u'بهرام',
+               u'سارا', u'مریم', u'زهرا', u'فاطمه', u'نگار', u'لیلا', u'نرگس', u'شیما', u'الهام', u'پریسا')
+LAST_NAMES = (u'احمدی', u'محمدی', u'حسینی', u'رضایی', u'کریمی', u'موسوی', u'جعفری', u'صادقی', u'رحیمی',
+              u'هاشمی', u'کاظمی', u'نوری', u'قاسمی', u'اکبری', u'عباسی', u'طاهری', u'فاضلی', u'زمانی')
+WORDS = ('blue', 'red', 'green', 'gold', 'silver', 'lion', 'eagle', 'wolf', 'tiger', 'star', 'goal', 'striker',
+         'keeper', 'winger', 'captain', 'derby', 'match', 'cup', 'league', 'final')
+
+DEVELOPER = {
+    'user_name': u'rishe',
+    'real_name': u'ریشه',
+    'phone': '09123456789',
+    'password': '123123',
+    'access': '123456',
+}
+PASSWORD = '123123'
+
+# now picked by a seed is a day of the year after this one
+FAKE_EPOCH = datetime(2016, 1, 1)
+
+# phones are 09 followed by one of these numbers, the developer phone is left out
+PHONE_NUMBERS = 10 ** 9 - 1
+DEVELOPER_NUMBER = int(DEVELOPER['phone'][2:])
+
+_app = None
+
+
+def _random(*parts):
+    # seeding with a string would depend on the interpreter hash seed
+    return Random(int(sha1(':'.join(str(part) for part in parts)).hexdigest(), 16))
+
+
+def seed_now(seed):
+    return FAKE_EPOCH + timedelta(days=_random('now', seed).randrange(365))
+
+
+def phone_permutation(seed):
+    """
+    :return: (a, b) of number = (a * id + b) mod PHONE_NUMBERS, a is coprime with PHONE_NUMBERS so ids below it
+             never share a phone
+    """
+    rng = _random('phones', seed)
+    while True:
+        a = rng.randrange(1, PHONE_NUMBERS)
+        if gcd(a, PHONE_NUMBERS) == 1:
+            return a, rng.randrange(PHONE_NUMBERS)
+
+
+def phone(user_id, permutation):
+    a, b = permutation
+    number = (a * user_id + b) % PHONE_NUMBERS
+    if number >= DEVELOPER_NUMBER:
+        number += 1
+    return '09%09d' % number
+
+
+def user_name(user_id, rng):
+    # words have no underscore so the id suffix keeps names unique
+    return u'%s_%s' % (rng.choice(WORDS), _base36(user_id))
+
+
+def _base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    text = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        text = digits[remainder] + text
+        if not number:
+            return text
+
+
+def _token(rng):
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def generate_chunk(seed, first_id, count, password_hash, now, issued_at):
+    """
+    :param issued_at: time signed access tokens are issued at (UTC)
+    :return: (user mappings, token mappings) of users first_id to first_id + count - 1
+    """
+    from application.models import User
+
+    rng = _random(seed, first_id)
+    permutation = phone_permutation(seed)
+    password = Password(password_hash)
+    signed = current_app.config['ACCESS_TOKEN_SIGNED']
+    expires_at = timegm(issued_at.utctimetuple()) + current_app.config['ACCESS_TOKEN_TIMEOUT']
+
+    users, tokens = [], []
+    for user_id in range(first_id, first_id + count):
+        users.append({
+            'id': user_id,
+            'real_name': u'%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+            'user_name': user_name(user_id, rng),
+            'phone': phone(user_id, permutation),
+            'password': password,
+            'active': rng.random() < 0.95,
+            'registered_at': now - timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+            'coupon_count': rng.randrange(6),
+        })
+
+        if signed:
+            token_id = '%016x' % rng.getrandbits(64)
+            access = User._access_token_serializer().dumps([user_id, token_id, 0, expires_at])
+        else:
+            access = _token(rng)
+        tokens.append({'refresh': _token(rng), 'access': access, 'user_id': user_id})
+
+    return users, tokens
+
+
+def insert_chunk(seed, first_id, count, password_hash, now, issued_at):
+    """
+    Insert one chunk of users with their tokens
+    :return: list of (id, phone, access token) of inserted users
+    """
+    from application.models import User, Token
+
+    users, tokens = generate_chunk(seed, first_id, count, password_hash, now, issued_at)
+    db.session.bulk_insert_mappings(User, users)
+    db.session.bulk_insert_mappings(Token, tokens)
+    count_cache.mark_changed(db.session, User.__tablename__)
+    count_cache.mark_changed(db.session, Token.__tablename__)
+    db.session.commit()
+
+    if not current_app.config['ACCESS_TOKEN_SIGNED']:
+        timeout = current_app.config['ACCESS_TOKEN_TIMEOUT']
+        pipe = redis.pipeline(transaction=False)
+        for token in tokens:
+            pipe.setex('uat:%s' % token['access'], timeout, str(token['user_id']))
+        pipe.execute()
+
+    return [(user['id'], user['phone'], token['access']) for user, token in zip(users, tokens)]
+
+
+def _init_worker():
+    # connections of parent must not be shared with forked workers
+    db.engine.dispose()
+
+
+def _insert_chunk(args):
+    with _app.app_context():
+        return insert_chunk(*args)
+
+
+def seed_users(count, seed='rishe', chunk_size=1000, processes=1, progress=None, now=None):
+    """
+    Insert count fake users after the largest user id
+    :param processes: chunks are inserted by this many worker processes (one with SQLite)
+    :param now: users registered before it (UTC), seed_now(seed) by default. Signed access tokens are issued at it
+                when it is given and at the current time otherwise
+    :return: iterator of (id, phone, access token) lists, one per chunk in id order
+    """
+    global _app
+    from application.models import User
+
+    start = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    if start + count > PHONE_NUMBERS:
+        raise ValueError('Only %d users can get a fake phone' % PHONE_NUMBERS)
+
+    password_hash = User.__table__.c.password.type.context.encrypt(PASSWORD)
+    # tokens of seeded users must be valid now, however old their rows look
+    issued_at = now if now is not None else datetime.utcnow()
+    if now is None:
+        now = seed_now(seed)
+    chunks = [(seed, first_id, min(chunk_size, start + count - first_id), password_hash, now, issued_at)
+              for first_id in range(start, start + count, chunk_size)]
+    if progress is not None:
+        progress.total = count
+
+    if db.engine.dialect.name == 'sqlite':
+        processes = 1
+    db.session.close()
+
+    pool = None
+    if processes > 1:
+        _app = current_app._get_current_object()
+        db.engine.dispose()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        results = pool.imap(_insert_chunk, chunks)
+    else:
+        results = (insert_chunk(*chunk) for chunk in chunks)
+
+    done = 0
+    try:
+        for inserted in results:
+            done += len(inserted)
+            if progress is not None:
+                progress.update(done, done)
+            yield inserted
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if db.engine.dialect.name == 'postgresql':
+        reset_sequences(User)
+    if progress is not None:
+        progress.update(done, done, finished=True)
+
+
+def create_developer():
+    """
+    Create development user (see README) once, with an access token which does not expire
+    :return: developer User
+    """
+    from application.models import User, Token
+
+    user = User.query.filter_by(phone=DEVELOPER['phone']).first()
+    if user is not None:
+        return user
+
+    user = User(user_name=DEVELOPER['user_name'], real_name=DEVELOPER['real_name'], phone=DEVELOPER['phone'],
+                password=DEVELOPER['password'])
+    db.session.add(user)
+    db.session.add(Token(user=user, access=DEVELOPER['access'], refresh=str(uuid4())))
+    db.session.commit()
+
+    redis.set('uat:%s' % DEVELOPER['access'], str(user.id))
+    return user
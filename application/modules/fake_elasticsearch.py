@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+    In process stand-in of the Elasticsearch client, used when ELASTICSEARCH_HOST = 'memory://' (tests and
+    offline runs). It keeps indices, aliases and documents in memory and covers the indices, bulk and document
+    APIs application.modules.search uses. Search matches documents containing every word of the query in any of
+    their values, nothing is analyzed.
+"""
+
+# python imports
+import json
+import threading
+from elasticsearch.serializer import JSONSerializer
+
+
+class FakeIndices(object):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, body=None, **kwargs):
+        with self.client.lock:
+            if index in self.client.indices_ or self.client.aliases.get(index):
+                self.client.error(400, 'index_already_exists_exception', index)
+            self.client.indices_[index] = {'settings': dict((body or {}).get('settings', {})), 'documents': {}}
+        return {'acknowledged': True}
+
+    def delete(self, index, ignore=(), **kwargs):
+        with self.client.lock:
+            if index not in self.client.indices_:
+                return self.client.error(404, 'index_not_found_exception', index, ignore)
+            del self.client.indices_[index]
+            for indices in self.client.aliases.values():
+                indices.discard(index)
+        return {'acknowledged': True}
+
+    def exists(self, index, **kwargs):
+        return index in self.client.indices_ or bool(self.client.aliases.get(index))
+
+    def exists_alias(self, name=None, index=None, **kwargs):
+        indices = self.client.aliases.get(name, set())
+        return bool(indices) if index is None else index in indices
+
+    def get_alias(self, name=None, index=None, **kwargs):
+        found = {}
+        for alias, indices in self.client.aliases.items():
+            for concrete in indices:
+                if (name is None or alias == name) and (index is None or concrete == index):
+                    found.setdefault(concrete, {'aliases': {}})['aliases'][alias] = {}
+        if not found:
+            self.client.error(404, 'aliases_not_found_exception', name)
+        return found
+
+    def update_aliases(self, body, **kwargs):
+        with self.client.lock:
+            # all changes are applied together like Elasticsearch does
+            aliases = dict((alias, set(indices)) for alias, indices in self.client.aliases.items())
+            removed = set()
+            for change in body['actions']:
+                (action, target), = change.items()
+                if target['index'] not in self.client.indices_:
+                    self.client.error(404, 'index_not_found_exception', target['index'])
+                if action == 'add':
+                    aliases.setdefault(target['alias'], set()).add(target['index'])
+                elif action == 'remove_index':
+                    removed.add(target['index'])
+                else:
+                    aliases.get(target['alias'], set()).discard(target['index'])
+
+            aliases = dict((alias, indices - removed) for alias, indices in aliases.items())
+            for alias, indices in aliases.items():
+                if indices and alias in self.client.indices_ and alias not in removed:
+                    self.client.error(400, 'invalid_alias_name_exception', alias)
+            for index in removed:
+                del self.client.indices_[index]
+            self.client.aliases = aliases
+        return {'acknowledged': True}
+
+    def put_settings(self, body, index=None, **kwargs):
+        for name in self.client.resolve(index):
+            self.client.indices_[name]['settings'].setdefault('index', {}).update(body.get('index', body))
+        return {'acknowledged': True}
+
+    def get_settings(self, index=None, **kwargs):
+        return dict((name, {'settings': self.client.indices_[name]['settings']})
+                    for name in self.client.resolve(index))
+
+    def refresh(self, index=None, **kwargs):
+        self.client.resolve(index)
+        return {'_shards': {'failed': 0}}
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeElasticsearch(object):
+    """
+    Client with one lock around every change, errors are raised as elasticsearch.exceptions like the real one
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indices_ = {}
+        self.aliases = {}
+        self.indices = FakeIndices(self)
+        self.transport = FakeTransport()
+
+    @staticmethod
+    def error(status, error, index, ignore=()):
+        from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError
+
+        body = {'error': {'type': error, 'index': index}, 'status': status}
+        if status in (ignore if isinstance(ignore, (list, tuple)) else [ignore]):
+            return body
+        raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error, body)
+
+    def resolve(self, index):
+        """
+        :return: names of concrete indices an index name or alias stands for
+        """
+        if index is None or index == '_all':
+            return sorted(self.indices_)
+        if index in self.indices_:
+            return [index]
+        if self.aliases.get(index):
+            return sorted(self.aliases[index])
+        return self.error(404, 'index_not_found_exception', index)
+
+    def _write_index(self, index):
+        names = self.resolve(index)
+        if len(names) != 1:
+            self.error(400, 'illegal_argument_exception', index)
+        return self.indices_[names[0]]['documents']
+
+    def bulk(self, body, index=None, doc_type=None, **kwargs):
+        lines = [line for line in (body.splitlines() if isinstance(body, basestring) else body) if line]
+        lines = [json.loads(line) if isinstance(line, basestring) else line for line in lines]
+        items, errors = [], False
+        with self.lock:
+            while lines:
+                (op_type, meta), = lines.pop(0).items()
+                source = lines.pop(0) if op_type != 'delete' else None
+                target = meta.get('_index', index)
+                key = (meta.get('_type', doc_type), str(meta.get('_id')))
+                item = {'_index': target, '_type': key[0], '_id': key[1]}
+                try:
+                    documents = self._write_index(target)
+                except Exception:
+                    item.update(status=404, error={'type': 'index_not_found_exception', 'index': target})
+                    errors = True
+                else:
+                    if op_type == 'delete':
+                        item['status'] = 200 if documents.pop(key, None) is not None else 404
+                    elif op_type == 'update':
+                        if key in documents:
+                            documents[key] = dict(documents[key], **source.get('doc', {}))
+                            item['status'] = 200
+                        elif 'upsert' in source or source.get('doc_as_upsert'):
+                            documents[key] = dict(source.get('upsert', source.get('doc')))
+                            item['status'] = 201
+                        else:
+                            item['status'] = 404
+                            errors = True
+                    else:
+                        item['status'] = 200 if key in documents else 201
+                        documents[key] = source
+                items.append({op_type: item})
+        return {'took': 0, 'errors': errors, 'items': items}
+
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        return self.bulk([{'index': {'_index': index, '_type': doc_type, '_id': id}}, body])['items'][0]['index']
+
+    def delete(self, index, doc_type, id, ignore=(), **kwargs):
+        item = self.bulk([{'delete': {'_index': index, '_type': doc_type, '_id': id}}])['items'][0]['delete']
+        if item['status'] == 404:
+            return self.error(404, 'not_found', index, ignore)
+        return item
+
+    def get(self, index, doc_type, id, ignore=(), **kwargs):
+        with self.lock:
+            for name in self.resolve(index):
+                source = self.indices_[name]['documents'].get((doc_type, str(id)))
+                if source is not None:
+                    return {'_index': name, '_type': doc_type, '_id': str(id), 'found': True, '_source': source}
+        return self.error(404, 'not_found', index, ignore)
+
+    def _documents(self, index, doc_type, text):
+        words = text.lower().split() if text else []
+        with self.lock:
+            for name in self.resolve(index):
+                for (type_, id_), source in sorted(self.indices_[name]['documents'].items()):
+                    if doc_type is not None and type_ != doc_type:
+                        continue
+                    values = u' '.join(unicode(value) for value in source.values() if value is not None).lower()
+                    if all(word in values for word in words):
+                        yield name, type_, id_, source
+
+    def count(self, index=None, doc_type=None, q=None, **kwargs):
+        return {'count': sum(1 for _ in self._documents(index, doc_type, q))}
+
+    def search(self, index=None, doc_type=None, q=None, body=None, from_=0, size=10, **kwargs):
+        hits = [{'_index': name, '_type': type_, '_id': id_, '_source': source}
+                for name, type_, id_, source in self._documents(index, doc_type, q)]
+        return {'hits': {'total': len(hits), 'hits': hits[from_:from_ + size]}}
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+    JSON encoder used by jsonify and flask.json.dumps across the app.
+
+    It serializes datetime, date and Decimal values natively and hands the actual encoding to the fastest
+    available backend (JSON_BACKEND): simplejson (with C speedups) or the standard library. Both of them turn
+    these values into text through default() so they write the same output.
+    JSON_COMPACT drops indentation and spaces after separators, which also lets C encoders do all the work.
+"""
+
+# python imports
+import json as stdlib_json
+from datetime import datetime, date
+from decimal import Decimal
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# flask imports
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+# project imports
+from application.modules.timing import phase
+
+BACKENDS = ('simplejson', 'json')
+
+
+def available_backends():
+    return [name for name, module in zip(BACKENDS, (simplejson, stdlib_json)) if module is not None]
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    backend = 'json'
+    compact = False
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            # same text str(datetime) gives, which is what clients always received
+            return o.isoformat(' ')
+        if isinstance(o, date):
+            return o.isoformat()
+        if isinstance(o, Decimal):
+            return float(o)
+        return FlaskJSONEncoder.default(self, o)
+
+    def encode(self, o):
+        with phase('serialize'):
+            return self._encode(o)
+
+    def _encode(self, o):
+        if self.compact:
+            self.indent = None
+            self.item_separator, self.key_separator = ',', ':'
+
+        if self.backend == 'simplejson':
+            # Decimal goes through default() like it does with the standard library
+            return simplejson.dumps(o, default=self.default, sort_keys=self.sort_keys, ensure_ascii=self.ensure_ascii,
+                                    indent=self.indent, separators=(self.item_separator, self.key_separator),
+                                    use_decimal=False)
+
+        # flask encoder is built on simplejson when it is installed, which keeps indent as a string of spaces
+        indent = len(self.indent) if isinstance(self.indent, basestring) else self.indent
+        return stdlib_json.dumps(o, default=self.default, sort_keys=self.sort_keys, ensure_ascii=self.ensure_ascii,
+                                 indent=indent, separators=(self.item_separator, self.key_separator))
+
+
+def make_encoder(backend='auto', compact=False):
+    """
+    :param backend: one of BACKENDS or 'auto' for the fastest installed one
+    :rtype type
+    """
+    backends = available_backends()
+    if backend == 'auto':
+        backend = backends[0]
+    elif backend not in backends:
+        raise ValueError('JSON backend %s is not available, installed backends: %s' % (backend, ', '.join(backends)))
+
+    return type('JSONEncoder', (JSONEncoder,), {'backend': backend, 'compact': compact})
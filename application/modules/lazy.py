@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Keep package imports off the startup path.
+
+    LazyExtension stands in for an extension instance and imports its package only when the extension is
+    initialized, so extensions left out of EXTENSIONS cost nothing.
+
+    With LAZY_VIEWS the url rules of CONTROLLERS are read from a url map cached in CACHE_DIR and their views
+    are imported by the first request which needs them. The cache is rebuilt (by importing controllers the
+    usual way) whenever config, a controller source file or a module of its blueprints and views changes.
+"""
+
+# python imports
+import json
+import os
+import sys
+from hashlib import sha1
+
+# flask imports
+from werkzeug.utils import import_string
+
+URL_MAP_VERSION = 2
+
+
+class LazyExtension(object):
+    def __init__(self, import_name, *args, **kwargs):
+        self._import_name = import_name
+        self._args = args
+        self._kwargs = kwargs
+        self._instance = None
+
+    def _get_instance(self):
+        if self._instance is None:
+            self._instance = import_string(self._import_name)(*self._args, **self._kwargs)
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._get_instance(), name)
+
+
+class LazyView(object):
+    def __init__(self, module, name):
+        self.__module__ = module
+        self.__name__ = name
+        self._view = None
+
+    def __call__(self, *args, **kwargs):
+        if self._view is None:
+            self._view = import_string('%s:%s' % (self.__module__, self.__name__))
+        return self._view(*args, **kwargs)
+
+
+def _url_map_path(app):
+    return os.path.join(app.config['CACHE_DIR'], 'url_map.json')
+
+
+def _source_file(module):
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    return path[:-1] if path.endswith(('.pyc', '.pyo')) else path
+
+
+def _fingerprint(app, modules=()):
+    """
+    Changes when config, controllers list or any of their source files changes
+    :param modules: source files of blueprints and views the url map was saved from
+    """
+    # secrets are left out of a digest which is written to disk, objects are only compared by type
+    config = dict((key, value) for key, value in app.config.items()
+                  if 'SECRET' not in key and 'PASSWORD' not in key)
+    digest = sha1(repr((URL_MAP_VERSION, tuple(app.config['CONTROLLERS']))))
+    digest.update(json.dumps(config, sort_keys=True, default=lambda value: type(value).__name__))
+
+    files = set(modules)
+    for controller in app.config['CONTROLLERS']:
+        location = os.path.join(app.root_path, 'controllers', controller)
+        if os.path.isdir(location):
+            files.update(os.path.join(root, name) for root, _, names in os.walk(location)
+                         for name in names if name.endswith('.py'))
+        else:
+            files.add(location + '.py')
+
+    for path in sorted(files):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        digest.update('%s:%s:%s' % (path, stat.st_mtime, stat.st_size))
+
+    return digest.hexdigest()
+
+
+def load_url_map(app):
+    """
+    Add controller rules from cached url map with lazy views
+    :return: False if there is no up to date cache
+    """
+    try:
+        with open(_url_map_path(app)) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    if cached.get('fingerprint') != _fingerprint(app, cached.get('modules', ())):
+        return False
+
+    for rule in cached['rules']:
+        app.add_url_rule(rule['rule'], rule['endpoint'], LazyView(*rule['view']), methods=rule['methods'],
+                         defaults=rule['defaults'], strict_slashes=rule['strict_slashes'])
+    return True
+
+
+def save_url_map(app, blueprints):
+    """
+    Cache rules of blueprints registered on app, blueprints which register anything but url rules
+    (request hooks, error handlers, ...) or have views not reachable by module and name are not cacheable
+    :return: False if url map could not be cached
+    """
+    rules = []
+    modules = set()
+    for blueprint in blueprints:
+        modules.add(_source_file(sys.modules.get(blueprint.import_name)))
+        blueprint_rules = [rule for rule in app.url_map.iter_rules()
+                           if rule.endpoint.startswith(blueprint.name + '.')]
+        if len(blueprint_rules) != len(blueprint.deferred_functions):
+            return False
+
+        for rule in blueprint_rules:
+            view = app.view_functions[rule.endpoint]
+            if getattr(sys.modules.get(view.__module__), view.__name__, None) is not view:
+                return False
+            modules.add(_source_file(sys.modules[view.__module__]))
+
+            # flask adds HEAD and automatic OPTIONS again
+            methods = set(rule.methods) - {'HEAD'}
+            if getattr(rule, 'provide_automatic_options', False):
+                methods.discard('OPTIONS')
+
+            rules.append({
+                'rule': rule.rule,
+                'endpoint': rule.endpoint,
+                'view': [view.__module__, view.__name__],
+                'methods': sorted(methods),
+                'defaults': rule.defaults,
+                'strict_slashes': rule.strict_slashes,
+            })
+
+    modules = sorted(path for path in modules if path is not None)
+    path = _url_map_path(app)
+    temporary = '%s.%d' % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump({'fingerprint': _fingerprint(app, modules), 'modules': modules, 'rules': rules}, f)
+    # workers starting at the same time never read a half written file
+    os.rename(temporary, path)
+    return True
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# python imports
+import threading
+from collections import OrderedDict
+from time import time
+
+# Returned by LocalCache.get when nothing (not even a cached None) is stored for a key
+MISSING = object()
+
+
+class LocalCache(object):
+    """
+    Bounded, thread safe LRU cache living in worker memory. Every entry has its own expiry time.
+    """
+
+    def __init__(self, max_size=1024, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            try:
+                expires_at, value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires_at < time():
+                return default
+
+            # re-insert so recently used keys are evicted last
+            self._data[key] = (expires_at, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time() + (self.timeout if timeout is None else timeout)
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires_at, value)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_if(self, predicate):
+        """
+        Delete every entry which predicate(key, value) is True for
+        """
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Profile single requests in production.
+
+    A request is profiled when it is picked by PROFILER_SAMPLE_RATE or carries PROFILER_HEADER with
+    PROFILER_SECRET, and its profile is kept when it took PROFILER_THRESHOLD_MS or more (picked by header always).
+    Profiles are written to PROFILER_DIR (<CACHE_DIR>/profiles by default) as <endpoint>-<timestamp>-<ms>ms with
+    .prof extension for cProfile (pstats) and .stacks for the statistical sampler (collapsed stacks which
+    flamegraph.pl reads). ./manager.py profiles lists and summarizes them.
+
+    cProfile slows down the request it profiles several times, so only one runs per worker at a time. The
+    sampler records stacks of profiled requests every PROFILER_SAMPLER_INTERVAL seconds from a background thread
+    and is cheap enough to watch every request for slow ones (needs enable-threads with uWSGI, greenlets of
+    gevent mode share one thread so it sees them mixed together).
+    With PROFILER_ENABLED off the app is not wrapped at all. Only the view is profiled, not a streamed body.
+"""
+
+# python imports
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from time import time, sleep
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# flask imports
+from flask import request
+
+MODES = ('cprofile', 'sampler')
+EXTENSIONS = {'cprofile': '.prof', 'sampler': '.stacks'}
+
+
+class StackSampler(object):
+    """
+    One background thread per worker which counts stacks of the threads being profiled
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.threads = {}
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def start(self, ident):
+        with self._lock:
+            self.threads[ident] = Counter()
+            # threads are not copied to forked workers
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = threading.Thread(target=self.run, name='stack-sampler')
+                thread.daemon = True
+                thread.start()
+
+    def stop(self, ident):
+        with self._lock:
+            return self.threads.pop(ident, Counter())
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            if not self.threads:
+                continue
+
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self.threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[self.stack(frame)] += 1
+
+    @staticmethod
+    def stack(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s:%s:%d' % (frame.f_globals.get('__name__', '?'), code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+class ProfilerMiddleware(object):
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.mode = config['PROFILER_MODE']
+        self.sample_rate = config['PROFILER_SAMPLE_RATE']
+        self.header = 'HTTP_' + config['PROFILER_HEADER'].upper().replace('-', '_')
+        self.secret = config['PROFILER_SECRET']
+        self.threshold = config['PROFILER_THRESHOLD_MS']
+        self.directory = config['PROFILER_DIR']
+        self.sampler = StackSampler(config['PROFILER_SAMPLER_INTERVAL'])
+        self._cprofile_lock = threading.Lock()
+
+        if self.mode not in MODES:
+            raise ValueError('Unknown PROFILER_MODE %s, use one of %s' % (self.mode, ', '.join(MODES)))
+
+    def forced(self, environ):
+        value = environ.get(self.header)
+        return bool(self.secret and value) and hmac.compare_digest(str(value), str(self.secret))
+
+    def __call__(self, environ, start_response):
+        forced = self.forced(environ)
+        if not forced and not (self.sample_rate and random.random() < self.sample_rate):
+            return self.wsgi_app(environ, start_response)
+
+        if self.mode == 'sampler':
+            return self.sampled(environ, start_response, forced)
+
+        if not self._cprofile_lock.acquire(False):
+            return self.wsgi_app(environ, start_response)
+        try:
+            profile = cProfile.Profile()
+            started = time()
+            response = profile.runcall(self.wsgi_app, environ, start_response)
+            elapsed = time() - started
+        finally:
+            self._cprofile_lock.release()
+
+        if self.keep(elapsed, forced):
+            profile.dump_stats(self.path(environ, elapsed))
+        return response
+
+    def sampled(self, environ, start_response, forced):
+        ident = threading.current_thread().ident
+        self.sampler.start(ident)
+        started = time()
+        try:
+            response = self.wsgi_app(environ, start_response)
+        finally:
+            stacks = self.sampler.stop(ident)
+        elapsed = time() - started
+
+        if self.keep(elapsed, forced):
+            with open(self.path(environ, elapsed), 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('%s %d\n' % (stack, count))
+        return response
+
+    def keep(self, elapsed, forced):
+        return forced or not self.threshold or elapsed * 1000 >= self.threshold
+
+    def path(self, environ, elapsed):
+        endpoint = environ.get('profiler.endpoint') or 'unmatched'
+        name = '%s-%s-%dms%s' % (endpoint, datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), elapsed * 1000,
+                                 EXTENSIONS[self.mode])
+        return os.path.join(self.directory, name)
+
+
+class Profiler(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # resolved here to follow CACHE_DIR of the config in use, ./manager.py profiles reads it back from app config
+        if app.config['PROFILER_DIR'] is None:
+            app.config['PROFILER_DIR'] = os.path.join(app.config['CACHE_DIR'], 'profiles')
+
+        if app.config['PROFILER_ENABLED']:
+            if not os.path.exists(app.config['PROFILER_DIR']):
+                os.makedirs(app.config['PROFILER_DIR'])
+            app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
+
+            @app.before_request
+            def profiler_endpoint():
+                # profiles are named by endpoint which only the app knows
+                request.environ['profiler.endpoint'] = request.endpoint
+
+        app.extensions['profiler'] = self
+
+
+def list_profiles(directory):
+    """
+    :return: list of (name, endpoint, captured at, milliseconds) of captured profiles, newest first
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for name in os.listdir(directory):
+        base, extension = os.path.splitext(name)
+        parts = base.rsplit('-', 2)
+        if extension not in EXTENSIONS.values() or len(parts) != 3:
+            continue
+
+        endpoint, captured_at, duration = parts
+        try:
+            captured_at = datetime.strptime(captured_at, '%Y%m%dT%H%M%S.%f')
+            duration = int(duration[:-2])
+        except ValueError:
+            continue
+        profiles.append((name, endpoint, captured_at, duration))
+
+    return sorted(profiles, key=lambda profile: profile[2], reverse=True)
+
+
+def summarize(path, limit=20):
+    """
+    :return: text with the limit most expensive functions of a profile
+    """
+    if path.endswith('.prof'):
+        output = StringIO()
+        stats = pstats.Stats(path, stream=output)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    inclusive, exclusive = Counter(), Counter()
+    samples = 0
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            count = int(count)
+            frames = stack.split(';')
+            samples += count
+            exclusive[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+    if not samples:
+        return 'No samples, request was shorter than sampler interval'
+
+    lines = ['%d samples' % samples, '', '{:>7s} {:>7s}  {}'.format('total%', 'self%', 'function')]
+    for frame, count in inclusive.most_common(limit):
+        lines.append('{:7.1f} {:7.1f}  {}'.format(100.0 * count / samples, 100.0 * exclusive[frame] / samples, frame))
+    return '\n'.join(lines)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Count SQL statements per request to catch N+1 queries.
+
+    With QUERY_COUNT_ENABLED (development) statements of every request are counted by shape (the statement
+    with IN lists collapsed, bound values are never part of it) and a warning is logged when one shape runs
+    more than QUERY_REPEAT_THRESHOLD times, which is what a query per item of a list looks like.
+    Tests put query budgets on code with assert_max_queries, which works whether the extension is enabled or not.
+"""
+
+# python imports
+import re
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# flask imports
+from flask import _app_ctx_stack, current_app, g, request
+
+IN_LIST = re.compile(r'\bIN \([^()]*\)', re.IGNORECASE)
+
+# count_queries blocks running at the moment
+_active = []
+
+
+def shape(statement):
+    return IN_LIST.sub('IN (...)', ' '.join(statement.split()))
+
+
+def _listen():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    ctx = _app_ctx_stack.top
+    queries = getattr(ctx.g, 'queries', None) if ctx is not None else None
+    if queries is None and not _active:
+        return
+
+    statement = shape(statement)
+    if queries is not None:
+        queries[statement] += 1
+    for counter in _active:
+        counter.queries[statement] += 1
+
+
+class count_queries(object):
+    """
+    Count statements run (on any engine) inside the block
+    """
+
+    def __init__(self):
+        self.queries = Counter()
+
+    @property
+    def count(self):
+        return sum(self.queries.values())
+
+    def __enter__(self):
+        _listen()
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.remove(self)
+
+    def report(self):
+        return '\n'.join('%4d x %s' % (count, statement) for statement, count in self.queries.most_common())
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """
+    Fail with the statements which ran when the block runs more than limit statements
+    """
+    with count_queries() as counter:
+        yield counter
+
+    if counter.count > limit:
+        raise AssertionError('%d queries ran, budget is %d:\n%s' % (counter.count, limit, counter.report()))
+
+
+class QueryCounter(object):
+    def __init__(self, app=None):
+        self.threshold = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.threshold = app.config['QUERY_REPEAT_THRESHOLD']
+
+        if app.config['QUERY_COUNT_ENABLED']:
+            _listen()
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+
+        app.extensions['query_counter'] = self
+
+    @staticmethod
+    def _before_request():
+        g.queries = Counter()
+
+    def _after_request(self, response):
+        queries = getattr(g, 'queries', None)
+        if queries:
+            for statement, count in queries.most_common():
+                if count <= self.threshold:
+                    break
+                current_app.logger.warning('Possible N+1 query, statement ran %d times during %s %s: %s',
+                                           count, request.method, request.path, statement)
+        return response
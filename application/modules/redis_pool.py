@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Redis client with a tunable, per process connection pool.
+
+    Pool size, socket timeouts, keepalive and health checks come from REDIS_* config keys and REDIS_URL may
+    point to a unix socket (unix:///path/to/redis.sock?db=0). memory:// keeps data in process with fakeredis
+    (for offline benchmarks, nothing is shared between processes). Connections are never shared between uWSGI
+    workers: a forked worker drops the ones it inherited and opens its own on first use.
+    Pool usage is counted per worker and returned by redis.pool_stats() for monitoring. Commands of sampled
+    requests are timed as their redis phase (see application.modules.timing), a pipeline is one round trip.
+"""
+
+# python imports
+import os
+import threading
+from time import time
+from redis import StrictRedis, Redis
+from redis.client import StrictPipeline, Pipeline
+from redis.connection import BlockingConnectionPool
+from redis.exceptions import ConnectionError, TimeoutError
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+# flask imports
+from flask.ext.redis import FlaskRedis
+
+# project imports
+from application.modules.timing import phase
+
+# unix socket connections have no such options
+TCP_ONLY_OPTIONS = ('socket_connect_timeout', 'socket_keepalive')
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """
+    Blocking pool (callers wait up to timeout seconds when max_connections are in use) which counts its usage
+    and pings connections idle for more than health_check_interval seconds before handing them out
+    """
+
+    def __init__(self, health_check_interval=0, **kwargs):
+        self.health_check_interval = health_check_interval
+        super(InstrumentedConnectionPool, self).__init__(**kwargs)
+
+    def reset(self):
+        super(InstrumentedConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.health_checks = 0
+        self.reconnects = 0
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid != os.getpid():
+                    # sockets are shared with parent process, shutting them down (what disconnect() does)
+                    # breaks parent connections too, so they are only forgotten
+                    self.reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        self._checkpid()
+
+        try:
+            connection = self.pool.get(block=False)
+        except Empty:
+            started = time()
+            try:
+                connection = self.pool.get(block=True, timeout=self.timeout)
+            except Empty:
+                raise ConnectionError('No connection available.')
+            finally:
+                with self._stats_lock:
+                    self.waits += 1
+                    self.wait_time += time() - started
+
+        if connection is None:
+            connection = self.make_connection()
+        elif self.health_check_interval and connection._sock is not None and \
+                time() - getattr(connection, 'released_at', 0) > self.health_check_interval:
+            self.check_health(connection)
+
+        with self._stats_lock:
+            self.in_use += 1
+        return connection
+
+    def check_health(self, connection):
+        with self._stats_lock:
+            self.health_checks += 1
+
+        try:
+            connection.send_command('PING')
+            if connection.read_response() in ('PONG', b'PONG'):
+                return
+        except (ConnectionError, TimeoutError):
+            pass
+
+        # connection is opened again by the command which uses it
+        connection.disconnect()
+        with self._stats_lock:
+            self.reconnects += 1
+
+    def release(self, connection):
+        self._checkpid()
+        if connection.pid != self.pid:
+            return
+
+        connection.released_at = time()
+        with self._stats_lock:
+            self.in_use -= 1
+        super(InstrumentedConnectionPool, self).release(connection)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'pid': self.pid,
+                'max_connections': self.max_connections,
+                'connections': len(self._connections),
+                'in_use': self.in_use,
+                'idle': len(self._connections) - self.in_use,
+                'waits': self.waits,
+                'wait_time': round(self.wait_time, 6),
+                'health_checks': self.health_checks,
+                'reconnects': self.reconnects,
+            }
+
+
+class TimedStrictPipeline(StrictPipeline):
+    def execute(self, raise_on_error=True):
+        with phase('redis', len(self.command_stack)):
+            return super(TimedStrictPipeline, self).execute(raise_on_error)
+
+
+class TimedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        with phase('redis', len(self.command_stack)):
+            return super(TimedPipeline, self).execute(raise_on_error)
+
+
+class TimedStrictRedis(StrictRedis):
+    def execute_command(self, *args, **options):
+        with phase('redis'):
+            return super(TimedStrictRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedStrictPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class TimedRedis(Redis):
+    def execute_command(self, *args, **options):
+        with phase('redis'):
+            return super(TimedRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class PooledRedis(FlaskRedis):
+    def init_app(self, app, strict=False):
+        url = app.config['REDIS_URL']
+        if url.startswith('memory://'):
+            import fakeredis
+
+            self._redis_client = (fakeredis.FakeStrictRedis if strict else fakeredis.FakeRedis)()
+            app.extensions['redis'] = self
+            return
+
+        options = {
+            'max_connections': app.config['REDIS_MAX_CONNECTIONS'],
+            'timeout': app.config['REDIS_POOL_TIMEOUT'],
+            'health_check_interval': app.config['REDIS_HEALTH_CHECK_INTERVAL'],
+            'socket_timeout': app.config['REDIS_SOCKET_TIMEOUT'],
+            'socket_connect_timeout': app.config['REDIS_SOCKET_CONNECT_TIMEOUT'],
+            'socket_keepalive': app.config['REDIS_SOCKET_KEEPALIVE'],
+        }
+        if url.startswith('unix://'):
+            for option in TCP_ONLY_OPTIONS:
+                options.pop(option)
+
+        pool = InstrumentedConnectionPool.from_url(url, **options)
+        self._redis_client = (TimedStrictRedis if strict else TimedRedis)(connection_pool=pool)
+
+        app.extensions['redis'] = self
+
+    def pool_stats(self):
+        """
+        Connection pool usage of current worker
+        :rtype dict
+        """
+        pool = getattr(self._redis_client, 'connection_pool', None)
+        if not isinstance(pool, InstrumentedConnectionPool):
+            return {}
+
+        pool._checkpid()
+        return pool.stats()
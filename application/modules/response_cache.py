@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Cached responses of GET views (see application.decorators.cached_response).
+
+    Entries are stored in the Flask-Cache backend (RESPONSE_CACHE_BACKEND = 'cache', filesystem in deployment so
+    workers of a host share them) or in Redis ('redis', shared by every host). An entry remembers the version of
+    each of its tags (e.g. user:12) and is only served while those versions are current, so committing changes to
+    a user gives its tag a new version and every response built from the old row is skipped from then on.
+    Entry and tag versions are read in one round trip.
+"""
+
+# python imports
+import json
+from hashlib import sha1
+from uuid import uuid4
+
+# flask imports
+from flask import current_app
+
+# project imports
+from application.extensions import cache, redis
+
+
+def _tag_key(tag):
+    return 'response-tag:%s' % tag
+
+
+def key(endpoint, user_id, path, args):
+    """
+    :param user_id: authenticated user the response is built for or None if it is the same for everyone
+    """
+    digest = sha1(json.dumps([endpoint, user_id, path, sorted(args.items(multi=True))]))
+    return 'response:%s' % digest.hexdigest()
+
+
+def _redis_mode():
+    return current_app.config['RESPONSE_CACHE_BACKEND'] == 'redis'
+
+
+def load(entry_key, tags):
+    """
+    :return: entry (dict of body, mimetype and etag) or None when there is none or one of tags changed since,
+             and versions of tags to store a new entry with
+    """
+    keys = [_tag_key(tag) for tag in tags]
+    if _redis_mode():
+        pipe = redis.pipeline(transaction=False)
+        pipe.hgetall(entry_key)
+        if keys:
+            pipe.mget(keys)
+        results = pipe.execute()
+        entry, versions = results[0] or None, results[1] if keys else []
+    else:
+        results = list(cache.get_many(entry_key, *keys))
+        entry, versions = results[0], results[1:]
+
+    if entry is None or None in versions or entry['versions'] != ','.join(versions):
+        return None, versions
+    return entry, versions
+
+
+def _assign_versions(tags, versions):
+    """
+    Tags which lost their version (evicted or never invalidated) get a new one
+    """
+    missing = [_tag_key(tag) for tag, version in zip(tags, versions) if version is None]
+    if not missing:
+        return versions
+
+    if _redis_mode():
+        pipe = redis.pipeline(transaction=False)
+        for tag_key in missing:
+            pipe.set(tag_key, uuid4().hex, nx=True)
+        assigned = pipe.mget(missing).execute()[-1]
+    else:
+        for tag_key in missing:
+            # add never overwrites a version another worker has just set
+            cache.add(tag_key, uuid4().hex, timeout=0)
+        assigned = list(cache.get_many(*missing))
+
+    assigned = iter(assigned)
+    return [version if version is not None else next(assigned) for version in versions]
+
+
+def store(entry_key, tags, versions, body, mimetype, timeout=None):
+    """
+    :param versions: tag versions load returned, read before the response was built so a change committed
+                     meanwhile is not hidden behind its new version
+    :return: stored entry
+    """
+    timeout = timeout or current_app.config['RESPONSE_CACHE_TIMEOUT']
+    versions = _assign_versions(tags, versions)
+    entry = {
+        'body': body,
+        'mimetype': mimetype,
+        'etag': sha1(body).hexdigest(),
+        'versions': ','.join(version or '' for version in versions),
+    }
+
+    if None in versions:
+        # backend keeps nothing (null cache), entry is only used for this response
+        return entry
+    if _redis_mode():
+        redis.pipeline(transaction=False).hmset(entry_key, entry).expire(entry_key, timeout).execute()
+    else:
+        cache.set(entry_key, entry, timeout=timeout)
+    return entry
+
+
+def invalidate(tags):
+    """
+    Skip every entry built with one of tags
+    """
+    versions = dict((_tag_key(tag), uuid4().hex) for tag in tags)
+    if not versions:
+        return
+
+    if _redis_mode():
+        redis.mset(versions)
+    else:
+        cache.set_many(versions, timeout=0)
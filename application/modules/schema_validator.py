@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Request body validation against schemas of application.jsons documents.
+
+    Each schema is generated from its jsl document when the app is created, checked against the meta schema
+    once and kept in memory as a validator object, so validating a request costs only the validation itself
+    (regular expressions of 'pattern' keywords are cached by re).
+"""
+
+# python imports
+import re
+from functools import wraps
+from jsonschema import Draft4Validator
+
+# flask imports
+from flask import current_app, request
+
+# project imports
+from application.modules.timing import phase
+
+
+def uncamelize(camel):
+    return re.sub('(.)([A-Z]{1})', r'\1_\2', camel).lower()
+
+
+class JsonSchema(object):
+    def __init__(self, app=None):
+        self.documents = {}
+        self.validators = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from application import jsons
+
+        self.documents = dict((uncamelize(name), getattr(jsons, name)) for name in jsons.__all__)
+        # a broken schema fails create_app instead of the first request using it
+        self.validators = dict((name, self._build(document)) for name, document in self.documents.items())
+
+        app.extensions['jsonschema'] = self
+
+    @staticmethod
+    def _build(document):
+        schema = document.get_schema(ordered=True)
+        Draft4Validator.check_schema(schema)
+        return Draft4Validator(schema)
+
+    def get_validator(self, name):
+        return self.validators[name]
+
+    def get_schema(self, name):
+        return self.get_validator(name).schema
+
+
+def validate(name):
+    """
+    Validate request json against schema of application.jsons document named name (in snake case)
+    and raise jsonschema.ValidationError if it is not valid
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with phase('validation'):
+                current_app.extensions['jsonschema'].get_validator(name).validate(request.json)
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Player search index.
+
+    SEARCH_INDEX is an alias, never a concrete index. reindex builds a new <alias>-<timestamp> index, streams rows
+    of every model in DOCUMENT_TYPES to it with parallel bulk requests while refresh and replicas are off, turns
+    them back on and moves the alias to the new index in one update_aliases call before old indices are deleted,
+    so searches are served from the old index until the new one is complete.
+
+    ELASTICSEARCH_HOST = 'memory://' keeps indices in process (application.modules.fake_elasticsearch) for tests
+    and offline runs, like REDIS_URL = 'memory://' does for Redis.
+"""
+
+# python imports
+from datetime import datetime
+from itertools import islice
+from elasticsearch.helpers import bulk, parallel_bulk
+from flask.ext.elasticsearch import FlaskElasticsearch as BaseFlaskElasticsearch
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+from werkzeug.utils import import_string
+
+# flask imports
+from flask import _app_ctx_stack, current_app
+
+# project imports
+from application.extensions import es
+
+MEMORY_HOST = 'memory://'
+
+SETTINGS = {
+    "index": {"max_result_window": 500000},
+    "analysis": {
+        "char_filter": {
+            "zero_width_spaces": {
+                "type": "mapping",
+                "mappings": ["\\u200C=> "]
+            }
+        },
+        "filter": {
+            "nGram_filter": {
+                "type": "nGram",
+                "min_gram": 2,
+                "max_gram": 50,
+                "token_chars": [
+                    "letter",
+                    "digit",
+                    "punctuation",
+                    "symbol"]
+            },
+            "persian_stop": {
+                "type": "stop",
+                "stopwords": "_persian_"
+            }
+
+        },
+        "analyzer": {
+            "nGram_analyzer": {
+                "type": "custom",
+                "tokenizer": "whitespace",
+                "filter": [
+                    "lowercase",
+                    "asciifolding",
+                    "arabic_normalization",
+                    "persian_normalization",
+                    "persian_stop",
+                    "nGram_filter"
+                ]
+            },
+            "whitespace_analyzer": {
+                "type": "custom",
+                "tokenizer": "whitespace",
+                "filter": [
+                    "lowercase",
+                    "asciifolding",
+                    "arabic_normalization",
+                    "persian_normalization",
+                    "persian_stop"
+                ]
+            }
+        }
+    }
+}
+
+MAPPINGS = {
+    "player": {
+        "_all": {
+            "analyzer": "nGram_analyzer",
+            "search_analyzer": "whitespace_analyzer"
+        },
+        "properties": {
+            "id": {
+                "type": "integer",
+                "index": "no",
+                "include_in_all": False
+            },
+            "name_fa": {
+                "type": "string",
+                "index": "not_analyzed"
+            },
+            "name_en": {
+                "type": "string",
+                "index": "not_analyzed"
+            },
+            "post": {
+                "type": "string",
+                "index": "not_analyzed"
+            },
+            "price": {
+                "type": "double",
+                "include_in_all": False
+            },
+            "team": {
+                "type": "string",
+                "index": "not_analyzed",
+            }
+        }
+    }
+}
+
+
+def player_document(player):
+    return {
+        'id': player.id,
+        'name_fa': player.name_fa,
+        'name_en': player.name_en,
+        'post': player.post,
+        'price': player.price,
+        'team': player.team.name_fa if player.team is not None else None,
+    }
+
+
+# document type: (model, function making the document of a row, relationships the function reads)
+DOCUMENT_TYPES = {
+    'player': ('application.models.Player', player_document, ('team',)),
+}
+
+# changes of these models change documents of rows pointing to them: model: [(document type, foreign key)]
+DEPENDENT_MODELS = {
+    'application.models.Team': [('player', 'team_id')],
+}
+
+_models = {}
+
+
+def _model(name):
+    if name not in _models:
+        _models[name] = import_string(name)
+    return _models[name]
+
+
+def changed_documents(objects):
+    """
+    :return: set of search_sync outbox members of documents changed objects are part of
+    """
+    members = set()
+    for obj in objects:
+        for doc_type, (model_name, _, _) in DOCUMENT_TYPES.items():
+            if isinstance(obj, _model(model_name)):
+                members.add('%s:%s' % (doc_type, obj.id))
+        for model_name, references in DEPENDENT_MODELS.items():
+            if isinstance(obj, _model(model_name)):
+                members.update('%s:%s:%s' % (doc_type, column, obj.id) for doc_type, column in references)
+    return members
+
+
+def index_changes(members, index):
+    """
+    Send documents of outbox members as their rows are now to index, documents of deleted rows are deleted
+    :return: members which could not be sent
+    """
+    by_type = {}
+    for member in members:
+        parts = member.split(':')
+        ids, references = by_type.setdefault(parts[0], (set(), {}))
+        if len(parts) == 2:
+            ids.add(int(parts[1]))
+        else:
+            references.setdefault(parts[1], set()).add(int(parts[2]))
+
+    actions = []
+    for doc_type, (ids, references) in by_type.items():
+        model_name, to_document, relationships = DOCUMENT_TYPES[doc_type]
+        model = _model(model_name)
+        conditions = [model.id.in_(ids)] if ids else []
+        conditions.extend(getattr(model, column).in_(values) for column, values in references.items())
+
+        found = set()
+        query = model.query.options(*[joinedload(getattr(model, name)) for name in relationships])
+        for row in query.filter(or_(*conditions)):
+            document = to_document(row)
+            found.add(document['id'])
+            actions.append({'_index': index, '_type': doc_type, '_id': document['id'], '_source': document})
+        actions.extend({'_op_type': 'delete', '_index': index, '_type': doc_type, '_id': deleted}
+                       for deleted in ids - found)
+
+    if not actions:
+        return []
+
+    _, errors = bulk(es.current_client(), actions, chunk_size=len(actions), raise_on_error=False)
+    failed = []
+    for error in errors:
+        (op_type, item), = error.items()
+        # document of a deleted row was never indexed
+        if not (op_type == 'delete' and item.get('status') == 404):
+            failed.append('%s:%s' % (item['_type'], item['_id']))
+    return failed
+
+
+def index_body(bulk_load=False):
+    """
+    :param bulk_load: create index without refresh and replicas, load_settings turns them on afterwards
+    """
+    settings = dict(SETTINGS, index=dict(SETTINGS['index']))
+    if bulk_load:
+        settings['index'].update(refresh_interval='-1', number_of_replicas=0)
+    return {'settings': settings, 'mappings': MAPPINGS}
+
+
+def load_settings():
+    return {'index': {'refresh_interval': current_app.config['SEARCH_REFRESH_INTERVAL'],
+                      'number_of_replicas': current_app.config['SEARCH_REPLICAS']}}
+
+
+def rows(doc_type, chunk_size):
+    """
+    Rows of a document type read chunk_size at a time with relationships the document needs
+    """
+    model_name, _, relationships = DOCUMENT_TYPES[doc_type]
+    model = import_string(model_name)
+    query = model.query.options(*[joinedload(getattr(model, name)) for name in relationships])
+    return query.order_by(model.id).yield_per(chunk_size)
+
+
+def actions(index, doc_type, chunk_size):
+    to_document = DOCUMENT_TYPES[doc_type][1]
+    for row in rows(doc_type, chunk_size):
+        document = to_document(row)
+        yield {'_index': index, '_type': doc_type, '_id': document['id'], '_source': document}
+
+
+def _windows(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        window = list(islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def bulk_load(index, chunk_size, threads, progress=None):
+    """
+    Send documents of every type to index, threads bulk requests of chunk_size documents at a time
+    :return: (number of indexed documents, list of failed items)
+    """
+    client = es.current_client()
+    indexed, failed = 0, []
+    for doc_type in sorted(DOCUMENT_TYPES):
+        # parallel_bulk reads all of its actions before sending any, so it is given a few chunks at a time
+        for window in _windows(actions(index, doc_type, chunk_size), chunk_size * threads * 4):
+            for ok, item in parallel_bulk(client, window, thread_count=threads, chunk_size=chunk_size,
+                                          raise_on_error=False):
+                if ok:
+                    indexed += 1
+                else:
+                    failed.append(item)
+            if progress is not None:
+                progress.update(indexed, indexed)
+
+    if progress is not None:
+        progress.update(indexed, indexed, finished=True)
+    return indexed, failed
+
+
+def aliased_indices(alias):
+    if not es.indices.exists_alias(name=alias):
+        return []
+    return sorted(es.indices.get_alias(name=alias))
+
+
+def swap_alias(alias, index):
+    """
+    Point alias to index alone and delete indices it pointed to before
+    """
+    current = aliased_indices(alias)
+    old = [name for name in current if name != index]
+    changes = [{'remove': {'index': name, 'alias': alias}} for name in old]
+    if not current and es.indices.exists(index=alias):
+        # index of the time before aliases is dropped in the same call, so searches always find one of them
+        changes.append({'remove_index': {'index': alias}})
+    changes.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': changes})
+
+    for name in old:
+        es.indices.delete(index=name, ignore=[404])
+
+
+def reindex(chunk_size=None, threads=None, progress=None):
+    """
+    Build a new index from database and swap SEARCH_INDEX alias to it
+    :return: (name of new index, number of indexed documents)
+    """
+    from application.modules import search_sync
+
+    config = current_app.config
+    chunk_size = chunk_size or config['SEARCH_BULK_CHUNK_SIZE']
+    threads = threads or config['SEARCH_BULK_THREADS']
+    alias = config['SEARCH_INDEX']
+    index = '%s-%s' % (alias, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+
+    es.indices.create(index=index, body=index_body(bulk_load=True))
+    # rows changed after being read are sent again by replay
+    search_sync.reindex_started(index)
+    try:
+        indexed, failed = bulk_load(index, chunk_size, threads, progress)
+        failed.extend(search_sync.replay_reindex_changes(index))
+        if failed:
+            raise RuntimeError('%d documents could not be indexed, first one: %s' % (len(failed), failed[0]))
+        es.indices.put_settings(index=index, body=load_settings())
+        es.indices.refresh(index=index)
+
+        swap_alias(alias, index)
+        # changes sent to the old index between last replay and swap
+        failed = search_sync.replay_reindex_changes(index)
+        if failed:
+            search_sync.enqueue(failed)
+    except Exception:
+        if index not in aliased_indices(alias):
+            # alias still points to the old index, the half loaded one is dropped
+            es.indices.delete(index=index, ignore=[404])
+        raise
+    finally:
+        search_sync.reindex_finished()
+
+    return index, indexed
+
+
+class FlaskElasticsearch(BaseFlaskElasticsearch):
+    """
+    Flask-Elasticsearch which keeps one FakeElasticsearch per app when ELASTICSEARCH_HOST is memory://
+    """
+
+    def __init__(self, app=None, **kwargs):
+        self._fakes = {}
+        super(FlaskElasticsearch, self).__init__(app, **kwargs)
+
+    def current_client(self):
+        """
+        Client of current app, for threads without app context (like parallel_bulk workers)
+        """
+        ctx = _app_ctx_stack.top
+        if ctx.app.config.get('ELASTICSEARCH_HOST') == MEMORY_HOST:
+            from application.modules.fake_elasticsearch import FakeElasticsearch
+
+            if id(ctx.app) not in self._fakes:
+                self._fakes.setdefault(id(ctx.app), FakeElasticsearch())
+            return self._fakes[id(ctx.app)]
+
+        # connects on first use
+        super(FlaskElasticsearch, self).__getattr__('transport')
+        return ctx.elasticsearch
+
+    def __getattr__(self, item):
+        if item.startswith('__') or _app_ctx_stack.top is None:
+            return super(FlaskElasticsearch, self).__getattr__(item)
+        return getattr(self.current_client(), item)
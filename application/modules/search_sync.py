@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Keep search index in step with database changes.
+
+    Session listeners (see configure_event_listeners) collect rows of models in search.DOCUMENT_TYPES changed by a
+    flush, and rows pointing to changed models of search.DEPENDENT_MODELS, and after commit add them to
+    SEARCH_SYNC_OUTBOX, a sorted set of <document type>:<id> (or <document type>:<column>:<value>) members scored
+    by time. A row changed many times before it is sent stays one member. ./manager.py search_worker takes the
+    oldest members in batches, reads the rows as they are now and sends them in one bulk request, deleting
+    documents of rows which are gone, so cost follows write rate and not table size.
+    Claimed members are moved to <outbox>:processing until they are sent, a worker which was killed meanwhile
+    queues them again when it starts (so one worker runs per outbox).
+    Changes made while reindex runs are also recorded and sent to the new index before and after the alias swap.
+    Bulk statements (bulk_insert_mappings and the like) are not seen by session listeners.
+    Queueing uses ZADD NX, which needs Redis 3.0.2 or newer.
+"""
+
+# python imports
+from time import time, sleep
+from redis.exceptions import RedisError
+
+# flask imports
+from flask import current_app
+
+# project imports
+from application.extensions import db, redis
+
+
+def _reindex_key(outbox):
+    return '%s:reindex' % outbox
+
+
+def _reindex_changes_key(outbox):
+    return '%s:reindex:changes' % outbox
+
+
+def _processing_key(outbox):
+    return '%s:processing' % outbox
+
+
+def collect_changed_documents(session, flush_context):
+    """
+    Remember documents of rows changed in a flush so they are queued after commit
+    """
+    if not current_app.config['SEARCH_SYNC_ENABLED']:
+        return
+
+    from application.modules.search import changed_documents
+
+    objects = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    members = changed_documents(session.new.union(session.deleted).union(objects))
+    if members:
+        session.info.setdefault('changed_documents', set()).update(members)
+
+
+def enqueue_changed_documents(session):
+    members = session.info.pop('changed_documents', None)
+    if members:
+        # rows are committed already, failing here would only turn a finished request into an error
+        try:
+            enqueue(members)
+        except RedisError as e:
+            current_app.logger.error('Queueing %d changed documents for search sync failed, they are synced on '
+                                     'their next change or reindex: %s' % (len(members), e))
+
+
+def forget_changed_documents(session):
+    session.info.pop('changed_documents', None)
+
+
+def enqueue(members, pipe=None):
+    """
+    Members already queued keep their score, so rows changed all the time are not pushed back behind newer changes
+    :param pipe: redis pipeline to queue members in, it is executed by caller
+    """
+    outbox = current_app.config['SEARCH_SYNC_OUTBOX']
+    now = time()
+    scores = []
+    if current_app.config['REDIS_URL'].startswith('memory://'):
+        # fakeredis 0.7 has no ZADD NX, nothing else changes in process data between reading scores and adding
+        members = list(members)
+        pending = redis.pipeline(transaction=False)
+        for member in members:
+            pending.zscore(outbox, member)
+        for member, score in zip(members, pending.execute()):
+            if score is None:
+                scores.extend((now, member))
+        if scores:
+            (pipe or redis).zadd(outbox, *scores)
+        return
+
+    for member in members:
+        scores.extend((now, member))
+    # redis-py zadd has no NX flag yet
+    (pipe or redis).execute_command('ZADD', outbox, 'NX', *scores)
+
+
+def reindex_started(index):
+    """
+    Record changes sent from now on until reindex_finished, they may be older in index than in database
+    """
+    outbox = current_app.config['SEARCH_SYNC_OUTBOX']
+    redis.pipeline(transaction=True).set(_reindex_key(outbox), index).delete(_reindex_changes_key(outbox)).execute()
+
+
+def replay_reindex_changes(index):
+    """
+    Send changes recorded since reindex_started to index again
+    :return: members which could not be sent
+    """
+    from application.modules.search import index_changes
+
+    outbox = current_app.config['SEARCH_SYNC_OUTBOX']
+    members, _ = redis.pipeline(transaction=True).smembers(_reindex_changes_key(outbox)) \
+        .delete(_reindex_changes_key(outbox)).execute()
+    return index_changes(members, index) if members else []
+
+
+def reindex_finished():
+    outbox = current_app.config['SEARCH_SYNC_OUTBOX']
+    redis.delete(_reindex_key(outbox), _reindex_changes_key(outbox))
+
+
+class SearchSyncWorker(object):
+    def __init__(self, app):
+        self.app = app
+        self.outbox = app.config['SEARCH_SYNC_OUTBOX']
+        self.processing = _processing_key(self.outbox)
+        self.batch_size = app.config['SEARCH_SYNC_BATCH_SIZE']
+        self.interval = app.config['SEARCH_SYNC_INTERVAL']
+        self.index = app.config['SEARCH_INDEX']
+
+    def run(self, once=False):
+        """
+        :param once: stop when outbox is empty instead of waiting for new changes
+        """
+        with self.app.app_context():
+            self.recover()
+            while True:
+                members = self.claim()
+                if members:
+                    self.flush(members)
+                elif once:
+                    break
+                else:
+                    sleep(self.interval)
+
+    def recover(self):
+        """
+        Queue again members claimed by a worker which stopped before sending them, with their first change time
+        """
+        redis.pipeline(transaction=True).zunionstore(self.outbox, [self.outbox, self.processing], aggregate='MIN') \
+            .delete(self.processing).execute()
+
+    def claim(self):
+        """
+        Move the oldest batch from outbox to processing set, a change committed from now on is queued again
+        """
+        def move(pipe):
+            claimed = pipe.zrange(self.outbox, 0, self.batch_size - 1, withscores=True)
+            pipe.multi()
+            if claimed:
+                scores = []
+                for member, score in claimed:
+                    scores.extend((score, member))
+                pipe.zadd(self.processing, *scores)
+                pipe.zrem(self.outbox, *[member for member, _ in claimed])
+            return [member for member, _ in claimed]
+
+        return redis.transaction(move, self.outbox, value_from_callable=True)
+
+    def flush(self, members):
+        from application.modules.search import index_changes
+
+        if redis.exists(_reindex_key(self.outbox)):
+            redis.sadd(_reindex_changes_key(self.outbox), *members)
+
+        try:
+            failed = index_changes(members, self.index)
+        except Exception as e:
+            self.app.logger.error('Search sync of %d documents failed: %s' % (len(members), e))
+            failed = members
+            sleep(self.interval)
+        finally:
+            # rows are read again for the next batch
+            db.session.remove()
+
+        pipe = redis.pipeline(transaction=True)
+        if failed:
+            self.app.logger.warning('%d of %d documents are queued again to be synced' % (len(failed), len(members)))
+            enqueue(failed, pipe)
+        pipe.zrem(self.processing, *members).execute()
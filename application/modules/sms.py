@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Outbound SMS through a Redis backed queue.
+
+    Requests only push messages to the SMS_QUEUE list, a separate worker (./manager.py sms_worker) pops them in
+    batches and hands them to providers configured in SMS_PROVIDERS, each with its own concurrency limit.
+    Failed messages are retried with exponential backoff from a sorted set and dropped to a dead letter list
+    after SMS_MAX_ATTEMPTS tries.
+    A popped batch is kept in <queue>:processing until providers (or the retry set) have it, a worker which was
+    killed meanwhile queues it again when it starts (so one worker runs per queue).
+
+    Providers are classes with a send(message) method returning True if the message was sent, those which can
+    send many messages in one call override send_many(messages) which returns the list of messages which failed.
+"""
+
+# python imports
+import json
+import random
+import threading
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+from time import time, sleep
+
+
+class Provider(object):
+    batch_size = 100
+
+    def __init__(self, **options):
+        self.options = options
+
+    def send(self, message):
+        """
+        :type message dict with 'text' and 'phone'
+        :return: True if message was sent
+        """
+        raise NotImplementedError
+
+    def send_many(self, messages):
+        """
+        Send messages one by one
+        :type messages list of dict with 'text' and 'phone'
+        :return: messages which could not be sent
+        """
+        return [message for message in messages if not self.send(message)]
+
+
+class FakeProvider(Provider):
+    """
+    Keeps sent messages in memory, for tests and load runs
+    :param latency: seconds each batch takes, to mimic a slow provider
+    :param failure_rate: chance of each message to fail
+    """
+
+    def __init__(self, latency=0, failure_rate=0, **options):
+        super(FakeProvider, self).__init__(**options)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+
+    def send_many(self, messages):
+        if self.latency:
+            sleep(self.latency)
+
+        failed = [message for message in messages if random.random() < self.failure_rate]
+        self.sent.extend(message for message in messages if message not in failed)
+        return failed
+
+
+class SMS(object):
+    def __init__(self, app=None):
+        self.on = False
+        self.queue = None
+        self.default_provider = None
+        self.providers = {}
+        self.concurrency = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.on = app.config['SMS_ON']
+        self.queue = app.config['SMS_QUEUE']
+        self.default_provider = app.config['SMS_PROVIDER']
+
+        self.providers = {}
+        self.concurrency = {}
+        for name, config in app.config['SMS_PROVIDERS'].items():
+            config = dict(config)
+            module, _, cls = config.pop('class').rpartition('.')
+            self.concurrency[name] = config.pop('concurrency', 1)
+            self.providers[name] = getattr(import_module(module), cls)(**config)
+
+        app.extensions['sms'] = self
+
+    def message(self, text, phone, provider=None):
+        return {'text': text, 'phone': phone, 'provider': provider or self.default_provider, 'attempts': 0}
+
+    def enqueue(self, text, phone, provider=None, pipe=None):
+        """
+        Queue message for sms worker
+        :param pipe: redis pipeline to queue message in, it is executed by caller
+        """
+        from application.extensions import redis
+
+        # right end of queue is its head, worker takes messages from there with RPOPLPUSH
+        (pipe or redis).lpush(self.queue, json.dumps(self.message(text, phone, provider)))
+
+    def send_one(self, text, phone, provider=None):
+        """
+        Send message right away, blocking until provider answers
+        :return: True if message was sent
+        """
+        message = self.message(text, phone, provider)
+        return not self.providers[message['provider']].send_many([message])
+
+
+class SMSWorker(object):
+    def __init__(self, app, sms):
+        self.app = app
+        self.sms = sms
+        self.queue = sms.queue
+        self.processing = '%s:processing' % sms.queue
+        self.retry_queue = '%s:retry' % sms.queue
+        self.dead_queue = '%s:dead' % sms.queue
+        self.batch_size = app.config['SMS_BATCH_SIZE']
+        self.max_attempts = app.config['SMS_MAX_ATTEMPTS']
+        self.retry_backoff = app.config['SMS_RETRY_BACKOFF']
+
+        self.semaphores = dict((name, threading.BoundedSemaphore(limit)) for name, limit in sms.concurrency.items())
+        self.pool = ThreadPool(sum(sms.concurrency.values()))
+
+    def run(self, once=False):
+        """
+        :param once: stop when queue is empty instead of waiting for new messages
+        """
+        from application.extensions import redis
+
+        self.recover()
+        while True:
+            self.requeue_due()
+            messages = self.pop_batch(block=not once)
+
+            if messages:
+                self.dispatch(messages)
+                # batch is sent or waits in retry set now
+                redis.delete(self.processing)
+            elif once:
+                break
+
+        self.pool.close()
+        self.pool.join()
+
+    def recover(self):
+        """
+        Queue again the batch of a worker which stopped before handing it to providers
+        """
+        from application.extensions import redis
+
+        # processing list holds the batch newest first, pushed in this order its oldest message is the head again
+        raw = redis.lrange(self.processing, 0, -1)
+        if raw:
+            redis.pipeline(transaction=True).rpush(self.queue, *raw).delete(self.processing).execute()
+
+    def pop_batch(self, block=True):
+        """
+        Move a batch from queue to processing list
+        """
+        from application.extensions import redis
+
+        if block:
+            first = redis.brpoplpush(self.queue, self.processing, timeout=1)
+        else:
+            first = redis.rpoplpush(self.queue, self.processing)
+        if first is None:
+            return []
+
+        pipe = redis.pipeline(transaction=False)
+        for _ in range(self.batch_size - 1):
+            pipe.rpoplpush(self.queue, self.processing)
+        rest = [raw for raw in pipe.execute() if raw is not None]
+        return [json.loads(raw) for raw in [first] + rest]
+
+    def dispatch(self, messages):
+        by_provider = {}
+        for message in messages:
+            by_provider.setdefault(message['provider'], []).append(message)
+
+        results = []
+        for name, provider_messages in by_provider.items():
+            provider = self.sms.providers[name]
+            for idx in range(0, len(provider_messages), provider.batch_size):
+                chunk = provider_messages[idx:idx + provider.batch_size]
+                results.append(self.pool.apply_async(self.send, (name, chunk)))
+
+        for result in results:
+            result.get()
+
+    def send(self, name, messages):
+        with self.semaphores[name]:
+            try:
+                failed = self.sms.providers[name].send_many(messages)
+            except Exception as e:
+                self.app.logger.error('SMS provider %s failed: %s' % (name, e))
+                failed = messages
+
+        if failed:
+            self.retry(failed)
+
+    def retry(self, messages):
+        from application.extensions import redis
+
+        pipe = redis.pipeline()
+        for message in messages:
+            message['attempts'] += 1
+            if message['attempts'] >= self.max_attempts:
+                self.app.logger.error('SMS to %s dropped after %d attempts' % (message['phone'], message['attempts']))
+                pipe.rpush(self.dead_queue, json.dumps(message))
+            else:
+                retry_at = time() + self.retry_backoff * 2 ** (message['attempts'] - 1)
+                pipe.zadd(self.retry_queue, retry_at, json.dumps(message))
+        pipe.execute()
+
+    def requeue_due(self):
+        """
+        Move messages which their backoff is over back to queue
+        """
+        from application.extensions import redis
+
+        for raw in redis.zrangebyscore(self.retry_queue, 0, time()):
+            # only the worker which removes message from retry set queues it again
+            if redis.zrem(self.retry_queue, raw):
+                redis.lpush(self.queue, raw)
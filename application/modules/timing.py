@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Per request timing of hot path phases.
+
+    TIMING_SAMPLE_RATE of requests get a recorder which phases report their time to:
+    auth (access token lookup), db (SQL statements), redis (commands, a pipeline is one round trip),
+    validation (request schema), serialize (to_json and JSON encoding) and compress.
+    Phases may overlap (token lookup runs Redis commands) so their times are not meant to add up to total.
+
+    Timed requests are aggregated per worker into per endpoint histograms shown by GET /api/v1/stats and,
+    with TIMING_HEADER, sent back in a Server-Timing header. Requests which are not sampled only pay for
+    checking there is no recorder.
+"""
+
+# python imports
+import random
+import threading
+from bisect import bisect_left
+from time import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# flask imports
+from flask import _app_ctx_stack, g, request
+
+PHASES = ('auth', 'db', 'redis', 'validation', 'serialize', 'compress')
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class Recorder(object):
+    def __init__(self, timing, endpoint):
+        self.timing = timing
+        self.endpoint = endpoint
+        self.started = time()
+        # phase: [seconds, calls]
+        self.phases = {}
+
+    def add(self, name, seconds, calls=1):
+        spent = self.phases.get(name)
+        if spent is None:
+            self.phases[name] = [seconds, calls]
+        else:
+            spent[0] += seconds
+            spent[1] += calls
+
+    def add_after_response(self, name, seconds):
+        """
+        Add a phase which runs out of app (WSGI middleware) once the request is aggregated
+        """
+        self.timing.add(self.endpoint, name, seconds)
+
+    def server_timing(self, total):
+        metrics = ['%s;dur=%.2f;desc="%d"' % (name, self.phases[name][0] * 1000, self.phases[name][1])
+                   for name in PHASES if name in self.phases]
+        metrics.append('total;dur=%.2f' % (total * 1000))
+        return ', '.join(metrics)
+
+
+def current():
+    """
+    Recorder of current request or None when request is not sampled (or there is no request)
+    """
+    ctx = _app_ctx_stack.top
+    return getattr(ctx.g, 'timing', None) if ctx is not None else None
+
+
+class phase(object):
+    """
+    Time a block as part of phase name when current request is sampled
+    :param calls: number of calls (statements, commands, ...) the block makes
+    """
+    __slots__ = ('name', 'calls', 'recorder', 'started')
+
+    def __init__(self, name, calls=1):
+        self.name = name
+        self.calls = calls
+
+    def __enter__(self):
+        self.recorder = current()
+        if self.recorder is not None:
+            self.started = time()
+
+    def __exit__(self, *exc_info):
+        if self.recorder is not None:
+            self.recorder.add(self.name, time() - self.started, self.calls)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.samples = 0
+        self.calls = 0
+        self.total_ms = 0.0
+
+    def add(self, ms, calls):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.samples += 1
+        self.calls += calls
+        self.total_ms += ms
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket percent of samples fall in
+        """
+        rank = self.samples * percent / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS_MS[idx] if idx < len(BUCKETS_MS) else None
+        return None
+
+    def to_json(self):
+        return {
+            'samples': self.samples,
+            'calls': self.calls,
+            'mean_ms': round(self.total_ms / self.samples, 3) if self.samples else 0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            # [upper bound in ms, samples], last bucket has no bound
+            'buckets': [[bound, count] for bound, count in zip(BUCKETS_MS + (None,), self.counts)],
+        }
+
+
+class Timing(object):
+    def __init__(self, app=None):
+        self.enabled = False
+        self.sample_rate = 0
+        self.header = False
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['TIMING_ENABLED']
+        self.sample_rate = app.config['TIMING_SAMPLE_RATE']
+        self.header = app.config['TIMING_HEADER']
+
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+            if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+                event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+        app.extensions['timing'] = self
+
+    def _before_request(self):
+        if random.random() < self.sample_rate:
+            g.timing = Recorder(self, request.endpoint or '<unmatched>')
+            # compress middleware reports to recorder after request context is gone
+            request.environ['timing.recorder'] = g.timing
+
+    def _after_request(self, response):
+        recorder = current()
+        if recorder is not None:
+            total = time() - recorder.started
+            self.add(recorder.endpoint, 'total', total)
+            for name, (seconds, calls) in recorder.phases.items():
+                self.add(recorder.endpoint, name, seconds, calls)
+
+            if self.header:
+                response.headers['Server-Timing'] = recorder.server_timing(total)
+        return response
+
+    def add(self, endpoint, name, seconds, calls=1):
+        with self._lock:
+            histogram = self.histograms.setdefault(endpoint, {}).get(name)
+            if histogram is None:
+                histogram = self.histograms[endpoint][name] = Histogram()
+            histogram.add(seconds * 1000, calls)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((endpoint, dict((name, histogram.to_json()) for name, histogram in phases.items()))
+                        for endpoint, phases in self.histograms.items())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        conn.info.setdefault('timing_started', []).append(time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    recorder = current()
+    started = conn.info.get('timing_started')
+    if recorder is not None and started:
+        recorder.add('db', time() - started.pop())
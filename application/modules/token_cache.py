@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Per worker access token cache which sits in front of Redis 'uat:<token>' keys.
+
+    Every worker keeps token -> user_id pairs (and unknown tokens for a short time) in memory,
+    next to a short lived cache of serialized user rows.
+    Revocations and row changes are published on a Redis channel and every worker listening on it
+    drops the matching entries. A worker which is not subscribed (yet, or anymore) never answers from cache.
+    Callers read generation (or user_generation) before reading Redis or database and pass it to set (or set_user),
+    an invalidation applied meanwhile changes it so the value read before it is not cached.
+"""
+
+# python imports
+import os
+import threading
+from time import time
+
+# project imports
+from application.modules.local_cache import LocalCache, MISSING
+
+
+class TokenCache(object):
+    def __init__(self, app=None):
+        self.enabled = False
+        self.cache = None
+        self.users = None
+        self.channel = None
+        self.timeout = None
+        self.negative_timeout = None
+        self.logger = None
+        # increased by every applied invalidation of tokens and of user rows
+        self.generation = 0
+        self.user_generation = 0
+
+        self._pid = None
+        self._ready = False
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        # listener and request threads change generations, checking one and caching happen under it too
+        self._generation_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['TOKEN_CACHE_ENABLED']
+        self.timeout = app.config['TOKEN_CACHE_TIMEOUT']
+        self.negative_timeout = app.config['TOKEN_CACHE_NEGATIVE_TIMEOUT']
+        self.channel = app.config['TOKEN_CACHE_CHANNEL']
+        self.cache = LocalCache(app.config['TOKEN_CACHE_SIZE'], self.timeout)
+        self.users = LocalCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TIMEOUT'])
+        self.logger = app.logger
+
+        app.extensions['token_cache'] = self
+
+    def get(self, access_token):
+        """
+        :return: cached user id, None for a known bad token or MISSING if cache can not answer
+        """
+        if not self.enabled or not self._listening():
+            return MISSING
+        return self.cache.get(access_token)
+
+    def set(self, access_token, user_id, ttl=None, generation=None):
+        """
+        :param ttl: remaining life time of token in seconds, cached entry never outlives it
+        :param generation: value of generation before user_id was read, nothing is cached if it changed since
+        """
+        if not self.enabled or not self._ready:
+            return
+
+        with self._generation_lock:
+            if generation is not None and generation != self.generation:
+                return
+            if user_id is None:
+                self.cache.set(access_token, None, self.negative_timeout)
+            else:
+                timeout = self.timeout if ttl is None or ttl < 0 else min(ttl, self.timeout)
+                self.cache.set(access_token, str(user_id), timeout)
+
+    def get_user(self, user_id):
+        """
+        :return: cached serialized user row or MISSING
+        """
+        if not self.enabled or not self._listening():
+            return MISSING
+        return self.users.get(str(user_id))
+
+    def set_user(self, user_id, json, generation=None):
+        """
+        :param generation: value of user_generation before row was read, nothing is cached if it changed since
+        """
+        if not self.enabled or not self._ready:
+            return
+
+        with self._generation_lock:
+            if generation is None or generation == self.user_generation:
+                self.users.set(str(user_id), json)
+
+    def invalidate_user_row(self, user_id):
+        """
+        Drop serialized user row from all workers
+        """
+        self._publish('r:%s' % user_id)
+
+    def invalidate(self, access_token, pipe=None):
+        """
+        Drop a single token from all workers
+        :param pipe: redis pipeline to publish in, it is executed by caller
+        """
+        self._publish('t:%s' % access_token, pipe)
+
+    def invalidate_user(self, user_id, pipe=None):
+        """
+        Drop every token of a user from all workers
+        :param pipe: redis pipeline to publish in, it is executed by caller
+        """
+        self._publish('u:%s' % user_id, pipe)
+
+    def _publish(self, message, pipe=None):
+        from application.extensions import redis
+
+        self._apply(message)
+        if self.enabled:
+            (pipe or redis).publish(self.channel, message)
+
+    def _apply(self, message):
+        if self.cache is None:
+            # init_app never ran, there is nothing to drop
+            return
+
+        kind, _, value = message.partition(':')
+
+        with self._generation_lock:
+            if kind == 't':
+                self.generation += 1
+                self.cache.delete(value)
+            elif kind == 'u':
+                self.generation += 1
+                self.cache.delete_if(lambda _, user_id: user_id == value)
+            elif kind == 'r':
+                self.user_generation += 1
+                self.users.delete(value)
+
+    def _listening(self):
+        # listener thread is started lazily so each forked uWSGI worker subscribes on its own
+        if self._pid == os.getpid():
+            return self._ready
+
+        with self._lock:
+            if self._pid != os.getpid() and self._retry_at <= time():
+                self._pid = os.getpid()
+                self._ready = False
+                self.cache.clear()
+                self.users.clear()
+
+                listener = threading.Thread(target=self._listen, name='token-cache-listener')
+                listener.daemon = True
+                listener.start()
+
+        return self._ready
+
+    def _listen(self):
+        from application.extensions import redis
+
+        try:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            self._ready = True
+
+            for message in pubsub.listen():
+                self._apply(message['data'])
+        except Exception as e:
+            self.logger.error('Token cache listener stopped: %s' % e)
+        finally:
+            # anything cached from now on could miss a revocation so stop using cache and retry later
+            self._ready = False
+            self._pid = None
+            self._retry_at = time() + self.negative_timeout
+            with self._generation_lock:
+                self.generation += 1
+                self.user_generation += 1
+                self.cache.clear()
+                self.users.clear()
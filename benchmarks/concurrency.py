@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Load test running servers with concurrent keep-alive clients, to compare concurrency modes (CONCURRENCY).
+    Start each server the way it is deployed (uwsgi --ini uwsgi.ini / uwsgi-threads.ini / uwsgi-gevent.ini,
+    with an http-socket) and give every one of them a label:
+
+    $ python -m benchmarks.concurrency --clients 64 --duration 20 \\
+        prefork=http://127.0.0.1:9001 threads=http://127.0.0.1:9002 gevent=http://127.0.0.1:9003
+
+    The authenticate scenario creates users with random phone numbers so run it against a disposable database.
+"""
+
+# python imports
+import argparse
+import json
+import random
+import threading
+from time import time
+
+try:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+
+SCENARIOS = {
+    # database, Redis and SMS queue work for each request
+    'authenticate': lambda args: ('POST', '/api/v1/user/authenticate',
+                                  json.dumps({'phone': '09%09d' % random.randint(0, 999999999)})),
+    'profile': lambda args: ('GET', '/api/v1/user', None),
+    'status': lambda args: ('GET', '/api/v1', None),
+}
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))] if values else 0
+
+
+def client(url, args, deadline, latencies, errors):
+    parsed = urlparse(url)
+    connection = HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+    headers = {'Content-Type': 'application/json'}
+    if args.access_token:
+        headers['Access-Token'] = args.access_token
+
+    while time() < deadline:
+        method, path, body = SCENARIOS[args.scenario](args)
+        started = time()
+        try:
+            connection.request(method, parsed.path.rstrip('/') + path, body, headers)
+            response = connection.getresponse()
+            response.read()
+        except Exception:
+            errors.append(1)
+            connection.close()
+            continue
+
+        if response.status >= 500:
+            errors.append(1)
+        else:
+            latencies.append(time() - started)
+
+
+def run(url, args):
+    latencies, errors = [], []
+    deadline = time() + args.duration
+    threads = [threading.Thread(target=client, args=(url, args, deadline, latencies, errors))
+               for _ in range(args.clients)]
+
+    started = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+
+    latencies.sort()
+    return len(latencies) / elapsed, percentile(latencies, 50), percentile(latencies, 99), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='+', metavar='label=url')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='authenticate')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--access-token', help='Access-Token header for profile scenario')
+    args = parser.parse_args()
+
+    print('{:10s} {:>10s} {:>10s} {:>10s} {:>8s}'.format('Target', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for target in args.targets:
+        label, _, url = target.partition('=')
+        throughput, p50, p99, errors = run(url, args)
+        print('{:10s} {:10.1f} {:10.1f} {:10.1f} {:8d}'.format(label, throughput, p50 * 1000, p99 * 1000, errors))
+
+
+if __name__ == '__main__':
+    main()
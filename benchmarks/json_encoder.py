@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Compare JSON encoder backends on a paginated list of users, the way jsonify serializes it.
+
+    $ python -m benchmarks.json_encoder --items 1000 --repeat 20
+"""
+
+# python imports
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+# flask imports
+from flask import Flask, json
+
+# project imports
+from application.modules.json_encoder import available_backends, make_encoder
+
+
+def payload(items):
+    registered_at = datetime(2016, 1, 1)
+    users = [{'user_name': u'user%d' % idx,
+              'real_name': u'کاربر شماره %d' % idx,
+              'phone': '09%09d' % idx,
+              'registered_at': registered_at + timedelta(minutes=idx),
+              'coupon_count': idx % 7,
+              'national_code': None,
+              'has_password': idx % 2 == 0} for idx in range(items)]
+    return {'users': users, 'meta': {'page': 1, 'per_page': items, 'total': items, 'pages': 1}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    data = payload(args.items)
+
+    print('{:12s} {:8s} {:>12s} {:>12s}'.format('Backend', 'Compact', 'ms/response', 'bytes'))
+    for backend in available_backends():
+        for compact in (False, True):
+            app.json_encoder = make_encoder(backend, compact)
+            # same arguments jsonify passes in production (no indent) and debug (indent=2)
+            indent = None if compact else 2
+
+            with app.app_context():
+                body = json.dumps(data, indent=indent)
+                seconds = min(timeit.repeat(lambda: json.dumps(data, indent=indent), number=1, repeat=args.repeat))
+
+            print('{:12s} {:8s} {:12.3f} {:12d}'.format(backend, str(compact), seconds * 1000, len(body)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Cost of validating one request body, per schema, the way Flask-JsonSchema did it (jsonschema.validate,
+    which checks the schema and builds a validator every time) against validators built once and kept in memory.
+
+    $ python -m benchmarks.schema_validation --number 2000
+"""
+
+# python imports
+import argparse
+import timeit
+from jsonschema import Draft4Validator, validate as jsonschema_validate
+
+# project imports
+from application import jsons
+from application.modules.schema_validator import uncamelize
+
+SAMPLES = {
+    'authenticate': {'phone': '09123456789'},
+    'web_authenticate': {'phone': '09123456789', 'password': '123456'},
+    'activate': {'phone': '09123456789', 'code': '12345'},
+    'refresh': {'access': '33c002af-0939-4c3d-89f4-d3ab7676d978', 'refresh': '82e53034-3552-4b68-8ded-3be2da7753d7'},
+    'edit_info': {'user_name': 'rishe', 'real_name': 'Rishe', 'national_code': '4360400071'},
+    'create_password': {'new_password': '123123'},
+    'edit_password': {'old_password': '123123', 'new_password': '321321'},
+    'delete_password': {'old_password': '123123'},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{:20s} {:>14s} {:>14s}'.format('Schema', 'per request us', 'compiled us'))
+    for name in jsons.__all__:
+        key = uncamelize(name)
+        if key not in SAMPLES:
+            continue
+
+        schema = getattr(jsons, name).get_schema(ordered=True)
+        validator = Draft4Validator(schema)
+        instance = SAMPLES[key]
+
+        per_request = timeit.timeit(lambda: jsonschema_validate(instance, schema), number=args.number)
+        compiled = timeit.timeit(lambda: validator.validate(instance), number=args.number)
+
+        print('{:20s} {:14.1f} {:14.1f}'.format(key, per_request * 1e6 / args.number, compiled * 1e6 / args.number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Where create_app spends its startup time: importing application package, every configure_* phase of
+    create_app, every extension init_app and the slowest modules imported on the way.
+    Imports are only cold in a fresh interpreter, so run it as its own process.
+
+    $ python -m benchmarks.startup --config DeploymentConfig
+    $ ./manager.py startup --config DeploymentConfig
+
+    With --all every config class of application.config is booted in its own interpreter and checked against
+    the budget: import and create_app time, resident memory after boot and modules which must never be imported
+    (dev only ones), exit status is 1 when budget is exceeded.
+
+    $ python -m benchmarks.startup --all --max-create-app-ms 300
+"""
+
+# python imports
+import argparse
+import json
+import resource
+import subprocess
+import sys
+from functools import wraps
+from time import time
+
+# dev only packages (fake data, scraping, bug reports) which production startup must not import
+FORBIDDEN_IMPORTS = ('faker', 'mixer', 'trello', 'scrapy')
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+
+class ImportTimer(object):
+    """
+    Time of every module imported for the first time, including modules it imports
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self._import = None
+
+    def __enter__(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.__import__ = self._import
+
+    def timed_import(self, name, globals=None, *args, **kwargs):
+        package = (globals or {}).get('__package__') or (globals or {}).get('__name__', '')
+        loaded = name in sys.modules or '%s.%s' % (package, name) in sys.modules
+
+        started = time()
+        try:
+            return self._import(name, globals, *args, **kwargs)
+        finally:
+            if name and not loaded:
+                if name not in sys.modules and '%s.%s' % (package, name) in sys.modules:
+                    name = '%s.%s' % (package, name)
+                self.modules[name] = self.modules.get(name, 0) + time() - started
+
+
+def timed(timings, name, f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        started = time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            timings.append((name, time() - started))
+
+    return wrapper
+
+
+def init_app_of(extension):
+    from application.modules.lazy import LazyExtension
+
+    if isinstance(extension, LazyExtension):
+        # package of a lazy extension is imported (and timed) when it is initialized
+        return lambda *args, **kwargs: extension._get_instance().init_app(*args, **kwargs)
+    return extension.init_app
+
+
+def profile(config_name):
+    """
+    :return: list of (phase, seconds) and dict of imported module to seconds
+    """
+    timings = []
+
+    with ImportTimer() as imports:
+        started = time()
+        import application
+        from application import config, extensions
+        timings.append(('import application', time() - started))
+
+        # create_app looks configure_* functions up when it is called
+        for name in dir(application):
+            if name.startswith('configure_'):
+                setattr(application, name, timed(timings, '  ' + name, getattr(application, name)))
+
+        configuration = getattr(config, config_name)
+        for name in set(configuration.EXTENSIONS) | {'redis'}:
+            extension = getattr(extensions, name, None)
+            if extension is not None:
+                extension.init_app = timed(timings, '    init %s' % name, init_app_of(extension))
+
+        started = time()
+        application.create_app(configuration)
+        timings.append(('create_app', time() - started))
+
+    return timings, imports.modules
+
+
+def rss_mb():
+    """
+    Resident memory of this process (peak memory where /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024
+    except IOError:
+        # bytes on OS X, kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024.0 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def summary(config_name):
+    """
+    Boot app with config in this process
+    :rtype dict
+    """
+    from application import config
+
+    if getattr(config, config_name).CONCURRENCY == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            return {'skipped': 'gevent is not installed'}
+
+        monkey.patch_all()
+
+    timings, modules = profile(config_name)
+    timings = dict(timings)
+    return {
+        'import_ms': timings['import application'] * 1000,
+        'create_app_ms': timings['create_app'] * 1000,
+        'rss_mb': rss_mb(),
+        'forbidden': sorted(set(name.split('.')[0] for name in sys.modules
+                                if name.split('.')[0] in FORBIDDEN_IMPORTS and sys.modules[name] is not None)),
+    }
+
+
+def config_names():
+    from application import config
+
+    return sorted(name for name, value in vars(config).items()
+                  if isinstance(value, type) and issubclass(value, config.DefaultConfig))
+
+
+def check_budget(args):
+    """
+    :return: True if every config is in budget
+    """
+    in_budget = True
+    print('{:28s} {:>10s} {:>14s} {:>8s}  {}'.format('Config', 'import ms', 'create_app ms', 'RSS MB', 'Problems'))
+
+    for name in config_names():
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.startup', '--config', name, '--json'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        if process.returncode:
+            print('{:28s} failed to boot: {}'.format(name, error.strip().splitlines()[-1]))
+            in_budget = False
+            continue
+
+        result = json.loads(output.strip().splitlines()[-1])
+        if 'skipped' in result:
+            print('{:28s} skipped: {}'.format(name, result['skipped']))
+            continue
+
+        problems = ['imports %s' % ', '.join(result['forbidden'])] if result['forbidden'] else []
+        for key, limit in (('import_ms', args.max_import_ms), ('create_app_ms', args.max_create_app_ms),
+                           ('rss_mb', args.max_rss_mb)):
+            if result[key] > limit:
+                problems.append('%s over %s' % (key, limit))
+
+        in_budget = in_budget and not problems
+        print('{:28s} {:10.1f} {:14.1f} {:8.1f}  {}'.format(name, result['import_ms'], result['create_app_ms'],
+                                                           result['rss_mb'], '; '.join(problems) or 'OK'))
+
+    return in_budget
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='DeploymentConfig')
+    parser.add_argument('--imports', type=int, default=15, help='number of slowest imports to show')
+    parser.add_argument('--json', action='store_true', help='print summary of --config as json')
+    parser.add_argument('--all', action='store_true', help='check every config class against budget')
+    parser.add_argument('--max-import-ms', type=float, default=500)
+    parser.add_argument('--max-create-app-ms', type=float, default=500)
+    parser.add_argument('--max-rss-mb', type=float, default=100)
+    args = parser.parse_args()
+
+    if args.all:
+        sys.exit(0 if check_budget(args) else 1)
+
+    if args.json:
+        print(json.dumps(summary(args.config)))
+        return
+
+    timings, modules = profile(args.config)
+
+    print('{:40s} {:>10s}'.format('Phase', 'ms'))
+    for name, seconds in timings:
+        print('{:40s} {:10.1f}'.format(name, seconds * 1000))
+
+    print('\n{:40s} {:>10s}'.format('Slowest imports (with their imports)', 'ms'))
+    for name, seconds in sorted(modules.items(), key=lambda item: -item[1])[:args.imports]:
+        print('{:40s} {:10.1f}'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
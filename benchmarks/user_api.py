@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Latency and throughput of the user API flow (authenticate, activate, profile, edit_info, refresh, revoke),
+    in process through the WSGI app and against a locally spawned server with several worker processes.
+    It runs offline on a temporary SQLite database and in memory Redis (memory://, fakeredis).
+
+    $ python -m benchmarks.user_api --users 200 --concurrency 8 --workers 4
+    $ python -m benchmarks.user_api --compare benchmarks/results/user_api-1a2b3c4.json
+
+    Results are written to benchmarks/results/user_api-<commit>.json so runs of two commits can be compared.
+"""
+
+# python imports
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from time import time
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+# project imports
+from benchmarks.concurrency import percentile
+
+ENDPOINTS = ('authenticate', 'activate', 'profile', 'edit_info', 'refresh', 'revoke')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def make_config(database, redis_url):
+    from application.config import TestingConfig
+
+    class BenchmarkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///%s' % database
+        REDIS_URL = redis_url
+        # memory Redis is not shared between server workers, signed tokens are valid in all of them
+        ACCESS_TOKEN_SIGNED = True
+        LAZY_VIEWS = False
+
+    return BenchmarkConfig
+
+
+class InProcessClient(object):
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, body, headers):
+        response = self.client.open(path, method=method, data=body, headers=headers)
+        return response.status_code, response.data
+
+
+class HTTPClient(object):
+    def __init__(self, port):
+        self.connection = HTTPConnection('127.0.0.1', port, timeout=30)
+
+    def request(self, method, path, body, headers):
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            self.connection.close()
+            raise
+
+
+def user_flow(client, phone, record):
+    """
+    Run the whole flow for one user, recording (endpoint, seconds, ok) of each request
+    """
+    headers = {'Content-Type': 'application/json'}
+
+    def call(endpoint, method, path, body=None, expected=200):
+        started = time()
+        try:
+            status, data = client.request(method, path, json.dumps(body) if body is not None else None, headers)
+        except Exception:
+            status, data = None, None
+        record(endpoint, time() - started, status == expected)
+        return json.loads(data) if status == expected and data else None
+
+    if call('authenticate', 'POST', '/api/v1/user/authenticate', {'phone': phone}, 201) is None:
+        return
+
+    # development code, activation code itself is not readable from a separate server process
+    tokens = call('activate', 'POST', '/api/v1/user/activate', {'phone': phone, 'code': '13740'}, 201)
+    if tokens is None:
+        return
+    headers['Access-Token'] = tokens['access']
+
+    call('profile', 'GET', '/api/v1/user')
+    call('edit_info', 'PUT', '/api/v1/user', {'real_name': u'Benchmark %s' % phone})
+
+    refreshed = call('refresh', 'POST', '/api/v1/user/refresh',
+                     {'access': tokens['access'], 'refresh': tokens['refresh']})
+    if refreshed is not None:
+        headers['Access-Token'] = refreshed['access']
+
+    call('revoke', 'DELETE', '/api/v1/user/revoke')
+
+
+def run(make_client, users, concurrency):
+    samples = dict((endpoint, []) for endpoint in ENDPOINTS)
+    errors = dict((endpoint, 0) for endpoint in ENDPOINTS)
+    lock = threading.Lock()
+    first = random.randint(0, 10 ** 9 - users)
+    phones = iter(['09%09d' % number for number in range(first, first + users)])
+
+    def record(endpoint, seconds, ok):
+        with lock:
+            if ok:
+                samples[endpoint].append(seconds)
+            else:
+                errors[endpoint] += 1
+
+    def worker():
+        client = make_client()
+        while True:
+            with lock:
+                phone = next(phones, None)
+            if phone is None:
+                return
+            user_flow(client, phone, record)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+
+    results = {}
+    for endpoint in ENDPOINTS:
+        values = sorted(samples[endpoint])
+        results[endpoint] = {
+            'requests': len(values),
+            'errors': errors[endpoint],
+            'throughput': round(len(values) / elapsed, 2),
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p95_ms': round(percentile(values, 95) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+        }
+    return results
+
+
+def prepare(config):
+    from application import create_app
+    from application.extensions import db
+
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        # server workers must not share database connections of this process
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return app
+
+
+def run_in_process(config, args):
+    app = prepare(config)
+    return run(lambda: InProcessClient(app), args.users, args.concurrency)
+
+
+def run_server(config, args):
+    """
+    Prefork server: every worker process accepts connections of the same listening socket
+    """
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = prepare(config)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    port = listener.getsockname()[1]
+
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            server = make_server('127.0.0.1', port, app, request_handler=QuietRequestHandler, fd=listener.fileno())
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    try:
+        return run(lambda: HTTPClient(port), args.users, args.concurrency)
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        listener.close()
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(mode, results, baseline=None):
+    print('\n%s' % mode)
+    print('{:14s} {:>9s} {:>9s} {:>9s} {:>9s} {:>7s}'.format('Endpoint', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                             'errors'))
+    for endpoint in ENDPOINTS:
+        result = results[endpoint]
+        line = '{:14s} {:9.1f} {:9.2f} {:9.2f} {:9.2f} {:7d}'.format(
+            endpoint, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors'])
+        if baseline and endpoint in baseline and baseline[endpoint]['p99_ms']:
+            line += '   p99 {:+.0%}'.format(result['p99_ms'] / baseline[endpoint]['p99_ms'] - 1)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='user flows to run in each mode')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes of spawned server')
+    parser.add_argument('--mode', choices=('all', 'inprocess', 'server'), default='all')
+    parser.add_argument('--redis-url', default='memory://')
+    parser.add_argument('--output', help='results file, benchmarks/results/user_api-<commit>.json by default')
+    parser.add_argument('--compare', help='results file of another run to compare p99 with')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    database = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False).name
+    config = make_config(database, args.redis_url)
+    modes = [('inprocess', run_in_process), ('server', run_server)]
+
+    results = {}
+    try:
+        for mode, runner in modes:
+            if args.mode in ('all', mode):
+                results[mode] = runner(config, args)
+                print_results(mode, results[mode], baseline.get(mode))
+    finally:
+        os.remove(database)
+
+    output = args.output or os.path.join(RESULTS_DIR, 'user_api-%s.json' % commit())
+    if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump({'commit': commit(), 'created_at': datetime.utcnow().isoformat(), 'python': sys.version.split()[0],
+                   'arguments': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+    print('\nResults written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
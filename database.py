@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 
 # python imports
+import sys
+
 # flask imports
-from flask.ext.script import Manager, prompt_bool
+from flask.ext.script import Manager, Command, Option, prompt_bool
 
 # project imports
-from application.extensions import db, redis, es
+from application.extensions import db, redis
 
 manager = Manager(usage="Perform database operations")
 
+# models export and import commands move, in the order they are imported
+TRANSFER_MODELS = ('user', 'token')
+
 
 @manager.command
 def drop():
@@ -33,110 +38,106 @@ def recreate():
     create()
 
 
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=None, help='documents per bulk request')
+@manager.option('-t', '--threads', dest='threads', type=int, default=None, help='bulk requests sent at the same time')
+def reindex(chunk_size, threads):
+    """
+    Build search index from database and swap search alias to it without downtime
+    """
+    from application.modules.data_transfer import Progress
+    from application.modules.search import reindex as build
+
+    index, indexed = build(chunk_size, threads, Progress('reindex'))
+    print('%d documents indexed in %s' % (indexed, index))
+
+
 @manager.command
 def update():
-    es.indices.delete(index='example', ignore=[400, 404])
-
-    body = {
-        "settings": {
-            "index": {"max_result_window": 500000},
-            "analysis": {
-                "char_filter": {
-                    "zero_width_spaces": {
-                        "type": "mapping",
-                        "mappings": ["\\u200C=> "]
-                    }
-                },
-                "filter": {
-                    "nGram_filter": {
-                        "type": "nGram",
-                        "min_gram": 2,
-                        "max_gram": 50,
-                        "token_chars": [
-                            "letter",
-                            "digit",
-                            "punctuation",
-                            "symbol"]
-                    },
-                    "persian_stop": {
-                        "type": "stop",
-                        "stopwords": "_persian_"
-                    }
-
-                },
-                "analyzer": {
-                    "nGram_analyzer": {
-                        "type": "custom",
-                        "tokenizer": "whitespace",
-                        "filter": [
-                            "lowercase",
-                            "asciifolding",
-                            "arabic_normalization",
-                            "persian_normalization",
-                            "persian_stop",
-                            "nGram_filter"
-                        ]
-                    },
-                    "whitespace_analyzer": {
-                        "type": "custom",
-                        "tokenizer": "whitespace",
-                        "filter": [
-                            "lowercase",
-                            "asciifolding",
-                            "arabic_normalization",
-                            "persian_normalization",
-                            "persian_stop"
-                        ]
-                    }
-                }
-            }
-        },
-        "mappings": {
-            "player": {
-                "_all": {
-                    "analyzer": "nGram_analyzer",
-                    "search_analyzer": "whitespace_analyzer"
-                },
-                "properties": {
-                    "id": {
-                        "type": "integer",
-                        "index": "no",
-                        "include_in_all": False
-                    },
-                    "name_fa": {
-                        "type": "string",
-                        "index": "not_analyzed"
-                    },
-                    "name_en": {
-                        "type": "string",
-                        "index": "not_analyzed"
-                    },
-                    "post": {
-                        "type": "string",
-                        "index": "not_analyzed"
-                    },
-                    "price": {
-                        "type": "double",
-                        "include_in_all": False
-                    },
-                    "team": {
-                        "type": "string",
-                        "index": "not_analyzed",
-                    }
-                }
-            }
-        }
-    }
-
-    es.indices.create(index='example', body=body)
+    """
+    Rebuild search index (same as reindex with default options)
+    """
+    reindex(None, None)
 
 
-@manager.command
-def fake():
+def _transfer_model(name):
+    from application.models import User, Token
+
+    return {'user': User, 'token': Token}[name]
+
+
+@manager.option('-m', '--model', dest='model', choices=TRANSFER_MODELS, required=True)
+@manager.option('-o', '--output', dest='output', default='-', help='file to write to, stdout by default')
+@manager.option('-f', '--format', dest='fmt', choices=('ndjson', 'csv'), default='ndjson')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=5000, help='rows fetched per round trip')
+def export(model, output, fmt, batch_size):
+    """
+    Stream rows of a model table to a NDJSON or CSV file with flat memory use
+    """
+    from application.modules.data_transfer import Progress, export_rows
+
+    if output == '-':
+        export_rows(_transfer_model(model), sys.stdout, fmt, batch_size)
+        return
+
+    with open(output, 'w') as f:
+        export_rows(_transfer_model(model), f, fmt, batch_size, Progress('export %s' % model))
+
+
+class Import(Command):
+    """
+    Insert rows exported by export command in committed batches, import users before tokens
+    """
+
+    option_list = (
+        Option('-m', '--model', dest='model', choices=TRANSFER_MODELS, required=True),
+        Option('-i', '--input', dest='path', required=True, help='file written by export'),
+        Option('-f', '--format', dest='fmt', choices=('ndjson', 'csv'), default='ndjson'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=5000, help='rows committed at a time'),
+        Option('-r', '--resume', dest='resume', action='store_true', default=False,
+               help='continue after the last batch an interrupted import committed'),
+    )
+
+    def run(self, model, path, fmt, batch_size, resume):
+        from application.modules.data_transfer import Progress, import_rows
+
+        import_rows(_transfer_model(model), path, fmt, batch_size, resume, Progress('import %s' % model))
+
+
+# import is a keyword so the command can not be named after its function
+manager.add_command('import', Import())
+
+
+@manager.option('-n', '--users', dest='users', type=int, default=1000, help='number of fake users')
+@manager.option('-s', '--seed', dest='seed', default='rishe', help='same seed gives the same users')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=1000, help='users inserted at a time')
+@manager.option('-p', '--processes', dest='processes', type=int, default=1, help='processes inserting chunks')
+@manager.option('-t', '--tokens', dest='tokens', default=None, help='file to write id,phone,access token of users to')
+@manager.option('-d', '--now', dest='now', default=None,
+                help='UTC time users registered before and signed tokens issued at (YYYY-MM-DDTHH:MM:SS or now), '
+                     'users are registered before a day picked by seed and tokens issued now by default')
+def fake(users, seed, chunk_size, processes, tokens, now):
     """
     Generate fake data for database
     """
-    pass
+    import csv
+    from datetime import datetime
+    from application.modules.data_transfer import Progress
+    from application.modules.fake_data import create_developer, seed_users
+
+    if now == 'now':
+        now = datetime.utcnow()
+    elif now is not None:
+        now = datetime.strptime(now, '%Y-%m-%dT%H:%M:%S')
+
+    create_developer()
+    output = open(tokens, 'w') if tokens else None
+    try:
+        for inserted in seed_users(users, seed, chunk_size, processes, Progress('fake users'), now):
+            if output is not None:
+                csv.writer(output).writerows(inserted)
+    finally:
+        if output is not None:
+            output.close()
 
 
 @manager.command
@@ -144,7 +145,9 @@ def developer():
     """
     Generate fake user for development use
     """
-    pass
+    from application.modules.fake_data import create_developer
+
+    create_developer()
 
 
 @manager.command
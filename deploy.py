@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
+# python imports
+import os
+
 # project imports
 from application import create_app
-from application.config import DeploymentConfig
+from application.config import DeploymentConfig, ThreadedDeploymentConfig
 
+# uwsgi-threads.ini sets CONCURRENCY=threads, gevent has its own entry point in deploy_gevent.py
+CONFIGS = {
+    'prefork': DeploymentConfig,
+    'threads': ThreadedDeploymentConfig,
+}
 
-app = create_app(DeploymentConfig)
+app = create_app(CONFIGS[os.environ.get('CONCURRENCY', 'prefork')])
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
+    app.run(host='0.0.0.0', port=8000, threaded=app.config['CONCURRENCY'] == 'threads')
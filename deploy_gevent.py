@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+# gevent has to patch standard library before anything else imports it
+from gevent import monkey
+
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+except ImportError:
+    # only needed when database is PostgreSQL
+    pass
+
+# project imports
+from application import create_app
+from application.config import GeventDeploymentConfig
+
+
+app = create_app(GeventDeploymentConfig)
+
+if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
+
+    WSGIServer(('0.0.0.0', 8000), app).serve_forever()
@@ -22,7 +22,6 @@ def reset():
 
 def pull_in_server():
     pull()
-    jsons()
     reset()
     doc()
 
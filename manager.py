@@ -3,8 +3,6 @@
 # find . -name "*.pyc" -exec rm -rf {} \;
 
 # python imports
-import re
-from scrapy import cmdline
 from sys import argv
 # flask imports
 from flask.ext.script import Manager
@@ -50,7 +48,7 @@ def routes():
 @manager.command
 def jsons():
     """
-    Generate json files from Json classes
+    Generate json files from Json classes (for documentation, requests are validated against in memory schemas)
     """
 
     # python imports
@@ -59,19 +57,110 @@ def jsons():
 
     # project imports
     from application import jsons
+    from application.modules.schema_validator import uncamelize
 
     location = os.path.join(app.root_path, 'jsonschema')
 
     if not os.path.exists(location):
         os.makedirs(location)
 
-    uncamelize = lambda camel: re.sub('(.)([A-Z]{1})', r'\1_\2', camel).lower()
-
     for json in jsons.__all__:
         with open(os.path.join(location, '%s.json' % uncamelize(json)), 'w') as f:
             dump(getattr(jsons, json).get_schema(ordered=True), f)
 
 
+@manager.command
+def sms_worker(once=False):
+    """
+    Send queued SMS messages, with --once it stops when queue is empty
+    """
+
+    # project imports
+    from application.extensions import sms
+    from application.modules.sms import SMSWorker
+
+    SMSWorker(app, sms).run(once=once)
+
+
+@manager.command
+def search_worker(once=False):
+    """
+    Send database changes queued for search index, with --once it stops when there are none left
+    """
+
+    # project imports
+    from application.modules.search_sync import SearchSyncWorker
+
+    SearchSyncWorker(app).run(once=once)
+
+
+@manager.option('-f', '--file', dest='path', required=True, help='phone numbers, one per line (first CSV column)')
+@manager.option('-o', '--output', dest='output', default=None, help='CSV file to write status of each phone to')
+@manager.option('--no-codes', dest='send_codes', action='store_false', default=True, help='do not send codes')
+def bulk_authenticate(path, output, send_codes):
+    """
+    Register phone numbers of a file (partner campaigns) and send activation codes to them
+    """
+    import csv
+    import os
+    from collections import Counter
+    from itertools import islice
+    from time import time
+
+    # project imports
+    from application.models import User
+
+    counts = Counter()
+    started = time()
+    with open(path) as phones_file, open(output or os.devnull, 'w') as output_file:
+        phones = (row[0].strip() for row in csv.reader(phones_file) if row)
+        writer = csv.writer(output_file)
+
+        while True:
+            batch = list(islice(phones, 10000))
+            if not batch:
+                break
+
+            results = User.bulk_authenticate(batch, send_codes)
+            counts.update(status for _, status in results)
+            writer.writerows(results)
+            print('{:8d} phones in {:.1f}s'.format(sum(counts.values()), time() - started))
+
+    print(', '.join('%s: %d' % item for item in sorted(counts.items())))
+
+
+@manager.option('-c', '--config', dest='config', default='DeploymentConfig', help='config class name')
+def startup(config):
+    """
+    Profile create_app startup time per phase in a fresh interpreter
+    """
+    import subprocess
+    import sys
+
+    subprocess.call([sys.executable, '-m', 'benchmarks.startup', '--config', config])
+
+
+@manager.option('-s', '--show', dest='name', default=None, help='profile file name to summarize')
+@manager.option('-n', '--limit', dest='limit', default=20, type=int, help='number of profiles or functions to show')
+def profiles(name, limit):
+    """
+    List profiles captured by profiler middleware, newest first, or summarize one of them
+    """
+    import os
+
+    # project imports
+    from application.modules.profiler import list_profiles, summarize
+
+    directory = app.config['PROFILER_DIR']
+    if name is not None:
+        print(summarize(os.path.join(directory, name), limit))
+        return
+
+    print("{:40s} {:27s} {:>8s}  {}".format('Endpoint', 'Captured at (UTC)', 'ms', 'File'))
+    for file_name, endpoint, captured_at, duration in list_profiles(directory)[:limit]:
+        print("{:40s} {:27s} {:8d}  {}".format(endpoint, captured_at.isoformat(), duration, file_name))
+
+
 @manager.command
 def doc():
     """
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# find . -name "*.pyc" -exec rm -rf {} \;
+
+# python imports
+import json
+import unittest
+import zlib
+
+# flask imports
+from flask import request, jsonify
+
+# project imports
+from application import create_app
+from application.config import TestingConfig
+from application.modules import compress
+
+
+class CompressTestCase(unittest.TestCase):
+    app = None
+    items = [{'id': idx, 'name': 'player %d' % idx} for idx in range(100)]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(TestingConfig)
+
+        @cls.app.route('/compress/large')
+        def large():
+            response = jsonify(items=cls.items)
+            response.headers['Vary'] = 'Origin'
+            response.set_etag('players')
+            return response.make_conditional(request)
+
+        @cls.app.route('/compress/small')
+        def small():
+            return jsonify(id=1)
+
+    def setUp(self):
+        self.client = self.app.test_client()
+
+    def get(self, path, **headers):
+        return self.client.get(path, headers=headers)
+
+    def test_accept_encoding(self):
+        response = self.get('/compress/large', **{'Accept-Encoding': 'identity, gzip;q=0.8'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+        self.assertEqual(json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))['items'], self.items)
+
+        for accept_encoding in (None, 'gzip;q=0', 'deflate'):
+            headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+            response = self.get('/compress/large', **headers)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(json.loads(response.data)['items'], self.items)
+
+        # media files are never compressed
+        response = self.get('/media/missing.png', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    @unittest.skipIf(compress.brotli is None, 'Brotli 0.6 or newer is not installed')
+    def test_brotli(self):
+        response = self.get('/compress/large', **{'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.headers.getlist('Vary'), ['Origin, Accept-Encoding'])
+        self.assertEqual(json.loads(compress.brotli.decompress(response.data))['items'], self.items)
+
+        response = self.get('/compress/large', **{'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+    def test_brotli_missing(self):
+        installed, compress.brotli = compress.brotli, None
+        try:
+            response = self.get('/compress/large', **{'Accept-Encoding': 'br, gzip'})
+        finally:
+            compress.brotli = installed
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        response = self.get('/compress/large', **{'Accept-Encoding': 'br'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'br' if installed else None)
+
+    def test_min_size(self):
+        response = self.get('/compress/small', **{'Accept-Encoding': 'gzip'})
+        self.assertLess(len(response.data), self.app.config['COMPRESS_MIN_SIZE'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(json.loads(response.data), {'id': 1})
+
+    def test_vary(self):
+        response = self.get('/compress/large', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.getlist('Vary'), ['Origin, Accept-Encoding'])
+
+    def test_weak_etag(self):
+        response = self.get('/compress/large', **{'Accept-Encoding': 'gzip'})
+        etag = response.headers['ETag']
+        self.assertEqual(etag, 'W/"players"')
+
+        # cached compressed body is served the second time
+        self.assertEqual(self.get('/compress/large', **{'Accept-Encoding': 'gzip'}).data, response.data)
+
+        response = self.get('/compress/large', **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, '')
+
+        # uncompressed representation keeps strong ETag
+        response = self.get('/compress/large')
+        self.assertEqual(response.headers['ETag'], '"players"')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# find . -name "*.pyc" -exec rm -rf {} \;
+
+# python imports
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+from binascii import hexlify
+from datetime import datetime
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy_utils.types.password import Password
+
+# project imports
+from application import create_app
+from application.config import TestingConfig
+from application.extensions import db
+from application.models import User
+from application.modules.data_transfer import FORMATS, NULL, export_rows, import_rows, checkpoint_path, copy_csv
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingProgress(object):
+    """
+    Stop import once the given number of batches is committed
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.total = None
+
+    def update(self, done, rows, finished=False):
+        self.batches -= 1
+        if not self.batches:
+            raise Interrupted()
+
+
+class DataTransferTestCase(unittest.TestCase):
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(TestingConfig)
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.drop_all()
+            db.session.remove()
+        cls.app.extensions['redis'].flushdb()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with self.app.app_context():
+            User.query.delete()
+            for idx in range(10):
+                db.session.add(User(phone='0937200%04d' % idx, user_name=u'کاربر_%d' % idx, coupon_count=idx,
+                                    active=idx % 2 == 0, password='123123' if idx < 2 else None,
+                                    registered_at=datetime(2016, 1, 1, 12, 0, idx, 1000 * idx)))
+            db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def rows():
+        columns = list(User.__table__.columns)
+        return [tuple(value.hash if isinstance(value, Password) else value for value in row)
+                for row in db.session.query(*columns).order_by(User.id)]
+
+    def export(self, fmt):
+        path = os.path.join(self.directory, 'users.%s' % fmt)
+        with open(path, 'w') as f:
+            self.assertEqual(export_rows(User, f, fmt, batch_size=4), 10)
+        User.query.delete()
+        db.session.commit()
+        return path
+
+    def test_export_import(self):
+        with self.app.app_context():
+            expected = self.rows()
+            for fmt in FORMATS:
+                path = self.export(fmt)
+                self.assertEqual(import_rows(User, path, fmt, batch_size=4), 10)
+                self.assertEqual(self.rows(), expected)
+                self.assertFalse(os.path.exists(checkpoint_path(path)))
+
+                # hashes are moved as they are
+                self.assertTrue(User.query.filter_by(phone='09372000001').one().password == '123123')
+
+    def test_resume(self):
+        with self.app.app_context():
+            expected = self.rows()
+            for fmt in FORMATS:
+                path = self.export(fmt)
+                self.assertRaises(Interrupted, import_rows, User, path, fmt, 3, progress=InterruptingProgress(2))
+                db.session.rollback()
+                self.assertEqual(User.query.count(), 6)
+                with open(checkpoint_path(path)) as f:
+                    self.assertEqual(f.read(), '6')
+
+                self.assertEqual(import_rows(User, path, fmt, batch_size=3, resume=True), 4)
+                self.assertEqual(self.rows(), expected)
+                self.assertFalse(os.path.exists(checkpoint_path(path)))
+
+    def test_copy_csv(self):
+        password = User.__table__.c.password.type.context.encrypt('123123')
+        mappings = [{'id': 1, 'phone': '09372000001', 'user_name': u'کاربر', 'password': Password(password),
+                     'active': True, 'registered_at': datetime(2016, 1, 1, 12, 0, 0, 5), 'coupon_count': 2}]
+
+        with self.app.app_context():
+            rows = list(csv.reader(copy_csv(User, mappings, PGDialect_psycopg2())))
+        row = dict(zip([column.name for column in User.__table__.columns], rows[0]))
+
+        # bytea in COPY text format, not the driver quoted literal
+        self.assertEqual(row['password'], '\\x' + hexlify(password))
+        self.assertEqual(row['user_name'], u'کاربر'.encode('utf-8'))
+        self.assertEqual(row['active'], 'true')
+        self.assertEqual(row['registered_at'], '2016-01-01T12:00:00.000005')
+        self.assertEqual(row['national_code'], NULL)
+
+
+if __name__ == '__main__':
+    unittest.main()
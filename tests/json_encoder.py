@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# find . -name "*.pyc" -exec rm -rf {} \;
+
+# python imports
+import unittest
+from datetime import datetime, date
+from decimal import Decimal
+
+# project imports
+from application.modules.json_encoder import available_backends, make_encoder
+
+
+class JSONEncoderTestCase(unittest.TestCase):
+    value = {'registered_at': datetime(2016, 1, 1, 12, 30, 5, 250), 'birthday': date(1990, 2, 3),
+             'price': Decimal('9.50'), 'name': u'ریشه', 'items': [1, 2.5, None, True]}
+
+    def test_backends_agree(self):
+        for compact in (False, True):
+            for indent in (None, 2):
+                for ensure_ascii in (True, False):
+                    outputs = set()
+                    for backend in available_backends():
+                        encoder = make_encoder(backend, compact)(sort_keys=True, indent=indent,
+                                                                 ensure_ascii=ensure_ascii)
+                        outputs.add(encoder.encode(self.value))
+                    self.assertEqual(len(outputs), 1, outputs)
+
+    def test_values(self):
+        for backend in available_backends():
+            encoder = make_encoder(backend, compact=True)(sort_keys=True)
+            self.assertEqual(encoder.encode(self.value),
+                             '{"birthday":"1990-02-03","items":[1,2.5,null,true],"name":"\\u0631\\u06cc\\u0634\\u0647",'
+                             '"price":9.5,"registered_at":"2016-01-01 12:30:05.000250"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
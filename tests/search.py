@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# find . -name "*.pyc" -exec rm -rf {} \;
+
+# python imports
+import unittest
+from time import sleep
+from redis.exceptions import ConnectionError
+
+# project imports
+from application import create_app
+from application.config import TestingConfig
+from application.extensions import db, es, redis
+from application.models import Player, Team
+from application.modules.search import index_body, reindex
+from application.modules.search_sync import SearchSyncWorker, enqueue
+
+
+class SearchConfig(TestingConfig):
+    ELASTICSEARCH_HOST = 'memory://'
+    SEARCH_BULK_CHUNK_SIZE = 10
+    SEARCH_BULK_THREADS = 2
+    SEARCH_SYNC_ENABLED = True
+
+
+class SearchTestCase(unittest.TestCase):
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(SearchConfig)
+        with cls.app.app_context():
+            db.create_all()
+            team = Team(name_fa=u'پرسپولیس')
+            for idx in range(95):
+                db.session.add(Player(name_fa=u'بازیکن %d' % idx, name_en=u'Player %d' % idx, post='FW',
+                                      price=5.5, team=team))
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.drop_all()
+            db.session.remove()
+        cls.app.extensions['redis'].flushdb()
+
+    def setUp(self):
+        with self.app.app_context():
+            for index in es.indices.get_settings(index='_all'):
+                es.indices.delete(index=index)
+            outbox = self.app.config['SEARCH_SYNC_OUTBOX']
+            redis.delete(outbox, '%s:processing' % outbox)
+
+    def test_reindex(self):
+        with self.app.app_context():
+            alias = self.app.config['SEARCH_INDEX']
+            es.indices.create(index=alias, body=index_body())
+
+            # index of the time before aliases is replaced by the alias in one call, it is never deleted alone
+            client = es.current_client()
+            deleted = []
+
+            def delete(index, **kwargs):
+                deleted.append(index)
+                return type(client.indices).delete(client.indices, index, **kwargs)
+
+            client.indices.delete = delete
+            try:
+                index, indexed = reindex()
+            finally:
+                del client.indices.delete
+            self.assertNotIn(alias, deleted)
+            self.assertEqual(indexed, 95)
+            self.assertEqual(es.indices.get_alias(name=alias).keys(), [index])
+            self.assertEqual(es.indices.get_settings(index='_all').keys(), [index])
+            self.assertEqual(es.count(index=alias)['count'], 95)
+            self.assertEqual(es.search(index=alias, q=u'Player 7')['hits']['hits'][0]['_source']['team'],
+                             u'پرسپولیس')
+
+            settings = es.indices.get_settings(index=index)[index]['settings']['index']
+            self.assertEqual(settings['refresh_interval'], self.app.config['SEARCH_REFRESH_INTERVAL'])
+            self.assertEqual(settings['number_of_replicas'], self.app.config['SEARCH_REPLICAS'])
+
+            new_index, _ = reindex()
+            self.assertEqual(es.indices.get_alias(name=alias).keys(), [new_index])
+            self.assertFalse(es.indices.exists(index=index))
+
+    def test_failed_reindex_keeps_alias(self):
+        with self.app.app_context():
+            alias = self.app.config['SEARCH_INDEX']
+            index, _ = reindex()
+
+            client = es.current_client()
+
+            def failing_bulk(body, **kwargs):
+                response = type(client).bulk(client, body, **kwargs)
+                for item in response['items']:
+                    item['index']['status'] = 500
+                return response
+
+            client.bulk = failing_bulk
+            try:
+                self.assertRaises(RuntimeError, reindex)
+            finally:
+                del client.bulk
+
+            self.assertEqual(es.indices.get_alias(name=alias).keys(), [index])
+            self.assertEqual(es.indices.get_settings(index='_all').keys(), [index])
+
+    def test_sync(self):
+        with self.app.app_context():
+            alias = self.app.config['SEARCH_INDEX']
+            outbox = self.app.config['SEARCH_SYNC_OUTBOX']
+            reindex()
+
+            player = Player(name_fa=u'علی کریمی', name_en=u'Ali Karimi', post='MF', price=9.0, team=Team.query.first())
+            db.session.add(player)
+            db.session.commit()
+            queued_at = redis.zscore(outbox, 'player:%d' % player.id)
+            self.assertIsNotNone(queued_at)
+            sleep(0.01)
+            player.price = 9.5
+            db.session.commit()
+            player_id = player.id
+            # both commits are one change to send, queued when the first one was
+            self.assertEqual(redis.zcard(outbox), 1)
+            self.assertEqual(redis.zscore(outbox, 'player:%d' % player_id), queued_at)
+
+            SearchSyncWorker(self.app).run(once=True)
+            self.assertEqual(redis.zcard(outbox), 0)
+            self.assertEqual(es.get(index=alias, doc_type='player', id=player_id)['_source']['price'], 9.5)
+
+            Team.query.first().name_fa = u'استقلال'
+            db.session.commit()
+            SearchSyncWorker(self.app).run(once=True)
+            self.assertEqual(es.count(index=alias, q=u'استقلال')['count'], 96)
+
+            db.session.delete(Player.query.get(player_id))
+            db.session.commit()
+            SearchSyncWorker(self.app).run(once=True)
+            self.assertEqual(es.count(index=alias)['count'], 95)
+
+    def test_killed_worker(self):
+        with self.app.app_context():
+            alias = self.app.config['SEARCH_INDEX']
+            outbox = self.app.config['SEARCH_SYNC_OUTBOX']
+            reindex()
+
+            player = Player(name_fa=u'مهدی طارمی', name_en=u'Mehdi Taremi', post='FW', price=8.0,
+                            team=Team.query.first())
+            db.session.add(player)
+            db.session.commit()
+            player_id = player.id
+
+            # worker is killed after it claimed the change and before it was sent
+            members = SearchSyncWorker(self.app).claim()
+            self.assertEqual(members, ['player:%d' % player_id])
+            self.assertEqual(redis.zcard(outbox), 0)
+
+            SearchSyncWorker(self.app).run(once=True)
+            self.assertEqual(es.get(index=alias, doc_type='player', id=player_id)['_source']['price'], 8.0)
+            self.assertEqual(redis.zcard(outbox), 0)
+            self.assertEqual(redis.zcard('%s:processing' % outbox), 0)
+
+            db.session.delete(Player.query.get(player_id))
+            db.session.commit()
+            SearchSyncWorker(self.app).run(once=True)
+
+    def test_outbox_unavailable(self):
+        with self.app.app_context():
+            client = redis._redis_client
+
+            def failing_execute_command(*args, **kwargs):
+                raise ConnectionError('Redis is down')
+
+            player = Player(name_fa=u'کریم باقری', name_en=u'Karim Bagheri', post='MF', price=7.0,
+                            team=Team.query.first())
+            db.session.add(player)
+            client.execute_command = failing_execute_command
+            try:
+                # row is committed even though its change could not be queued
+                db.session.commit()
+            finally:
+                del client.execute_command
+
+            player_id = player.id
+            self.assertEqual(redis.zcard(self.app.config['SEARCH_SYNC_OUTBOX']), 0)
+            db.session.delete(Player.query.get(player_id))
+            db.session.commit()
+
+
+class MemoryRedisConfig(SearchConfig):
+    REDIS_URL = 'memory://'
+
+
+class MemoryRedisSyncTestCase(unittest.TestCase):
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(MemoryRedisConfig)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.extensions['redis'].flushdb()
+
+    def test_enqueue(self):
+        with self.app.app_context():
+            outbox = self.app.config['SEARCH_SYNC_OUTBOX']
+            enqueue(['player:1'])
+            queued_at = redis.zscore(outbox, 'player:1')
+            sleep(0.01)
+
+            pipe = redis.pipeline()
+            enqueue(['player:1', 'player:2'], pipe)
+            pipe.execute()
+            self.assertEqual(redis.zscore(outbox, 'player:1'), queued_at)
+            self.assertGreater(redis.zscore(outbox, 'player:2'), queued_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,14 +3,36 @@
 # find . -name "*.pyc" -exec rm -rf {} \;
 
 # python imports
+import os
 import unittest
 import json
+from datetime import datetime
+from time import sleep
 
 # project imports
 from application import create_app
 from application.config import TestingConfig
-from application.extensions import db, redis
+from application.decorators import paginate, _cursor_serializer
+from application.extensions import db, redis, sms, token_cache
+from application.models import user as user_module
 from application.models import User
+from application.modules import count_cache
+from application.modules.fake_data import seed_users
+from application.modules.local_cache import MISSING
+from application.modules.sms import Provider, SMSWorker
+from application.modules.token_cache import TokenCache
+from application.modules.query_counter import assert_max_queries
+
+# most SQL statements each endpoint may run, a query per item of a list shows up here first
+QUERY_BUDGETS = {
+    'authenticate': 3,
+    'activate': 4,
+    'profile': 1,
+    'profile_other': 1,
+    'edit_info': 2,
+    'refresh': 3,
+    'revoke': 2,
+}
 
 
 def authenticate(self, phone):
@@ -44,12 +66,16 @@ def create_password(self, password):
                             data=json.dumps({'new_password': password}))
 
 
-class UserTestCase(unittest.TestCase):
+class UserAppTestCase(unittest.TestCase):
+    """
+    Fresh database and test client for an app built from config
+    """
     app = None
+    config = TestingConfig
 
     @classmethod
     def setUpClass(cls):
-        cls.app = create_app(TestingConfig)
+        cls.app = create_app(cls.config)
         with cls.app.app_context():
             db.create_all()
 
@@ -67,6 +93,8 @@ class UserTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+
+class UserTestCase(UserAppTestCase):
     def test_authenticate(self):
         with self.app.app_context():
             response = authenticate(self, "093081849422")
@@ -108,6 +136,31 @@ class UserTestCase(unittest.TestCase):
             response = activate(self, "09301477885", "13740")
             self.assertEquals(response.status_code, 404)
 
+    def test_bulk_authenticate(self):
+        def bulk_authenticate(phones, api_key='partner'):
+            headers = dict(self.headers, **{'X-Api-Key': api_key})
+            return self.client.post('/api/v1/user/bulk_authenticate', headers=headers,
+                                    data=json.dumps({'phones': phones}))
+
+        with self.app.app_context():
+            self.app.config['BULK_API_KEY'] = 'partner'
+            try:
+                authenticate(self, "09375876901")
+
+                response = bulk_authenticate(["09375876901"], 'wrong')
+                self.assertEqual(response.status_code, 401)
+
+                with assert_max_queries(4):
+                    response = bulk_authenticate(["09375876901", "09375876902", "0937", "09375876902"])
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([item['status'] for item in json.loads(response.data)['results']],
+                                 ['existing', 'created', 'invalid', 'duplicate'])
+
+                user_obj = User.query.filter_by(phone="09375876902").one()
+                self.assertIsNotNone(redis.get('uac:%d' % user_obj.id))
+            finally:
+                self.app.config['BULK_API_KEY'] = None
+
     def test_web_authenticate(self):
         with self.app.app_context():
             phone = "09375876888"
@@ -193,6 +246,28 @@ class UserTestCase(unittest.TestCase):
             response = info_other(85)
             self.assertEqual(response.status_code, 404)
 
+    def test_info_after_edit_info(self):
+        def info():
+            return self.client.get('/api/v1/user', headers=self.headers)
+
+        def edit_info(user_name):
+            return self.client.put('/api/v1/user', headers=self.headers, data=json.dumps({'user_name': user_name}))
+
+        with self.app.app_context():
+            phone = "09375876890"
+            authenticate(self, phone)
+            access(self, phone)
+
+            # warm up cached user row
+            response = info()
+            self.assertIsNone(json.loads(response.data)['user_name'])
+
+            response = edit_info('cached')
+            self.assertEqual(response.status_code, 200)
+
+            response = info()
+            self.assertEqual(json.loads(response.data)['user_name'], 'cached')
+
     def test_edit_info(self):
         def edit_info(user_name, real_name, national_code):
             data = {'user_name': user_name, 'real_name': real_name, 'national_code': national_code}
@@ -342,7 +417,542 @@ class UserTestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 401)
 
     def test_revoke_all(self):
-        pass
+        def info():
+            return self.client.get('/api/v1/user', headers=self.headers)
+
+        def revoke_all():
+            return self.client.delete('/api/v1/user/revoke_all', headers=self.headers)
+
+        with self.app.app_context():
+            phone = "09372643536"
+            authenticate(self, phone)
+            first_access_token = access(self, phone)
+            second_access_token = access(self, phone)
+
+            # warm up token cache for both tokens
+            response = info()
+            self.assertEqual(response.status_code, 200)
+            self.headers['Access-Token'] = first_access_token
+            response = info()
+            self.assertEqual(response.status_code, 200)
+
+            response = revoke_all()
+            self.assertEqual(response.status_code, 200)
+
+            response = info()
+            self.assertEqual(response.status_code, 401)
+            self.headers['Access-Token'] = second_access_token
+            response = info()
+            self.assertEqual(response.status_code, 401)
+
+    def test_revoke_during_token_lookup(self):
+        def info():
+            return self.client.get('/api/v1/user', headers=self.headers)
+
+        with self.app.app_context():
+            phone = "09372643538"
+            authenticate(self, phone)
+            access_token = access(self, phone)
+
+            cache = self.app.extensions['token_cache']
+            for _ in range(50):
+                if cache._listening():
+                    break
+                sleep(0.1)
+            self.assertTrue(cache._listening())
+            cache.cache.delete(access_token)
+
+            pipeline = redis.pipeline
+
+            def racing_pipeline(*args, **kwargs):
+                # token is revoked right after it is read from Redis and before it is cached
+                pipe = pipeline(*args, **kwargs)
+                execute = pipe.execute
+
+                def execute_then_revoke(*execute_args, **execute_kwargs):
+                    result = execute(*execute_args, **execute_kwargs)
+                    del redis.pipeline
+                    redis.delete('uat:%s' % access_token)
+                    User.revoke_access_token(access_token)
+                    return result
+
+                pipe.execute = execute_then_revoke
+                return pipe
+
+            redis.pipeline = racing_pipeline
+            try:
+                response = info()
+            finally:
+                redis.__dict__.pop('pipeline', None)
+            self.assertEqual(response.status_code, 200)
+
+            self.assertIs(cache.get(access_token), MISSING)
+            response = info()
+            self.assertEqual(response.status_code, 401)
+
+    def test_uninitialized_token_cache(self):
+        with self.app.app_context():
+            phone = "09372643542"
+            authenticate(self, phone)
+            access(self, phone)
+
+            # token_cache left out of EXTENSIONS
+            user_module.token_cache = TokenCache()
+            try:
+                response = self.client.put('/api/v1/user', headers=self.headers,
+                                           data=json.dumps({'real_name': u'Uncached'}))
+                self.assertEqual(response.status_code, 200)
+                response = self.client.delete('/api/v1/user/revoke', headers=self.headers)
+                self.assertEqual(response.status_code, 200)
+            finally:
+                user_module.token_cache = token_cache
+
+    def test_query_budgets(self):
+        with self.app.app_context():
+            phone = "09375876895"
+            authenticate(self, "09375876896")
+
+            with assert_max_queries(QUERY_BUDGETS['authenticate']):
+                response = authenticate(self, phone)
+            self.assertEqual(response.status_code, 201)
+
+            with assert_max_queries(QUERY_BUDGETS['activate']):
+                response = activate(self, phone, '13740')
+            self.assertEqual(response.status_code, 201)
+            tokens = json.loads(response.data)
+            self.headers['Access-Token'] = tokens['access']
+
+            with assert_max_queries(QUERY_BUDGETS['profile']):
+                response = self.client.get('/api/v1/user', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+
+            other = User.query.filter_by(phone="09375876896").one()
+            with assert_max_queries(QUERY_BUDGETS['profile_other']):
+                response = self.client.get('/api/v1/user/%d' % other.id, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+
+            with assert_max_queries(QUERY_BUDGETS['edit_info']):
+                response = self.client.put('/api/v1/user', headers=self.headers,
+                                           data=json.dumps({'real_name': 'Budget'}))
+            self.assertEqual(response.status_code, 200)
+
+            with assert_max_queries(QUERY_BUDGETS['refresh']):
+                response = refresh(self, tokens['access'], tokens['refresh'])
+            self.assertEqual(response.status_code, 200)
+            self.headers['Access-Token'] = json.loads(response.data)['access']
+
+            with assert_max_queries(QUERY_BUDGETS['revoke']):
+                response = self.client.delete('/api/v1/user/revoke', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+
+
+class SignedAccessTokenConfig(TestingConfig):
+    ACCESS_TOKEN_SIGNED = True
+
+
+class SignedAccessTokenTestCase(UserAppTestCase):
+    config = SignedAccessTokenConfig
+
+    def test_signed_access_token(self):
+        def info():
+            return self.client.get('/api/v1/user', headers=self.headers)
+
+        with self.app.app_context():
+            phone = "09372643542"
+            authenticate(self, phone)
+            access(self, phone)
+
+            response = info()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['phone'], phone)
+            # nothing is stored per token
+            self.assertEqual(redis.keys('uat:*'), [])
+
+    def test_revoke(self):
+        def info():
+            return self.client.get('/api/v1/user', headers=self.headers)
+
+        with self.app.app_context():
+            phone = "09372643543"
+            authenticate(self, phone)
+            first_access_token = access(self, phone)
+            second_access_token = access(self, phone)
+            third_access_token = access(self, phone)
+
+            response = self.client.delete('/api/v1/user/revoke', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            response = info()
+            self.assertEqual(response.status_code, 401)
+
+            self.headers['Access-Token'] = second_access_token
+            response = info()
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.delete('/api/v1/user/revoke_all', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            for access_token in (first_access_token, second_access_token, third_access_token):
+                self.headers['Access-Token'] = access_token
+                response = info()
+                self.assertEqual(response.status_code, 401)
+
+            # tokens issued after revoke_all are valid
+            access(self, phone)
+            response = info()
+            self.assertEqual(response.status_code, 200)
+
+    def test_seeded_access_token(self):
+        with self.app.app_context():
+            # rows are seeded on a day picked by seed, tokens are issued now
+            inserted, = seed_users(1, 'signed')
+            (_, phone, access_token), = inserted
+            self.headers['Access-Token'] = access_token
+
+            response = self.client.get('/api/v1/user', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['phone'], phone)
+
+    def test_tampered_access_token(self):
+        def info():
+            return self.client.get('/api/v1/user', headers=self.headers)
+
+        with self.app.app_context():
+            phone = "09372643537"
+            authenticate(self, phone)
+            access_token = access(self, phone)
+
+            # low bits of last base64 character may be ignored when decoding so payload is changed instead
+            self.headers['Access-Token'] = ('A' if access_token[0] != 'A' else 'B') + access_token[1:]
+            response = info()
+            self.assertEqual(response.status_code, 401)
+
+
+class SMSQueueConfig(TestingConfig):
+    SMS_ON = True
+
+
+class SMSQueueTestCase(UserAppTestCase):
+    config = SMSQueueConfig
+
+    def setUp(self):
+        super(SMSQueueTestCase, self).setUp()
+        self.worker = SMSWorker(self.app, sms)
+        redis.delete(sms.queue, self.worker.processing, self.worker.retry_queue, self.worker.dead_queue)
+        del sms.providers['fake'].sent[:]
+
+    def test_activation_code_queue(self):
+        with self.app.app_context():
+            phone = "09372643544"
+            provider = sms.providers['fake']
+
+            response = authenticate(self, phone)
+            self.assertEquals(response.status_code, 201)
+            self.assertEquals(redis.llen(sms.queue), 1)
+            self.assertEquals(provider.sent, [])
+
+            self.worker.run(once=True)
+            self.assertEquals(redis.llen(sms.queue), 0)
+            self.assertEquals(len(provider.sent), 1)
+
+            user_obj = User.query.filter_by(phone=phone).one()
+            self.assertEquals(provider.sent[0]['phone'], phone)
+            self.assertIn(redis.get('uac:%d' % user_obj.id), provider.sent[0]['text'])
+
+    def test_failed_sms_retry(self):
+        with self.app.app_context():
+            phone = "09372643545"
+            provider = sms.providers['fake']
+            provider.failure_rate = 1
+            try:
+                sms.enqueue('text', phone)
+                self.worker.run(once=True)
+            finally:
+                provider.failure_rate = 0
+
+            self.assertEquals(redis.llen(sms.queue), 0)
+            retries = redis.zrange(self.worker.retry_queue, 0, -1)
+            self.assertEquals(len(retries), 1)
+            self.assertEquals(json.loads(retries[0])['attempts'], 1)
+
+            redis.zadd(self.worker.retry_queue, 0, retries[0])
+            SMSWorker(self.app, sms).run(once=True)
+            self.assertEquals(provider.sent[-1]['phone'], phone)
+            self.assertEquals(redis.zcard(self.worker.retry_queue), 0)
+
+    def test_killed_worker_batch(self):
+        with self.app.app_context():
+            provider = sms.providers['fake']
+            for text in ('first', 'second', 'third'):
+                sms.enqueue(text, "09372643546")
+
+            # worker is killed after taking a batch of two
+            self.worker.batch_size = 2
+            self.assertEquals([message['text'] for message in self.worker.pop_batch(block=False)], ['first', 'second'])
+            self.assertEquals(redis.llen(sms.queue), 1)
+
+            SMSWorker(self.app, sms).run(once=True)
+            self.assertEquals([message['text'] for message in provider.sent], ['first', 'second', 'third'])
+            self.assertEquals(redis.llen(self.worker.processing), 0)
+
+    def test_send_one_by_one(self):
+        class OneByOneProvider(Provider):
+            def send(self, message):
+                return message['phone'] != "09372643547"
+
+        messages = [sms.message('text', phone) for phone in ("09372643547", "09372643548")]
+        self.assertEquals(OneByOneProvider().send_many(messages), messages[:1])
+
+
+class ResponseCacheConfig(TestingConfig):
+    RESPONSE_CACHE_BACKEND = 'redis'
+
+
+class ResponseCacheTestCase(UserAppTestCase):
+    config = ResponseCacheConfig
+
+    def info(self, etag=None):
+        headers = dict(self.headers, **({'If-None-Match': etag} if etag else {}))
+        return self.client.get('/api/v1/user', headers=headers)
+
+    def test_cache_hit(self):
+        with self.app.app_context():
+            phone = "09372643549"
+            authenticate(self, phone)
+            access(self, phone)
+
+            response = self.info()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+
+            # bulk update skips session listeners, the entry stays current and is served instead of the new row
+            user_obj = User.query.filter_by(phone=phone).one()
+            User.query.filter_by(id=user_obj.id).update({'real_name': u'Hidden'})
+            db.session.commit()
+
+            cached = self.info()
+            self.assertEqual(cached.status_code, 200)
+            self.assertEqual(cached.data, response.data)
+            self.assertEqual(cached.headers['ETag'], response.headers['ETag'])
+
+    def test_not_modified(self):
+        with self.app.app_context():
+            phone = "09372643550"
+            authenticate(self, phone)
+            access(self, phone)
+
+            etag = self.info().headers['ETag']
+            response = self.info(etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, '')
+
+            response = self.info('"other"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_tag_invalidation(self):
+        with self.app.app_context():
+            phone = "09372643540"
+            authenticate(self, phone)
+            access(self, phone)
+
+            etag = self.info().headers['ETag']
+
+            response = self.client.put('/api/v1/user', headers=self.headers, data=json.dumps({'real_name': u'Cached'}))
+            self.assertEqual(response.status_code, 200)
+
+            response = self.info(etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertEqual(json.loads(response.data)['real_name'], 'Cached')
+
+    def test_stale_user_row_of_other_worker(self):
+        def info(worker):
+            user_module.token_cache = worker
+            try:
+                return self.client.get('/api/v1/user', headers=self.headers)
+            finally:
+                user_module.token_cache = token_cache
+
+        with self.app.app_context():
+            phone = "09372643541"
+            authenticate(self, phone)
+            access(self, phone)
+
+            # a second worker which is subscribed but has not received the invalidation of the row yet
+            other = TokenCache(self.app)
+            self.app.extensions['token_cache'] = token_cache
+            other._pid, other._ready = os.getpid(), True
+
+            response = info(other)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNot(other.get_user(User.query.filter_by(phone=phone).one().id), MISSING)
+
+            response = self.client.put('/api/v1/user', headers=self.headers, data=json.dumps({'real_name': u'Fresh'}))
+            self.assertEqual(response.status_code, 200)
+
+            # other worker builds the response again and must not store its old row under the new tag version
+            response = info(other)
+            self.assertEqual(json.loads(response.data)['real_name'], 'Fresh')
+            response = info(token_cache)
+            self.assertEqual(json.loads(response.data)['real_name'], 'Fresh')
+
+
+class PaginateConfig(TestingConfig):
+    # counts are cached in memory
+    CACHE_TYPE = 'simple'
+    PAGINATE_STREAM_CHUNK_SIZE = 10
+
+
+class PaginateTestCase(unittest.TestCase):
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(PaginateConfig)
+
+        @cls.app.route('/test/users/coupons')
+        @paginate('users', 100, mode='keyset', order_by=User.coupon_count.desc())
+        def users_by_coupons():
+            return User.query
+
+        @cls.app.route('/test/users/registered')
+        @paginate('users', 100, mode='keyset', order_by=User.registered_at)
+        def users_by_registered_at():
+            return User.query
+
+        @cls.app.route('/test/users/stream')
+        @paginate('users', 1000, mode='keyset', stream=True)
+        def users_stream():
+            return User.query
+
+        @cls.app.route('/test/users/stream/offset')
+        @paginate('users', 1000, stream=True)
+        def users_stream_offset():
+            return User.query.order_by(User.id)
+
+        with cls.app.app_context():
+            db.create_all()
+            # groups of equal values span page boundaries, half of the times have microseconds
+            for idx in range(25):
+                db.session.add(User(phone='0937100%04d' % idx, coupon_count=idx % 3,
+                                    registered_at=datetime(2016, 1, 1, 12, 0, idx % 4, 500000 * (idx % 2))))
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.drop_all()
+            db.session.remove()
+        cls.app.extensions['redis'].flushdb()
+
+    def setUp(self):
+        self.headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        self.client = self.app.test_client(use_cookies=False)
+
+    def get(self, url):
+        # meta urls are external and test client drops query string of those
+        response = self.client.get(url.replace('http://localhost', ''), headers=self.headers)
+        return response, json.loads(response.data) if response.status_code == 200 else None
+
+    def walk(self, url):
+        """
+        :return: pages of phones read by following meta.next urls and the last page
+        """
+        pages = []
+        while url:
+            self.assertLess(len(pages), 10)
+            response, data = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([user['phone'] for user in data['users']])
+            url = data['meta']['next']
+        return pages, data
+
+    def test_count_cache(self):
+        with self.app.app_context():
+            query = User.query.filter(User.coupon_count > 0)
+            self.assertEqual(count_cache.count(query), 16)
+            with assert_max_queries(0):
+                self.assertEqual(count_cache.count(query), 16)
+
+            # rolled back changes keep cached counts, also after the next commit
+            db.session.add(User(phone='09371009999', coupon_count=1))
+            db.session.flush()
+            db.session.rollback()
+            db.session.commit()
+            with assert_max_queries(0):
+                self.assertEqual(count_cache.count(query), 16)
+
+            user = User(phone='09371009999', coupon_count=1)
+            db.session.add(user)
+            db.session.commit()
+            self.assertEqual(count_cache.count(query), 17)
+
+            db.session.delete(user)
+            db.session.commit()
+            self.assertEqual(count_cache.count(query), 16)
+
+    def test_keyset_pages(self):
+        with self.app.app_context():
+            expected = [user.phone for user in User.query.order_by(User.coupon_count.desc(), User.id)]
+            pages, last = self.walk('/test/users/coupons?per_page=10')
+
+            self.assertEqual([len(page) for page in pages], [10, 10, 5])
+            self.assertEqual(sum(pages, []), expected)
+            self.assertIsNone(last['meta']['next'])
+            self.assertIsNone(last['meta']['total'])
+
+            response, data = self.get(last['meta']['prev'])
+            self.assertEqual([user['phone'] for user in data['users']], pages[1])
+            response, data = self.get(data['meta']['prev'])
+            self.assertEqual([user['phone'] for user in data['users']], pages[0])
+            self.assertIsNone(data['meta']['prev'])
+
+            response, data = self.get('/test/users/coupons?per_page=100&total=1')
+            self.assertEqual(len(data['users']), 25)
+            self.assertEqual(data['meta']['total'], 25)
+            self.assertIsNone(data['meta']['next'])
+
+    def test_keyset_ties(self):
+        with self.app.app_context():
+            expected = [user.phone for user in User.query.order_by(User.registered_at, User.id)]
+            pages, _ = self.walk('/test/users/registered?per_page=4')
+            self.assertEqual(sum(pages, []), expected)
+
+    def test_stream(self):
+        with self.app.app_context():
+            expected = [user.phone for user in User.query.order_by(User.id)]
+
+            for path in ('/test/users/stream', '/test/users/stream/offset'):
+                headers = dict(self.headers, Accept='application/x-ndjson')
+                response = self.client.get(path + '?per_page=22', headers=headers)
+                self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+                # one item per line, then meta
+                lines = response.data.split('\n')
+                self.assertEqual(len(lines), 24)
+                self.assertEqual(lines[-1], '')
+                self.assertEqual([json.loads(line)['phone'] for line in lines[:22]], expected[:22])
+                self.assertEqual(json.loads(lines[22])['meta']['per_page'], 22)
+                self.assertIsNotNone(json.loads(lines[22])['meta']['next'])
+
+                response, data = self.get(path + '?per_page=30')
+                self.assertEqual(response.mimetype, 'application/json')
+                self.assertEqual([user['phone'] for user in data['users']], expected)
+                self.assertIsNone(data['meta']['next'])
+
+    def test_cursor(self):
+        with self.app.app_context():
+            response, data = self.get('/test/users/registered?per_page=3')
+            cursor = data['meta']['next'].split('cursor=')[1].split('&')[0]
+
+            last = User.query.filter_by(phone=data['users'][-1]['phone']).one()
+            direction, values = _cursor_serializer().loads(cursor)
+            self.assertEqual(direction, 'n')
+            self.assertEqual(values, [{'dt': last.registered_at.isoformat()}, last.id])
+
+            # cursor values are signed, first character of payload is never ignored when decoding
+            tampered = ('X' if cursor[0] != 'X' else 'Y') + cursor[1:]
+            for bad in (tampered, 'garbage', _cursor_serializer().dumps(['n', [last.id]])):
+                response, _ = self.get('/test/users/registered?per_page=3&cursor=%s' % bad)
+                self.assertEqual(response.status_code, 400)
 
 
 if __name__ == '__main__':